@@ -0,0 +1,171 @@
+"""Микробенчмарк рендеринга заявок и клавиатур.
+
+Сравнивает прежнюю реализацию (quote_plus и сборка разметки на каждый
+вызов) с текущей из bot.py. Запуск:
+
+    python bench_render.py [число_итераций]
+"""
+import sys
+import time
+from typing import Optional
+from urllib.parse import quote_plus
+
+from aiogram import types
+
+import bot
+
+# ============ ПРЕЖНЯЯ РЕАЛИЗАЦИЯ ============
+
+
+def legacy_format_ticket_text(
+    ticket_id: int,
+    store: str,
+    sender_id: int,
+    equipment: str,
+    description: str,
+    priority: str,
+    status: str,
+    sender_name: Optional[str] = None,
+    executor_name: str = "",
+    executor_id: Optional[int] = None,
+):
+    if status == "Создана":
+        status_text = "Создана"
+    elif status == "Выполняется" and executor_name:
+        if executor_id:
+            status_text = (
+                f'Выполняется <a href="tg://user?id={executor_id}">{executor_name}</a>'
+            )
+        else:
+            status_text = f"Выполняется {executor_name}"
+    elif status == "Выполнена" and executor_name:
+        if executor_id:
+            status_text = (
+                f'Выполнена <a href="tg://user?id={executor_id}">{executor_name}</a>'
+            )
+        else:
+            status_text = f"Выполнена {executor_name}"
+    elif status == "Аннулирована пользователем":
+        status_text = "Аннулирована пользователем"
+    else:
+        status_text = status
+
+    sender_label = sender_name or "Отправитель"
+
+    address_line = ""
+    if store and bot.CONFIG.stores:
+        address = bot.CONFIG.stores.get(str(store).strip())
+        if address:
+            q = quote_plus(address)
+            yandex_url = f"https://yandex.ru/maps/?text={q}"
+            google_url = f"https://maps.google.com/?q={q}"
+            dgis_url = f"https://2gis.ru/search/{q}"
+            address_line = (
+                f"<b>Адрес:</b> {address}\n"
+                f"Открыть в: "
+                f'<a href="{yandex_url}">Яндекс</a> | '
+                f'<a href="{dgis_url}">2ГИС</a> | '
+                f'<a href="{google_url}">Google</a>\n'
+            )
+
+    return (
+        f"#{ticket_id}\n"
+        f"<b>Магазин:</b> {store} / "
+        f'<a href="tg://user?id={sender_id}">{sender_label}</a>\n'
+        f"{address_line}"
+        f"<b>Оборудование:</b> {equipment}\n"
+        f"<b>Описание:</b> {description}\n"
+        f"<b>Срочность:</b> {priority}\n"
+        f"<b>Статус:</b> {status_text}\n"
+    )
+
+
+def legacy_equipment_keyboard():
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
+    kb.add("Весы", "Видеонаблюдение")
+    kb.add("Интернет", "Кассовое оборудование")
+    kb.add("Другое")
+    kb.add(bot.CANCEL_TEXT)
+    return kb
+
+
+def legacy_tech_inline_keyboard(ticket_id: int, sender_id: int):
+    kb = types.InlineKeyboardMarkup()
+    kb.add(
+        types.InlineKeyboardButton("Принять", callback_data=f"take_{ticket_id}"),
+        types.InlineKeyboardButton("Завершить", callback_data=f"done_{ticket_id}"),
+    )
+    kb.add(
+        types.InlineKeyboardButton(
+            "Связаться с отправителем", url=f"tg://user?id={sender_id}"
+        )
+    )
+    return kb
+
+
+# ============ ЗАМЕРЫ ============
+
+TICKETS = [
+    dict(
+        ticket_id=1000 + i,
+        store=str(i % 40 + 1),
+        sender_id=100000 + i,
+        equipment="Весы",
+        description="Не печатают этикетки",
+        priority="высокая" if i % 3 == 0 else "обычная",
+        status=("Создана", "Выполняется", "Выполнена")[i % 3],
+        sender_name="Продавец",
+        executor_name="" if i % 3 == 0 else "Техник",
+        executor_id=None if i % 3 == 0 else 200000 + i,
+    )
+    for i in range(100)
+]
+
+
+def bench(label: str, func, iterations: int) -> float:
+    started = time.perf_counter()
+    for i in range(iterations):
+        func(TICKETS[i % len(TICKETS)])
+    elapsed = time.perf_counter() - started
+    rate = iterations / elapsed
+    print(f"  {label:<10} {rate:>12,.0f} в сек")
+    return rate
+
+
+def compare(title: str, legacy, current, iterations: int):
+    print(title)
+    before = bench("до", legacy, iterations)
+    after = bench("после", current, iterations)
+    print(f"  ускорение  x{after / before:.1f}")
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    bot.load_config()
+
+    for t in TICKETS:
+        assert legacy_format_ticket_text(**t) == bot.format_ticket_text(**t)
+
+    compare(
+        "Текст заявки:",
+        lambda t: legacy_format_ticket_text(**t),
+        lambda t: bot.format_ticket_text(**t),
+        iterations,
+    )
+    compare(
+        "Клавиатура выбора оборудования:",
+        lambda t: legacy_equipment_keyboard(),
+        lambda t: bot.equipment_keyboard(),
+        iterations // 10,
+    )
+    compare(
+        "Клавиатура техника под заявкой:",
+        lambda t: legacy_tech_inline_keyboard(t["ticket_id"], t["sender_id"]),
+        lambda t: bot.tech_inline_keyboard(t["ticket_id"], t["sender_id"]),
+        iterations // 10,
+    )
+    bot.shutdown_db_executors()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,74 @@
 # bot.py
+import asyncio
+import copy
+import cProfile
+import functools
+import hmac
+import html
+import io
+import json
 import logging
 import os
+import pstats
+import secrets
+import signal
 import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types as types_module
+from collections import OrderedDict, deque
 from datetime import datetime
+from types import MappingProxyType
 from urllib.parse import quote_plus
-from typing import Optional, Set
+from typing import Dict, FrozenSet, Mapping, NamedTuple, Optional, Set, Tuple
 
+from aiohttp import web
 from aiogram import Bot, Dispatcher, types
-from aiogram.utils import executor
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.bot.api import TELEGRAM_PRODUCTION, TelegramAPIServer
+from aiogram.utils import exceptions
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.storage import BaseStorage
+
+from db import DB_POOL, DB_WRITER, run_db_read, run_db_write, shutdown_db_executors
+from lanes import LaneDispatcher
+from metrics import (
+    BACKGROUND_TASKS,
+    CACHE_ENTRIES,
+    CACHE_HITS,
+    CACHE_MISSES,
+    DB_COMMITS,
+    DB_WRITE_QUEUE,
+    FSM_STATES,
+    HANDLER_CALLS,
+    HANDLER_SECONDS,
+    LANES_PENDING,
+    LANES_RUNNING,
+    MEDIA_GROUPS_BUFFERED,
+    METRICS,
+    OUTBOUND_FAILED,
+    OUTBOUND_FLOOD_WAITS,
+    OUTBOUND_QUEUE,
+    OUTBOUND_SENT,
+    UPDATES_PROCESSED,
+    UPDATE_ERRORS,
+    UPDATE_PHASES,
+    detached_context,
+    observe_api_call,
+    timed_phase,
+)
+from outbound import (
+    OUTBOUND,
+    PRIORITY_BULK,
+    PRIORITY_HIGH,
+    PRIORITY_NORMAL,
+    in_outbound_worker,
+)
+from watchdog import LOOP_WATCHDOG
 
 # ============ НАСТРОЙКИ ============
 
@@ -25,40 +83,102 @@ ADMIN_USER_IDS = [
     int(x) for x in os.getenv("ADMIN_USER_IDS", "1403904334").split(",") if x.strip()
 ]
 
-DB_PATH = "tickets.db"
-
 # Файл с адресами: каждая строка "Номер | Адрес"
 # Пример:
 # 1 | Казань, ул. Космонавтов, 4
 # 2 | Казань, ул. Патриса Лумумбы, 32
-STORES_FILE_PATH = "stores.txt"
+STORES_FILE_PATH = os.getenv("STORES_FILE_PATH", "stores.txt")
 
 # Файл с техниками: по одному ID в строке, можно с комментом через "|"
 # Пример:
 # 111111111 | Илья (камеры)
 # 222222222 | Вася (весы)
-TECHS_FILE_PATH = "techs.txt"
+TECHS_FILE_PATH = os.getenv("TECHS_FILE_PATH", "techs.txt")
+
+# Как получать обновления: "polling" (long polling) или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+
+# Вебхук: полный публичный URL, на который Telegram шлёт обновления
+# (например https://bot.example.com/telegram/webhook), путь и адрес,
+# которые слушает встроенный aiohttp-сервер (обычно за nginx)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_LISTEN_HOST = os.getenv("WEBHOOK_LISTEN_HOST", "127.0.0.1")
+WEBHOOK_LISTEN_PORT = int(os.getenv("WEBHOOK_LISTEN_PORT", "8080"))
+# Секрет, который Telegram присылает в заголовке X-Telegram-Bot-Api-Secret-Token
+# (1–256 символов: A-Z, a-z, 0-9, _ и -)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+
+# Хэндлерам бота нужны только сообщения и нажатия inline-кнопок
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+# Адрес Bot API: можно указать локальный Bot API сервер или фейковый API для тестов
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
 
 logging.basicConfig(level=logging.INFO)
 
-bot = Bot(token=BOT_TOKEN, parse_mode="HTML")
-dp = Dispatcher(bot, storage=MemoryStorage())
 
-# Карта: номер магазина -> адрес
-STORE_ADDRESS_MAP: dict[str, str] = {}
+# ============ КОНФИГУРАЦИЯ: МАГАЗИНЫ И ТЕХНИКИ ============
+
+# Как часто проверять, не поменялись ли stores.txt / techs.txt, секунд
+CONFIG_POLL_SECONDS = float(os.getenv("CONFIG_POLL_SECONDS", "5"))
+
+_EMPTY_MAPPING: Mapping = MappingProxyType({})
+
 
-# Множество media_group_id, чтобы не дублировать ответы на альбомы
-RECENT_MEDIA_GROUPS: Set[str] = set()
+class ConfigSnapshot(NamedTuple):
+    """Неизменяемый снимок stores.txt и techs.txt.
+
+    Перезагрузка собирает новый снимок целиком и подменяет ссылку CONFIG
+    одним присваиванием, поэтому обработчики никогда не видят файл
+    прочитанным наполовину.
+    """
+
+    stores: Mapping[str, str]  # номер магазина -> адрес
+    store_lines: Mapping[str, str]  # номер магазина -> HTML адреса и ссылок на карты
+    techs: FrozenSet[int]
+    tech_comments: Mapping[int, str]  # ID техника -> комментарий после "|"
+    stores_sig: Optional[Tuple[int, int]]  # (mtime_ns, size) файла или None
+    techs_sig: Optional[Tuple[int, int]]
+
+
+CONFIG = ConfigSnapshot(
+    stores=_EMPTY_MAPPING,
+    store_lines=_EMPTY_MAPPING,
+    techs=frozenset(),
+    tech_comments=_EMPTY_MAPPING,
+    stores_sig=None,
+    techs_sig=None,
+)
+
+# Перезагрузка и запись techs.txt не должны пересекаться
+CONFIG_LOCK = asyncio.Lock()
+_config_watcher_task: Optional[asyncio.Task] = None
+
+
+def store_address_line(address: str) -> str:
+    """HTML-фрагмент с адресом магазина и ссылками на Яндекс, 2ГИС и Google."""
+    q = quote_plus(address)
+    return (
+        f"<b>Адрес:</b> {address}\n"
+        f"Открыть в: "
+        f'<a href="https://yandex.ru/maps/?text={q}">Яндекс</a> | '
+        f'<a href="https://2gis.ru/search/{q}">2ГИС</a> | '
+        f'<a href="https://maps.google.com/?q={q}">Google</a>\n'
+    )
 
-# Список ID техников (загружается из файла + управляется командами)
-TECH_USER_IDS: Set[int] = set()
 
+def file_signature(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
 
-# ============ ЗАГРУЗКА АДРЕСОВ МАГАЗИНОВ ============
 
-def load_store_addresses(path: str = STORES_FILE_PATH):
-    global STORE_ADDRESS_MAP
-    STORE_ADDRESS_MAP = {}
+def read_stores_file(path: str = STORES_FILE_PATH) -> dict:
+    """Номер магазина -> адрес из файла "Номер | Адрес"."""
+    stores = {}
     try:
         with open(path, "r", encoding="utf-8") as f:
             for line in f:
@@ -72,21 +192,19 @@ def load_store_addresses(path: str = STORES_FILE_PATH):
                 address = address.strip()
                 if not number or not address:
                     continue
-                STORE_ADDRESS_MAP[number] = address
-        logging.info(f"Загружено магазинов из файла: {len(STORE_ADDRESS_MAP)}")
+                stores[number] = address
+        logging.info(f"Загружено магазинов из файла: {len(stores)}")
     except FileNotFoundError:
         logging.warning(
             f"Файл с магазинами '{path}' не найден. "
             "Проверка номеров магазинов и адреса в заявках работать не будут."
         )
+    return stores
 
 
-# ============ ЗАГРУЗКА / СОХРАНЕНИЕ СПИСКА ТЕХНИКОВ ============
-
-def load_tech_ids_from_file(path: str = TECHS_FILE_PATH):
-    """Читает TECH_USER_IDS из файла."""
-    global TECH_USER_IDS
-    TECH_USER_IDS = set()
+def read_techs_file(path: str = TECHS_FILE_PATH) -> dict:
+    """ID техника -> комментарий из файла "id | комментарий"."""
+    techs = {}
     try:
         with open(path, "r", encoding="utf-8") as f:
             for line in f:
@@ -95,40 +213,185 @@ def load_tech_ids_from_file(path: str = TECHS_FILE_PATH):
                     continue
                 # поддерживаем формат "id | комментарий"
                 if "|" in line:
-                    left, _ = line.split("|", 1)
+                    left, comment = line.split("|", 1)
                 else:
-                    left = line
+                    left, comment = line, ""
                 left = left.strip()
                 # игнорируем строки не с числом
                 if not left.isdigit():
                     continue
-                TECH_USER_IDS.add(int(left))
-        logging.info(f"Загружено техников из файла: {len(TECH_USER_IDS)}")
+                techs[int(left)] = comment.strip()
+        logging.info(f"Загружено техников из файла: {len(techs)}")
     except FileNotFoundError:
         logging.warning(
             f"Файл с техниками '{path}' не найден. "
             "Создастся автоматически при первом добавлении техника."
         )
+    return techs
 
 
-def save_tech_ids_to_file(path: str = TECHS_FILE_PATH):
-    """Сохраняет текущее множество TECH_USER_IDS в файл (по одному ID в строке)."""
+def write_techs_file(tech_comments: Mapping[int, str], path: str = TECHS_FILE_PATH):
+    """Пишет techs.txt через временный файл и os.replace.
+
+    Читатель видит либо старый файл, либо новый целиком. Возвращает
+    подпись записанного файла, чтобы наблюдатель не перечитывал его.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".techs-", suffix=".tmp", dir=directory)
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            for uid in sorted(TECH_USER_IDS):
-                f.write(f"{uid}\n")
-        logging.info(f"Список техников сохранён в '{path}'.")
-    except Exception as e:
-        logging.warning(f"Не удалось сохранить список техников в файл: {e}")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            for uid in sorted(tech_comments):
+                comment = tech_comments[uid]
+                f.write(f"{uid} | {comment}\n" if comment else f"{uid}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    logging.info(f"Список техников сохранён в '{path}'.")
+    return file_signature(path)
+
+
+def _with_stores(snapshot: ConfigSnapshot, stores: dict, sig) -> ConfigSnapshot:
+    return snapshot._replace(
+        stores=MappingProxyType(stores),
+        store_lines=MappingProxyType(
+            {number: store_address_line(address) for number, address in stores.items()}
+        ),
+        stores_sig=sig,
+    )
+
+
+def _with_techs(snapshot: ConfigSnapshot, techs: dict, sig) -> ConfigSnapshot:
+    return snapshot._replace(
+        techs=frozenset(techs),
+        tech_comments=MappingProxyType(techs),
+        techs_sig=sig,
+    )
+
+
+def read_config(current: ConfigSnapshot, force: bool = False) -> ConfigSnapshot:
+    """Новый снимок с перечитанными файлами, чей mtime/размер изменился.
+
+    Блокирующая функция: из обработчиков вызывается через reload_config.
+    Если ничего не поменялось, возвращает тот же объект current.
+    """
+    snapshot = current
+    # Подпись снимаем до чтения: если файл поменяют во время чтения,
+    # на следующей проверке подпись не совпадёт и файл перечитается.
+    sig = file_signature(STORES_FILE_PATH)
+    if force or sig != current.stores_sig:
+        snapshot = _with_stores(snapshot, read_stores_file(STORES_FILE_PATH), sig)
+    sig = file_signature(TECHS_FILE_PATH)
+    if force or sig != current.techs_sig:
+        snapshot = _with_techs(snapshot, read_techs_file(TECHS_FILE_PATH), sig)
+    return snapshot
+
+
+def load_config():
+    """Первичная загрузка при старте, до запуска event loop."""
+    global CONFIG
+    CONFIG = read_config(CONFIG, force=True)
+
+
+async def reload_config(force: bool = False) -> bool:
+    """Перечитывает изменившиеся файлы в потоке и подменяет CONFIG."""
+    global CONFIG
+    async with CONFIG_LOCK:
+        loop = asyncio.get_running_loop()
+        snapshot = await loop.run_in_executor(None, read_config, CONFIG, force)
+        changed = snapshot is not CONFIG
+        CONFIG = snapshot
+    return changed
+
+
+async def _update_techs(change) -> ConfigSnapshot:
+    """Применяет change(dict) к списку техников и сохраняет его в файл."""
+    global CONFIG
+    async with CONFIG_LOCK:
+        loop = asyncio.get_running_loop()
+        # Сначала подхватываем ручные правки файла, чтобы не затереть их
+        current = await loop.run_in_executor(None, read_config, CONFIG)
+        techs = dict(current.tech_comments)
+        change(techs)
+        try:
+            sig = await loop.run_in_executor(
+                None, write_techs_file, techs, TECHS_FILE_PATH
+            )
+        except Exception as e:
+            logging.warning(f"Не удалось сохранить список техников в файл: {e}")
+            sig = current.techs_sig
+        CONFIG = _with_techs(current, techs, sig)
+        return CONFIG
+
+
+async def add_tech(user_id: int, comment: str = "") -> ConfigSnapshot:
+    def change(techs: dict):
+        techs[user_id] = comment or techs.get(user_id, "")
+
+    return await _update_techs(change)
+
+
+async def remove_tech(user_id: int) -> ConfigSnapshot:
+    return await _update_techs(lambda techs: techs.pop(user_id, None))
+
+
+async def config_watcher():
+    while True:
+        await asyncio.sleep(CONFIG_POLL_SECONDS)
+        try:
+            await reload_config()
+        except Exception as e:
+            logging.warning(f"Не удалось перечитать конфигурацию: {e}")
+
+
+def start_config_watcher():
+    global _config_watcher_task
+    if _config_watcher_task is None:
+        _config_watcher_task = asyncio.create_task(config_watcher())
+
+
+async def stop_config_watcher():
+    global _config_watcher_task
+    if _config_watcher_task is not None:
+        _config_watcher_task.cancel()
+        try:
+            await _config_watcher_task
+        except asyncio.CancelledError:
+            pass
+        _config_watcher_task = None
+
+
+# ============ МЕТРИКИ ============
+
+# Порт HTTP-эндпоинта /metrics (формат Prometheus); 0 — не поднимать
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# По умолчанию только локально: метрики снимает агент на той же машине
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
 
 
 # ============ БАЗА ДАННЫХ SQLITE ============
 
+# ---- Миграции схемы ----
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция выполняется
+# в своей транзакции и должна спокойно отрабатывать на старых базах,
+# где часть таблиц/колонок уже создана вручную.
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+def _table_columns(cur: sqlite3.Cursor, table: str) -> Set[str]:
+    cur.execute(f"PRAGMA table_info({table});")
+    return {row[1] for row in cur.fetchall()}
+
+
+def _add_column_if_missing(cur: sqlite3.Cursor, table: str, column: str, decl: str):
+    if column not in _table_columns(cur, table):
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl};")
 
+
+def _migration_base_tables(cur: sqlite3.Cursor):
     # Таблица заявок
     cur.execute(
         """
@@ -170,23 +433,283 @@ def init_db():
         );
         """
     )
+    # В самых старых базах senders создавалась без магазина и даты
+    _add_column_if_missing(cur, "senders", "store", "TEXT")
+    _add_column_if_missing(cur, "senders", "created_at", "TEXT")
 
-    conn.commit()
-    conn.close()
 
+def _migration_epoch_timestamps(cur: sqlite3.Cursor):
+    """Целочисленные метки времени (unix epoch) рядом с текстовыми датами."""
+    _add_column_if_missing(cur, "tickets", "created_ts", "INTEGER")
+    _add_column_if_missing(cur, "senders", "created_at_ts", "INTEGER")
+
+    # Текстовые даты записаны в локальном времени сервера
+    cur.execute(
+        """
+        UPDATE tickets
+        SET created_ts = CAST(strftime('%s', created, 'utc') AS INTEGER)
+        WHERE created_ts IS NULL AND created IS NOT NULL AND created != '';
+        """
+    )
+    cur.execute(
+        """
+        UPDATE senders
+        SET created_at_ts = CAST(strftime('%s', created_at, 'utc') AS INTEGER)
+        WHERE created_at_ts IS NULL AND created_at IS NOT NULL AND created_at != '';
+        """
+    )
+
+
+def _migration_indexes(cur: sqlite3.Cursor):
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tickets_status ON tickets(status);")
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_tickets_sender ON tickets(sender_id, created_ts);"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_tickets_executor ON tickets(executor_id, status);"
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tickets_created_ts ON tickets(created_ts);")
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_senders_created_at_ts ON senders(created_at_ts);"
+    )
+
+
+# ---- Счётчики для /admin ----
+# Поддерживаются триггерами в той же транзакции, что и сама запись, поэтому
+# /admin читает несколько строк вместо COUNT(*) и GROUP BY по всей истории.
+
+def _counter_upsert(name_expr: str, delta: int) -> str:
+    return (
+        f"INSERT INTO stats_counters (name, value) VALUES ({name_expr}, {delta}) "
+        f"ON CONFLICT(name) DO UPDATE SET value = value + ({delta});"
+    )
+
+
+def rebuild_stats_counters(cur: sqlite3.Cursor):
+    """Пересчитывает stats_counters с нуля по текущим таблицам."""
+    cur.execute("DELETE FROM stats_counters;")
+    cur.execute(
+        "INSERT INTO stats_counters (name, value) SELECT 'tickets_total', COUNT(*) FROM tickets;"
+    )
+    cur.execute(
+        """
+        INSERT INTO stats_counters (name, value)
+        SELECT 'status:' || COALESCE(status, ''), COUNT(*) FROM tickets GROUP BY status;
+        """
+    )
+    cur.execute(
+        "INSERT INTO stats_counters (name, value) SELECT 'senders', COUNT(*) FROM senders;"
+    )
+    cur.execute(
+        "INSERT INTO stats_counters (name, value) SELECT 'technicians', COUNT(*) FROM technicians;"
+    )
+
+
+def _migration_stats_counters(cur: sqlite3.Cursor):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name  TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        );
+        """
+    )
+    status_new = "'status:' || COALESCE(NEW.status, '')"
+    status_old = "'status:' || COALESCE(OLD.status, '')"
+    triggers = {
+        "trg_tickets_stats_insert": (
+            "AFTER INSERT ON tickets",
+            _counter_upsert("'tickets_total'", 1) + _counter_upsert(status_new, 1),
+        ),
+        "trg_tickets_stats_status": (
+            "AFTER UPDATE OF status ON tickets WHEN OLD.status IS NOT NEW.status",
+            _counter_upsert(status_old, -1) + _counter_upsert(status_new, 1),
+        ),
+        "trg_tickets_stats_delete": (
+            "AFTER DELETE ON tickets",
+            _counter_upsert("'tickets_total'", -1) + _counter_upsert(status_old, -1),
+        ),
+        "trg_senders_stats_insert": (
+            "AFTER INSERT ON senders",
+            _counter_upsert("'senders'", 1),
+        ),
+        "trg_senders_stats_delete": (
+            "AFTER DELETE ON senders",
+            _counter_upsert("'senders'", -1),
+        ),
+        "trg_technicians_stats_insert": (
+            "AFTER INSERT ON technicians",
+            _counter_upsert("'technicians'", 1),
+        ),
+        "trg_technicians_stats_delete": (
+            "AFTER DELETE ON technicians",
+            _counter_upsert("'technicians'", -1),
+        ),
+    }
+    for name, (event, body) in triggers.items():
+        cur.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END;")
+    rebuild_stats_counters(cur)
+
+
+def _migration_outbox(cur: sqlite3.Cursor):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id              INTEGER PRIMARY KEY AUTOINCREMENT,
+            ticket_id       INTEGER NOT NULL,
+            kind            TEXT NOT NULL,
+            chat_id         INTEGER NOT NULL,
+            photo_id        TEXT,
+            status          TEXT NOT NULL DEFAULT 'pending',
+            attempts        INTEGER NOT NULL DEFAULT 0,
+            next_attempt_ts REAL NOT NULL,
+            last_error      TEXT,
+            created_ts      INTEGER NOT NULL
+        );
+        """
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt_ts);"
+    )
+
+
+def _migration_broadcasts(cur: sqlite3.Cursor):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id              INTEGER PRIMARY KEY AUTOINCREMENT,
+            text            TEXT NOT NULL,
+            status          TEXT NOT NULL,
+            admin_chat_id   INTEGER NOT NULL,
+            progress_msg_id INTEGER,
+            last_user_id    INTEGER NOT NULL DEFAULT 0,
+            total           INTEGER NOT NULL DEFAULT 0,
+            sent            INTEGER NOT NULL DEFAULT 0,
+            failed          INTEGER NOT NULL DEFAULT 0,
+            created_ts      INTEGER NOT NULL,
+            updated_ts      INTEGER NOT NULL
+        );
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status);")
+
+
+def _migration_ticket_messages(cur: sqlite3.Cursor):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ticket_messages (
+            ticket_id  INTEGER NOT NULL,
+            chat_id    INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            kind       TEXT NOT NULL,
+            PRIMARY KEY (ticket_id, chat_id)
+        );
+        """
+    )
+
+
+def _migration_admin_msg_kind(cur: sqlite3.Cursor):
+    # "photo" или "text": чтобы сразу вызывать нужный edit_message_*
+    _add_column_if_missing(cur, "tickets", "admin_msg_kind", "TEXT")
 
-def get_next_ticket_id() -> int:
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT MAX(ticket_id) FROM tickets;")
-    row = cur.fetchone()
-    conn.close()
-    if row and row[0]:
-        return row[0] + 1
-    return 1001
+
+def _migration_fsm_states(cur: sqlite3.Cursor):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            chat_id    INTEGER NOT NULL,
+            user_id    INTEGER NOT NULL,
+            state      TEXT,
+            data       TEXT NOT NULL DEFAULT '{}',
+            bucket     TEXT NOT NULL DEFAULT '{}',
+            updated_ts INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, user_id)
+        );
+        """
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states(updated_ts);"
+    )
+
+
+def _migration_outbox_album(cur: sqlite3.Cursor):
+    # JSON-список file_id, если к заявке приложен альбом из нескольких фото
+    _add_column_if_missing(cur, "outbox", "album", "TEXT")
+
+
+def _migration_outbox_album_sent(cur: sqlite3.Cursor):
+    # JSON-список message_id уже отправленного альбома: повтор после сбоя
+    # отправляет только карточку заявки
+    _add_column_if_missing(cur, "outbox", "album_message_ids", "TEXT")
+
+
+def _migration_bot_state(cur: sqlite3.Cursor):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS bot_state (
+            key        TEXT PRIMARY KEY,
+            value      INTEGER NOT NULL,
+            updated_ts INTEGER NOT NULL
+        );
+        """
+    )
+
+
+# (версия, описание, функция) — только добавлять в конец, не менять старые
+SCHEMA_MIGRATIONS = [
+    (1, "базовые таблицы", _migration_base_tables),
+    (2, "целочисленные метки времени", _migration_epoch_timestamps),
+    (3, "индексы по статусу, отправителю, исполнителю и дате", _migration_indexes),
+    (4, "счётчики для админ-панели", _migration_stats_counters),
+    (5, "очередь уведомлений (outbox)", _migration_outbox),
+    (6, "фоновые рассылки", _migration_broadcasts),
+    (7, "копии заявок у техников", _migration_ticket_messages),
+    (8, "тип сообщения заявки в чате руководства", _migration_admin_msg_kind),
+    (9, "состояния FSM (черновики заявок и профилей)", _migration_fsm_states),
+    (10, "альбомы фото в уведомлениях", _migration_outbox_album),
+    (11, "служебные значения бота (последний update_id)", _migration_bot_state),
+    (12, "отметка об отправленном альбоме в outbox", _migration_outbox_album_sent),
+]
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version;").fetchone()[0]
+
+
+def run_migrations(conn: sqlite3.Connection) -> int:
+    """Доводит схему до последней версии, возвращает итоговую версию."""
+    version = get_schema_version(conn)
+    for target, title, migrate in SCHEMA_MIGRATIONS:
+        if target <= version:
+            continue
+        started = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE;")
+        try:
+            migrate(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {int(target)};")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logging.exception(f"Миграция схемы до версии {target} ({title}) не удалась")
+            raise
+        version = target
+        logging.info(
+            f"Схема БД обновлена до версии {target} ({title}) "
+            f"за {(time.perf_counter() - started) * 1000:.0f} мс"
+        )
+    return version
+
+
+def init_db():
+    with DB_POOL.connection() as conn:
+        run_migrations(conn)
 
 
+# Хелперы записи принимают курсор и не коммитят сами: их выполняет
+# DB_WRITER пачками в одной транзакции (см. db.py).
+
 def create_ticket_row(
+    cur: sqlite3.Cursor,
     ticket_id: int,
     store: str,
     sender_id: int,
@@ -197,21 +720,21 @@ def create_ticket_row(
     status: str,
     admin_msg_id: int = 0,
 ):
-    created = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+    now = datetime.now()
+    created = now.strftime("%Y-%m-%d %H:%M:%S")
     cur.execute(
         """
         INSERT INTO tickets (
-            ticket_id, created, store, sender_id, sender_name,
+            ticket_id, created, created_ts, store, sender_id, sender_name,
             equipment, description, priority, status,
             executor_id, executor_name, admin_msg_id
         )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
         """,
         (
             ticket_id,
             created,
+            int(now.timestamp()),
             store,
             sender_id,
             sender_name,
@@ -224,48 +747,64 @@ def create_ticket_row(
             admin_msg_id,
         ),
     )
-    conn.commit()
-    conn.close()
+    return {
+        "ticket_id": ticket_id,
+        "created": created,
+        "store": store,
+        "sender_id": sender_id,
+        "sender_name": sender_name,
+        "equipment": equipment,
+        "description": description,
+        "priority": priority,
+        "status": status,
+        "executor_id": None,
+        "executor_name": "",
+        "admin_msg_id": admin_msg_id,
+        "admin_msg_kind": None,
+    }
 
 
-def get_ticket_data(ticket_id: int) -> Optional[dict]:
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+TICKET_COLUMNS = (
+    "ticket_id",
+    "created",
+    "store",
+    "sender_id",
+    "sender_name",
+    "equipment",
+    "description",
+    "priority",
+    "status",
+    "executor_id",
+    "executor_name",
+    "admin_msg_id",
+    "admin_msg_kind",
+)
+_TICKET_SELECT = ", ".join(TICKET_COLUMNS)
+
+
+def _ticket_from_row(row) -> dict:
+    return dict(zip(TICKET_COLUMNS, row))
+
+
+def _select_ticket(cur: sqlite3.Cursor, ticket_id: int) -> Optional[dict]:
     cur.execute(
-        """
-        SELECT ticket_id, created, store, sender_id, sender_name,
-               equipment, description, priority, status,
-               executor_id, executor_name, admin_msg_id
-        FROM tickets
-        WHERE ticket_id = ?;
-        """,
+        f"SELECT {_TICKET_SELECT} FROM tickets WHERE ticket_id = ?;",
         (ticket_id,),
     )
     row = cur.fetchone()
-    conn.close()
     if not row:
         return None
-    return {
-        "ticket_id": row[0],
-        "created": row[1],
-        "store": row[2],
-        "sender_id": row[3],
-        "sender_name": row[4],
-        "equipment": row[5],
-        "description": row[6],
-        "priority": row[7],
-        "status": row[8],
-        "executor_id": row[9],
-        "executor_name": row[10],
-        "admin_msg_id": row[11],
-    }
+    return _ticket_from_row(row)
 
 
-def update_ticket(ticket_id: int, **fields):
+def get_ticket_data(ticket_id: int) -> Optional[dict]:
+    with DB_POOL.connection() as conn:
+        return _select_ticket(conn.cursor(), ticket_id)
+
+
+def update_ticket(cur: sqlite3.Cursor, ticket_id: int, **fields):
     if not fields:
         return
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
 
     columns = []
     values = []
@@ -276,123 +815,379 @@ def update_ticket(ticket_id: int, **fields):
 
     sql = f"UPDATE tickets SET {', '.join(columns)} WHERE ticket_id = ?;"
     cur.execute(sql, values)
-    conn.commit()
-    conn.close()
 
 
-# ---- Техники ----
+# ---- Смена статуса заявки ----
+# Переход делается одним условным UPDATE ... WHERE status = ...: кто первым
+# выполнил UPDATE, тот и выиграл, второй получает 0 изменённых строк и
+# текущее состояние заявки. Повторные/одновременные нажатия не требуют
+# отдельного чтения и блокировок.
 
-def set_technician_name(user_id: int, display_name: str):
-    """Сохраняем/обновляем отображаемое имя техника."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+STATUS_CREATED = "Создана"
+STATUS_IN_PROGRESS = "Выполняется"
+STATUS_DONE = "Выполнена"
+STATUS_CANCELLED = "Аннулирована пользователем"
+
+
+def _transition_ticket(
+    cur: sqlite3.Cursor,
+    ticket_id: int,
+    fields: dict,
+    condition: str,
+    condition_params: tuple = (),
+) -> Tuple[bool, Optional[dict]]:
+    """
+    Меняет поля заявки, только если выполняется condition.
+    Возвращает (выиграл ли переход, заявка после попытки).
+    """
+    assignments = ", ".join(f"{key} = ?" for key in fields)
     cur.execute(
-        """
-        INSERT INTO technicians (user_id, display_name)
-        VALUES (?, ?)
-        ON CONFLICT(user_id) DO UPDATE SET display_name = excluded.display_name;
+        f"""
+        UPDATE tickets SET {assignments}
+        WHERE ticket_id = ? AND ({condition})
+        RETURNING {_TICKET_SELECT};
         """,
-        (user_id, display_name),
+        (*fields.values(), ticket_id, *condition_params),
     )
-    conn.commit()
-    conn.close()
+    row = cur.fetchone()
+    if row:
+        return True, _ticket_from_row(row)
+    return False, _select_ticket(cur, ticket_id)
 
 
-def get_technician_name(user: types.User) -> str:
-    """Возвращаем имя техника из БД, если есть, иначе имя из Telegram."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT display_name FROM technicians WHERE user_id = ?;",
-        (user.id,),
+def take_ticket(
+    cur: sqlite3.Cursor, ticket_id: int, executor_id: int, executor_name: str
+) -> Tuple[bool, Optional[dict]]:
+    """Создана -> Выполняется (назначаем исполнителя)."""
+    return _transition_ticket(
+        cur,
+        ticket_id,
+        {
+            "status": STATUS_IN_PROGRESS,
+            "executor_id": executor_id,
+            "executor_name": executor_name,
+        },
+        "status = ?",
+        (STATUS_CREATED,),
     )
-    row = cur.fetchone()
-    conn.close()
 
-    if row and row[0]:
-        return row[0]
 
-    return (user.full_name or "").strip() or user.username or "Исполнитель"
+def complete_ticket(
+    cur: sqlite3.Cursor, ticket_id: int, executor_id: int, executor_name: str
+) -> Tuple[bool, Optional[dict]]:
+    """Выполняется -> Выполнена (только назначенным исполнителем)."""
+    return _transition_ticket(
+        cur,
+        ticket_id,
+        {
+            "status": STATUS_DONE,
+            "executor_id": executor_id,
+            "executor_name": executor_name,
+        },
+        "status = ? AND executor_id = ?",
+        (STATUS_IN_PROGRESS, executor_id),
+    )
 
 
-def get_all_technicians():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT user_id, display_name FROM technicians ORDER BY user_id ASC;"
+def cancel_ticket_by_sender(
+    cur: sqlite3.Cursor, ticket_id: int, sender_id: int
+) -> Tuple[bool, Optional[dict]]:
+    """Отмена отправителем, пока заявка не выполнена и не отменена."""
+    return _transition_ticket(
+        cur,
+        ticket_id,
+        {"status": STATUS_CANCELLED},
+        "sender_id = ? AND status NOT IN (?, ?)",
+        (sender_id, STATUS_DONE, STATUS_CANCELLED),
     )
-    rows = cur.fetchall()
-    conn.close()
-    result = []
-    for r in rows:
-        result.append({"user_id": r[0], "display_name": r[1] or ""})
-    return result
 
 
-# ---- Пользователи (отправители) ----
+# ---- Создание заявки и очередь уведомлений (outbox) ----
+# Заявка и все уведомления о ней записываются одной транзакцией, а
+# отправкой в Telegram занимается фоновый outbox_dispatcher(). Если бот
+# упадёт посреди рассылки, неотправленные уведомления останутся в outbox
+# и уйдут после перезапуска.
 
-def get_sender_profile(user_id: int) -> Optional[dict]:
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+OUTBOX_KIND_ADMIN = "admin"
+OUTBOX_KIND_TECH = "tech"
+
+
+def create_ticket(
+    cur: sqlite3.Cursor,
+    store: str,
+    sender_id: int,
+    sender_name: str,
+    equipment: str,
+    description: str,
+    priority: str,
+    photo_ids,
+    tech_ids,
+) -> dict:
+    """Новая заявка + уведомления в чат руководства и техникам.
+
+    photo_ids — file_id приложенных фото (пустой список, одно фото или альбом).
+    """
+    # Внутри транзакции записи номер не может достаться двум заявкам
+    cur.execute("SELECT COALESCE(MAX(ticket_id), 1000) + 1 FROM tickets;")
+    ticket_id = cur.fetchone()[0]
+    ticket = create_ticket_row(
+        cur,
+        ticket_id=ticket_id,
+        store=store,
+        sender_id=sender_id,
+        sender_name=sender_name,
+        equipment=equipment,
+        description=description,
+        priority=priority,
+        status=STATUS_CREATED,
+    )
+
+    now = time.time()
+    photo_id = photo_ids[0] if photo_ids else None
+    album = json.dumps(list(photo_ids)) if len(photo_ids) > 1 else None
+    recipients = [(OUTBOX_KIND_ADMIN, ADMIN_CHAT_ID)]
+    recipients += [(OUTBOX_KIND_TECH, tech_id) for tech_id in tech_ids]
+    cur.executemany(
+        """
+        INSERT INTO outbox
+            (ticket_id, kind, chat_id, photo_id, album, next_attempt_ts, created_ts)
+        VALUES (?, ?, ?, ?, ?, ?, ?);
+        """,
+        [
+            (ticket_id, kind, chat_id, photo_id, album, now, int(now))
+            for kind, chat_id in recipients
+        ],
+    )
+    return ticket
+
+
+def fetch_due_outbox(limit: int) -> list:
+    with DB_POOL.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id, ticket_id, kind, chat_id, photo_id, album, attempts, album_message_ids
+            FROM outbox
+            WHERE status = 'pending' AND next_attempt_ts <= ?
+            ORDER BY id
+            LIMIT ?;
+            """,
+            (time.time(), limit),
+        )
+        rows = cur.fetchall()
+    return [
+        {
+            "id": r[0],
+            "ticket_id": r[1],
+            "kind": r[2],
+            "chat_id": r[3],
+            "photo_id": r[4],
+            "album": json.loads(r[5]) if r[5] else [],
+            "attempts": r[6],
+            "album_message_ids": json.loads(r[7]) if r[7] else [],
+        }
+        for r in rows
+    ]
+
+
+def set_outbox_album_sent(cur: sqlite3.Cursor, outbox_id: int, message_ids: list):
     cur.execute(
-        "SELECT display_name, store, created_at FROM senders WHERE user_id = ?;",
-        (user_id,),
+        "UPDATE outbox SET album_message_ids = ? WHERE id = ?;",
+        (json.dumps(message_ids), outbox_id),
     )
-    row = cur.fetchone()
-    conn.close()
-    if not row:
-        return None
-    return {
-        "user_id": user_id,
-        "display_name": row[0],
-        "store": row[1],
-        "created_at": row[2],
-    }
 
 
-def set_sender_profile(user_id: int, display_name: str, store: str):
-    """Создаём/обновляем профиль отправителя (имя + магазин)."""
-    created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+def delete_outbox_item(cur: sqlite3.Cursor, outbox_id: int):
+    cur.execute("DELETE FROM outbox WHERE id = ?;", (outbox_id,))
+
+
+def reschedule_outbox_item(
+    cur: sqlite3.Cursor,
+    outbox_id: int,
+    attempts: int,
+    next_attempt_ts: float,
+    error: str,
+    give_up: bool,
+):
     cur.execute(
         """
-        INSERT INTO senders (user_id, display_name, store, created_at)
-        VALUES (?, ?, ?, ?)
-        ON CONFLICT(user_id) DO UPDATE SET
-            display_name = excluded.display_name,
-            store        = excluded.store;
+        UPDATE outbox
+        SET attempts = ?, next_attempt_ts = ?, last_error = ?, status = ?
+        WHERE id = ?;
         """,
-        (user_id, display_name, store, created_at),
+        (attempts, next_attempt_ts, error, "failed" if give_up else "pending", outbox_id),
     )
-    conn.commit()
-    conn.close()
 
 
-def set_sender_name(user_id: int, display_name: str):
-    """Обновляем только имя отправителя, магазин не трогаем."""
-    profile = get_sender_profile(user_id)
-    store = ""
-    if profile:
-        store = profile.get("store") or ""
-    set_sender_profile(user_id, display_name, store)
+def finish_admin_outbox_item(
+    cur: sqlite3.Cursor, outbox_id: int, ticket_id: int, message_id: int, kind: str
+):
+    """Записывает сообщение в чате руководства и снимает уведомление — атомарно."""
+    update_ticket(cur, ticket_id, admin_msg_id=message_id, admin_msg_kind=kind)
+    delete_outbox_item(cur, outbox_id)
 
 
-def get_all_senders(limit: Optional[int] = None):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    sql = """
-        SELECT user_id, display_name, store, created_at
+def finish_tech_outbox_item(
+    cur: sqlite3.Cursor,
+    outbox_id: int,
+    ticket_id: int,
+    chat_id: int,
+    message_id: int,
+    kind: str,
+):
+    """Записывает копию заявки у техника и снимает уведомление — атомарно."""
+    add_ticket_message(cur, ticket_id, chat_id, message_id, kind)
+    delete_outbox_item(cur, outbox_id)
+
+
+# ---- Копии заявки у техников ----
+# Каждый техник получает свою копию заявки; (ticket_id, chat_id) -> message_id
+# нужен, чтобы при смене статуса обновить кнопки во всех копиях.
+# kind: "photo" (редактируется подпись) или "text".
+
+MESSAGE_KIND_PHOTO = "photo"
+MESSAGE_KIND_TEXT = "text"
+
+
+def add_ticket_message(
+    cur: sqlite3.Cursor, ticket_id: int, chat_id: int, message_id: int, kind: str
+):
+    cur.execute(
+        """
+        INSERT INTO ticket_messages (ticket_id, chat_id, message_id, kind)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(ticket_id, chat_id) DO UPDATE SET
+            message_id = excluded.message_id,
+            kind       = excluded.kind;
+        """,
+        (ticket_id, chat_id, message_id, kind),
+    )
+
+
+def get_ticket_messages(ticket_id: int) -> list:
+    with DB_POOL.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT chat_id, message_id, kind FROM ticket_messages WHERE ticket_id = ?;",
+            (ticket_id,),
+        )
+        rows = cur.fetchall()
+    return [{"chat_id": r[0], "message_id": r[1], "kind": r[2]} for r in rows]
+
+
+# ---- Техники ----
+
+def set_technician_name(cur: sqlite3.Cursor, user_id: int, display_name: str):
+    """Сохраняем/обновляем отображаемое имя техника."""
+    cur.execute(
+        """
+        INSERT INTO technicians (user_id, display_name)
+        VALUES (?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET display_name = excluded.display_name;
+        """,
+        (user_id, display_name),
+    )
+
+
+def get_technician_display_name(user_id: int) -> Optional[str]:
+    """Имя техника из БД (None, если не задано)."""
+    with DB_POOL.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT display_name FROM technicians WHERE user_id = ?;",
+            (user_id,),
+        )
+        row = cur.fetchone()
+    if row and row[0]:
+        return row[0]
+    return None
+
+
+def telegram_display_name(user: types.User) -> str:
+    return (user.full_name or "").strip() or user.username or "Исполнитель"
+
+
+def get_technician_name(user: types.User) -> str:
+    """Возвращаем имя техника из БД, если есть, иначе имя из Telegram."""
+    return get_technician_display_name(user.id) or telegram_display_name(user)
+
+
+def get_all_technicians():
+    with DB_POOL.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT user_id, display_name FROM technicians ORDER BY user_id ASC;"
+        )
+        rows = cur.fetchall()
+    result = []
+    for r in rows:
+        result.append({"user_id": r[0], "display_name": r[1] or ""})
+    return result
+
+
+# ---- Пользователи (отправители) ----
+
+def _select_sender_profile(cur: sqlite3.Cursor, user_id: int) -> Optional[dict]:
+    cur.execute(
+        "SELECT display_name, store, created_at FROM senders WHERE user_id = ?;",
+        (user_id,),
+    )
+    row = cur.fetchone()
+    if not row:
+        return None
+    return {
+        "user_id": user_id,
+        "display_name": row[0],
+        "store": row[1],
+        "created_at": row[2],
+    }
+
+
+def get_sender_profile(user_id: int) -> Optional[dict]:
+    with DB_POOL.connection() as conn:
+        return _select_sender_profile(conn.cursor(), user_id)
+
+
+def set_sender_profile(cur: sqlite3.Cursor, user_id: int, display_name: str, store: str) -> dict:
+    """Создаём/обновляем профиль отправителя (имя + магазин), возвращаем профиль."""
+    now = datetime.now()
+    created_at = now.strftime("%Y-%m-%d %H:%M:%S")
+    cur.execute(
+        """
+        INSERT INTO senders (user_id, display_name, store, created_at, created_at_ts)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            display_name = excluded.display_name,
+            store        = excluded.store;
+        """,
+        (user_id, display_name, store, created_at, int(now.timestamp())),
+    )
+    return _select_sender_profile(cur, user_id)
+
+
+def set_sender_name(cur: sqlite3.Cursor, user_id: int, display_name: str) -> dict:
+    """Обновляем только имя отправителя, магазин не трогаем."""
+    profile = _select_sender_profile(cur, user_id)
+    store = ""
+    if profile:
+        store = profile.get("store") or ""
+    return set_sender_profile(cur, user_id, display_name, store)
+
+
+def get_all_senders(limit: Optional[int] = None):
+    sql = """
+        SELECT user_id, display_name, store, created_at
         FROM senders
-        ORDER BY COALESCE(created_at, '') DESC
+        ORDER BY created_at_ts DESC
     """
     params = ()
     if limit:
         sql += " LIMIT ?"
         params = (limit,)
-    cur.execute(sql, params)
-    rows = cur.fetchall()
-    conn.close()
+    with DB_POOL.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        rows = cur.fetchall()
     result = []
     for r in rows:
         result.append(
@@ -406,192 +1201,1850 @@ def get_all_senders(limit: Optional[int] = None):
     return result
 
 
-def delete_sender(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("DELETE FROM senders WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+def delete_sender(cur: sqlite3.Cursor, user_id: int):
+    cur.execute("DELETE FROM senders WHERE user_id = ?", (user_id,))
+
+
+# ---- Рассылки ----
+# Рассылка — задание в таблице broadcasts. Получатели читаются пачками по
+# возрастанию user_id, после каждой пачки сохраняется last_user_id, так что
+# после перезапуска рассылка продолжается с места остановки.
+
+BROADCAST_RUNNING = "running"
+BROADCAST_PAUSED = "paused"
+BROADCAST_CANCELLED = "cancelled"
+BROADCAST_DONE = "done"
+
+BROADCAST_COLUMNS = (
+    "id",
+    "text",
+    "status",
+    "admin_chat_id",
+    "progress_msg_id",
+    "last_user_id",
+    "total",
+    "sent",
+    "failed",
+    "created_ts",
+    "updated_ts",
+)
+_BROADCAST_SELECT = ", ".join(BROADCAST_COLUMNS)
+
+
+def _select_broadcast(cur: sqlite3.Cursor, broadcast_id: int) -> Optional[dict]:
+    cur.execute(
+        f"SELECT {_BROADCAST_SELECT} FROM broadcasts WHERE id = ?;",
+        (broadcast_id,),
+    )
+    row = cur.fetchone()
+    if not row:
+        return None
+    return dict(zip(BROADCAST_COLUMNS, row))
+
+
+def create_broadcast(cur: sqlite3.Cursor, text: str, admin_chat_id: int) -> dict:
+    now = int(time.time())
+    cur.execute("SELECT COUNT(*) FROM senders;")
+    total = cur.fetchone()[0]
+    cur.execute(
+        """
+        INSERT INTO broadcasts (text, status, admin_chat_id, total, created_ts, updated_ts)
+        VALUES (?, ?, ?, ?, ?, ?);
+        """,
+        (text, BROADCAST_RUNNING, admin_chat_id, total, now, now),
+    )
+    return _select_broadcast(cur, cur.lastrowid)
+
+
+def get_broadcast(broadcast_id: int) -> Optional[dict]:
+    with DB_POOL.connection() as conn:
+        return _select_broadcast(conn.cursor(), broadcast_id)
+
+
+def get_broadcasts_by_status(statuses) -> list:
+    placeholders = ", ".join("?" for _ in statuses)
+    with DB_POOL.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            f"SELECT {_BROADCAST_SELECT} FROM broadcasts "
+            f"WHERE status IN ({placeholders}) ORDER BY id;",
+            tuple(statuses),
+        )
+        rows = cur.fetchall()
+    return [dict(zip(BROADCAST_COLUMNS, r)) for r in rows]
+
+
+def get_broadcast_recipients(after_user_id: int, limit: int) -> list:
+    """Следующая пачка получателей после last_user_id (по первичному ключу)."""
+    with DB_POOL.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT user_id FROM senders WHERE user_id > ? ORDER BY user_id LIMIT ?;",
+            (after_user_id, limit),
+        )
+        return [r[0] for r in cur.fetchall()]
+
+
+def save_broadcast_checkpoint(
+    cur: sqlite3.Cursor, broadcast_id: int, last_user_id: int, sent: int, failed: int
+):
+    cur.execute(
+        """
+        UPDATE broadcasts
+        SET last_user_id = ?, sent = sent + ?, failed = failed + ?, updated_ts = ?
+        WHERE id = ?;
+        """,
+        (last_user_id, sent, failed, int(time.time()), broadcast_id),
+    )
+
+
+def set_broadcast_status(
+    cur: sqlite3.Cursor, broadcast_id: int, status: str, from_statuses
+) -> Tuple[bool, Optional[dict]]:
+    """Меняет статус, только если текущий входит в from_statuses."""
+    placeholders = ", ".join("?" for _ in from_statuses)
+    cur.execute(
+        f"""
+        UPDATE broadcasts SET status = ?, updated_ts = ?
+        WHERE id = ? AND status IN ({placeholders});
+        """,
+        (status, int(time.time()), broadcast_id, *from_statuses),
+    )
+    return cur.rowcount > 0, _select_broadcast(cur, broadcast_id)
+
+
+def set_broadcast_progress_msg(cur: sqlite3.Cursor, broadcast_id: int, message_id: int):
+    cur.execute(
+        "UPDATE broadcasts SET progress_msg_id = ? WHERE id = ?;",
+        (message_id, broadcast_id),
+    )
+
+
+# ---- Состояния FSM ----
+
+def load_fsm_record(chat_id: int, user_id: int) -> Optional[dict]:
+    """Состояние, данные и bucket пользователя или None."""
+    with DB_POOL.connection() as conn:
+        row = conn.execute(
+            """
+            SELECT state, data, bucket, updated_ts FROM fsm_states
+            WHERE chat_id = ? AND user_id = ?;
+            """,
+            (chat_id, user_id),
+        ).fetchone()
+    if row is None:
+        return None
+    return {
+        "state": row[0],
+        "data": json.loads(row[1]),
+        "bucket": json.loads(row[2]),
+        "ts": row[3],
+    }
+
+
+def save_fsm_record(cur: sqlite3.Cursor, chat_id: int, user_id: int, record: dict):
+    """Сохраняет запись; пустая запись (нет состояния и данных) удаляется."""
+    if record["state"] is None and not record["data"] and not record["bucket"]:
+        cur.execute(
+            "DELETE FROM fsm_states WHERE chat_id = ? AND user_id = ?;",
+            (chat_id, user_id),
+        )
+        return
+    cur.execute(
+        """
+        INSERT INTO fsm_states (chat_id, user_id, state, data, bucket, updated_ts)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(chat_id, user_id) DO UPDATE SET
+            state = excluded.state,
+            data = excluded.data,
+            bucket = excluded.bucket,
+            updated_ts = excluded.updated_ts;
+        """,
+        (
+            chat_id,
+            user_id,
+            record["state"],
+            json.dumps(record["data"], ensure_ascii=False),
+            json.dumps(record["bucket"], ensure_ascii=False),
+            record["ts"],
+        ),
+    )
+
+
+def delete_expired_fsm_records(cur: sqlite3.Cursor, before_ts: int) -> int:
+    cur.execute("DELETE FROM fsm_states WHERE updated_ts < ?;", (before_ts,))
+    return cur.rowcount
+
+
+def count_fsm_states(since_ts: int) -> dict:
+    """Число незаконченных сценариев по состояниям (без протухших)."""
+    with DB_POOL.connection() as conn:
+        rows = conn.execute(
+            """
+            SELECT state, COUNT(*) FROM fsm_states
+            WHERE state IS NOT NULL AND updated_ts >= ?
+            GROUP BY state;
+            """,
+            (since_ts,),
+        ).fetchall()
+    return dict(rows)
+
+
+# ---- Служебные значения бота ----
+
+def get_bot_state(key: str) -> Optional[Tuple[int, int]]:
+    """(значение, время записи) или None."""
+    with DB_POOL.connection() as conn:
+        row = conn.execute(
+            "SELECT value, updated_ts FROM bot_state WHERE key = ?;", (key,)
+        ).fetchone()
+    return (row[0], row[1]) if row else None
+
+
+def set_bot_state(cur: sqlite3.Cursor, key: str, value: int):
+    cur.execute(
+        """
+        INSERT INTO bot_state (key, value, updated_ts) VALUES (?, ?, ?)
+        ON CONFLICT(key) DO UPDATE SET
+            value = excluded.value,
+            updated_ts = excluded.updated_ts;
+        """,
+        (key, value, int(time.time())),
+    )
+
+
+# ---- Админ-панель ----
+
+def get_admin_stats() -> dict:
+    """Счётчики для /admin: пользователи, техники, заявки по статусам."""
+    with DB_POOL.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT name, value FROM stats_counters;")
+        counters = dict(cur.fetchall())
+
+    status_counts = {
+        "Создана": 0,
+        "Выполняется": 0,
+        "Выполнена": 0,
+        "Аннулирована пользователем": 0,
+    }
+    for status in status_counts:
+        status_counts[status] = counters.get(f"status:{status}", 0)
+
+    return {
+        "users_count": counters.get("senders", 0),
+        "tech_count": counters.get("technicians", 0),
+        "tickets_total": counters.get("tickets_total", 0),
+        "status_counts": status_counts,
+    }
+
+
+def wipe_all_tables(cur: sqlite3.Cursor):
+    cur.execute("DELETE FROM tickets;")
+    cur.execute("DELETE FROM senders;")
+    cur.execute("DELETE FROM technicians;")
+    cur.execute("DELETE FROM outbox;")
+    cur.execute("DELETE FROM ticket_messages;")
+    cur.execute("DELETE FROM fsm_states;")
+    # Чекпоинт рассылки указывает на отправителей, которых больше нет.
+    # Идущая рассылка, не найдя свою запись, остановится на следующей пачке
+    cur.execute("DELETE FROM broadcasts;")
+
+
+# ---- Асинхронные обёртки хелперов ----
+# Чтение — через run_db_read(), запись — через run_db_write() (см. db.py)
+
+def _db_reader(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_db_read(func, *args, **kwargs)
+
+    wrapper.__name__ = f"{func.__name__}_async"
+    return wrapper
+
+
+def _db_writer(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_db_write(func, *args, **kwargs)
+
+    wrapper.__name__ = f"{func.__name__}_async"
+    return wrapper
+
+
+get_all_technicians_async = _db_reader(get_all_technicians)
+get_all_senders_async = _db_reader(get_all_senders)
+get_admin_stats_async = _db_reader(get_admin_stats)
+
+rebuild_stats_counters_async = _db_writer(rebuild_stats_counters)
+
+
+# ---- Кэш заявок ----
+
+TICKET_CACHE_SIZE = int(os.getenv("TICKET_CACHE_SIZE", "2000"))
+
+_CACHE_MISS = object()
+
+
+class LRUCache:
+    """
+    Ограниченный по размеру LRU-кэш со статистикой попаданий.
+
+    Чтобы медленное чтение из БД не положило в кэш устаревшие данные поверх
+    более свежей записи, загрузка идёт через begin_load()/put_loaded():
+    результат сохраняется, только если с начала чтения не было записей.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict" = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._data.get(key, _CACHE_MISS)
+            if value is _CACHE_MISS:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def _store(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def put(self, key, value):
+        with self._lock:
+            self._writes += 1
+            self._store(key, value)
+
+    def begin_load(self) -> int:
+        with self._lock:
+            return self._writes
+
+    def put_loaded(self, key, value, token: int):
+        with self._lock:
+            if self._writes == token and key not in self._data:
+                self._store(key, value)
+
+    def update(self, key, **fields):
+        """Обновляет поля закэшированного словаря (если запись есть в кэше)."""
+        with self._lock:
+            self._writes += 1
+            value = self._data.get(key)
+            if value is not None:
+                self._data[key] = {**value, **fields}
+
+    def invalidate(self, key):
+        with self._lock:
+            self._writes += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._writes += 1
+            self._data.clear()
+
+    def prune(self, predicate) -> int:
+        """Удаляет записи, для которых predicate(value) истинно."""
+        with self._lock:
+            stale = [key for key, value in self._data.items() if predicate(value)]
+            for key in stale:
+                del self._data[key]
+            self._writes += 1
+            return len(stale)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
+
+
+# ticket_id -> словарь заявки (как возвращает get_ticket_data)
+TICKET_CACHE = LRUCache(TICKET_CACHE_SIZE)
+
+
+async def get_ticket_data_async(ticket_id: int) -> Optional[dict]:
+    """Заявка из кэша, при промахе — из БД (с сохранением в кэш)."""
+    ticket = TICKET_CACHE.get(ticket_id)
+    if ticket is None:
+        token = TICKET_CACHE.begin_load()
+        ticket = await run_db_read(get_ticket_data, ticket_id)
+        if ticket is None:
+            return None
+        TICKET_CACHE.put_loaded(ticket_id, ticket, token)
+    return dict(ticket)
+
+
+async def create_ticket_row_async(*args, **kwargs) -> dict:
+    ticket = await run_db_write(create_ticket_row, *args, **kwargs)
+    TICKET_CACHE.put(ticket["ticket_id"], ticket)
+    return dict(ticket)
+
+
+async def update_ticket_async(ticket_id: int, **fields):
+    await run_db_write(update_ticket, ticket_id, **fields)
+    TICKET_CACHE.update(ticket_id, **fields)
+
+
+async def create_ticket_async(**kwargs) -> dict:
+    ticket = await run_db_write(create_ticket, **kwargs)
+    TICKET_CACHE.put(ticket["ticket_id"], ticket)
+    return dict(ticket)
+
+
+async def _transition_ticket_async(func, *args) -> Tuple[bool, Optional[dict]]:
+    won, ticket = await run_db_write(func, *args)
+    if ticket is not None:
+        TICKET_CACHE.put(ticket["ticket_id"], ticket)
+        ticket = dict(ticket)
+    return won, ticket
+
+
+async def take_ticket_async(ticket_id: int, executor_id: int, executor_name: str):
+    return await _transition_ticket_async(take_ticket, ticket_id, executor_id, executor_name)
+
+
+async def complete_ticket_async(ticket_id: int, executor_id: int, executor_name: str):
+    return await _transition_ticket_async(
+        complete_ticket, ticket_id, executor_id, executor_name
+    )
+
+
+async def cancel_ticket_by_sender_async(ticket_id: int, sender_id: int):
+    return await _transition_ticket_async(cancel_ticket_by_sender, ticket_id, sender_id)
+
+
+async def wipe_all_tables_async():
+    await run_db_write(wipe_all_tables)
+    TICKET_CACHE.clear()
+    SENDER_CACHE.clear()
+    TECH_NAME_CACHE.clear()
+    FSM_STORAGE.clear_cache()
+
+
+# ---- Кэш профилей отправителей и имён техников ----
+# Таблицы маленькие и почти не меняются, а читаются на каждое действие.
+# Кэши прогреваются при старте целиком и обновляются всеми хелперами записи.
+# Отсутствие профиля/имени тоже кэшируется (значение None).
+
+SENDER_CACHE_SIZE = int(os.getenv("SENDER_CACHE_SIZE", "5000"))
+TECH_NAME_CACHE_SIZE = int(os.getenv("TECH_NAME_CACHE_SIZE", "500"))
+
+# user_id -> профиль отправителя или None
+SENDER_CACHE = LRUCache(SENDER_CACHE_SIZE)
+# user_id -> имя техника из БД или None
+TECH_NAME_CACHE = LRUCache(TECH_NAME_CACHE_SIZE)
+
+
+def warm_profile_caches():
+    """Загружает отправителей и техников в кэши (вызывается при старте)."""
+    for sender in get_all_senders(limit=SENDER_CACHE_SIZE):
+        SENDER_CACHE.put(sender["user_id"], sender)
+    for tech in get_all_technicians()[:TECH_NAME_CACHE_SIZE]:
+        TECH_NAME_CACHE.put(tech["user_id"], tech["display_name"] or None)
+    logging.info(
+        f"Кэши прогреты: отправителей {len(SENDER_CACHE)}, техников {len(TECH_NAME_CACHE)}"
+    )
+
+
+async def get_sender_profile_async(user_id: int) -> Optional[dict]:
+    profile = SENDER_CACHE.get(user_id, _CACHE_MISS)
+    if profile is _CACHE_MISS:
+        token = SENDER_CACHE.begin_load()
+        profile = await run_db_read(get_sender_profile, user_id)
+        SENDER_CACHE.put_loaded(user_id, profile, token)
+    return dict(profile) if profile else None
+
+
+async def set_sender_profile_async(user_id: int, display_name: str, store: str) -> dict:
+    profile = await run_db_write(set_sender_profile, user_id, display_name, store)
+    SENDER_CACHE.put(user_id, profile)
+    return dict(profile)
+
+
+async def set_sender_name_async(user_id: int, display_name: str) -> dict:
+    profile = await run_db_write(set_sender_name, user_id, display_name)
+    SENDER_CACHE.put(user_id, profile)
+    return dict(profile)
+
+
+async def delete_sender_async(user_id: int):
+    await run_db_write(delete_sender, user_id)
+    SENDER_CACHE.put(user_id, None)
+
+
+async def get_technician_name_async(user: types.User) -> str:
+    """Имя техника из кэша/БД, иначе имя из Telegram."""
+    name = TECH_NAME_CACHE.get(user.id, _CACHE_MISS)
+    if name is _CACHE_MISS:
+        token = TECH_NAME_CACHE.begin_load()
+        name = await run_db_read(get_technician_display_name, user.id)
+        TECH_NAME_CACHE.put_loaded(user.id, name, token)
+    return name or telegram_display_name(user)
+
+
+async def set_technician_name_async(user_id: int, display_name: str):
+    await run_db_write(set_technician_name, user_id, display_name)
+    TECH_NAME_CACHE.put(user_id, display_name or None)
+
+
+def invalidate_ticket_cache(ticket_id: Optional[int] = None):
+    """Сбросить одну заявку или (без аргумента) весь кэш заявок."""
+    if ticket_id is None:
+        TICKET_CACHE.clear()
+    else:
+        TICKET_CACHE.invalidate(ticket_id)
+
+
+# ============ ХРАНИЛИЩЕ СОСТОЯНИЙ FSM ============
+
+# Через сколько секунд без изменений брошенный черновик считается протухшим
+FSM_STATE_TTL_SECONDS = int(os.getenv("FSM_STATE_TTL_SECONDS", str(24 * 3600)))
+# Как часто удалять протухшие состояния из БД и кэша
+FSM_CLEANUP_SECONDS = float(os.getenv("FSM_CLEANUP_SECONDS", "600"))
+# Размер кэша в памяти; 0 — читать всегда из БД (несколько процессов на одной БД)
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "5000"))
+
+_EMPTY_FSM_RECORD = {"state": None, "data": {}, "bucket": {}, "ts": 0}
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище состояний FSM в таблице fsm_states с кэшем в памяти.
+
+    Запись сквозная: кэш обновляется сразу, строка в БД — через групповую
+    запись, поэтому незаконченные заявки переживают перезапуск. Состояния,
+    не менявшиеся дольше ttl, считаются пустыми и удаляются фоновой очисткой.
+    Записи в кэше не изменяются на месте — только заменяются целиком.
+    """
+
+    def __init__(self, ttl: int = FSM_STATE_TTL_SECONDS, cache_size: int = FSM_CACHE_SIZE):
+        self.ttl = ttl
+        self.cache = LRUCache(cache_size) if cache_size > 0 else None
+        self.expired = 0
+        self._cleanup_task: Optional[asyncio.Task] = None
+
+    def _is_expired(self, record: Optional[dict]) -> bool:
+        return record is not None and record["ts"] < time.time() - self.ttl
+
+    async def _load(self, chat, user) -> Tuple[tuple, dict]:
+        key = tuple(self.check_address(chat=chat, user=user))
+        record = _CACHE_MISS
+        if self.cache is not None:
+            record = self.cache.get(key, _CACHE_MISS)
+        if record is _CACHE_MISS:
+            token = self.cache.begin_load() if self.cache is not None else 0
+            record = await run_db_read(load_fsm_record, *key)
+            if self.cache is not None:
+                self.cache.put_loaded(key, record, token)
+        if record is None or self._is_expired(record):
+            record = _EMPTY_FSM_RECORD
+        return key, record
+
+    async def _save(self, key: tuple, record: dict, **fields):
+        record = {**record, **fields, "ts": int(time.time())}
+        empty = record["state"] is None and not record["data"] and not record["bucket"]
+        if self.cache is not None:
+            self.cache.put(key, None if empty else record)
+        try:
+            await run_db_write(save_fsm_record, *key, record)
+        except Exception:
+            if self.cache is not None:
+                self.cache.invalidate(key)
+            raise
+
+    async def get_state(self, *, chat=None, user=None, default=None) -> Optional[str]:
+        _, record = await self._load(chat, user)
+        if record["state"] is None:
+            return self.resolve_state(default)
+        return record["state"]
+
+    async def get_data(self, *, chat=None, user=None, default=None) -> dict:
+        _, record = await self._load(chat, user)
+        return copy.deepcopy(record["data"])
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        key, record = await self._load(chat, user)
+        await self._save(key, record, state=self.resolve_state(state))
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        key, record = await self._load(chat, user)
+        await self._save(key, record, data=copy.deepcopy(data or {}))
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        key, record = await self._load(chat, user)
+        await self._save(key, record, data={**record["data"], **(data or {}), **kwargs})
+
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        key, record = await self._load(chat, user)
+        if with_data:
+            await self._save(key, record, state=None, data={})
+        else:
+            await self._save(key, record, state=None)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None) -> dict:
+        _, record = await self._load(chat, user)
+        return copy.deepcopy(record["bucket"])
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        key, record = await self._load(chat, user)
+        await self._save(key, record, bucket=copy.deepcopy(bucket or {}))
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        key, record = await self._load(chat, user)
+        await self._save(
+            key, record, bucket={**record["bucket"], **(bucket or {}), **kwargs}
+        )
+
+    def clear_cache(self):
+        if self.cache is not None:
+            self.cache.clear()
+
+    async def cleanup(self) -> int:
+        """Удаляет протухшие состояния из БД и кэша, возвращает число строк."""
+        removed = await run_db_write(
+            delete_expired_fsm_records, int(time.time() - self.ttl)
+        )
+        if self.cache is not None:
+            self.cache.prune(self._is_expired)
+        self.expired += removed
+        if removed:
+            logging.info(f"Удалено брошенных состояний FSM: {removed}")
+        return removed
+
+    async def _cleanup_loop(self):
+        while True:
+            try:
+                await self.cleanup()
+            except Exception as e:
+                logging.warning(f"Не удалось очистить состояния FSM: {e}")
+            await asyncio.sleep(FSM_CLEANUP_SECONDS)
+
+    def start_cleanup(self):
+        if self._cleanup_task is None:
+            self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+
+    async def close(self):
+        if self._cleanup_task is not None:
+            self._cleanup_task.cancel()
+            try:
+                await self._cleanup_task
+            except asyncio.CancelledError:
+                pass
+            self._cleanup_task = None
+
+    async def wait_closed(self):
+        pass
+
+
+FSM_STORAGE = SQLiteStorage()
+
+
+# ============ ЗАПИСЬ ТРАФИКА ============
+
+# Если задан путь, входящие обновления и исходящие вызовы Bot API
+# дописываются в этот JSONL-файл для последующего прогона через replay.py
+TRAFFIC_RECORD_PATH = os.getenv("TRAFFIC_RECORD_PATH", "")
+# Ключ для обезличивания id; без него — случайный на каждый запуск
+TRAFFIC_RECORD_SALT = os.getenv("TRAFFIC_RECORD_SALT", "")
+
+
+def recordable_text(text: str) -> str:
+    """
+    Текст сообщения для записи: кнопки, команды и номера магазинов
+    сохраняются как есть (от них зависит ветка обработки), остальное
+    заменяется на «x» той же длины.
+    """
+    if text in RECORDABLE_TEXTS:
+        return text
+    if text.startswith("/"):
+        # Аргументы команд (id пользователей и т. п.) не пишем
+        return text.split()[0]
+    if text.isdigit() and len(text) <= 4:
+        return text
+    return "x" * len(text)
+
+
+class TrafficRecorder:
+    """
+    Обезличенный журнал трафика бота, только дописывается.
+
+    Строка файла — одно событие: {"k":"in","t":..,"u":{...}} — входящее
+    обновление, {"k":"out","t":..,"m":..,"c":..,"ms":..,"e":..} — вызов
+    Bot API, {"k":"session","ts":..} — начало записи (t отсчитывается от
+    него, в секундах). Id пользователей, чатов и файлов заменены ключевым
+    хэшем, имена не пишутся, свободный текст — см. recordable_text().
+    """
+
+    def __init__(self, path: str, salt: str = ""):
+        self.path = path
+        self._salt = salt.encode() or secrets.token_bytes(16)
+        self._file = None
+        self._started = 0.0
+        self._callbacks = 0
+        self.updates = 0
+        self.calls = 0
+
+    def _write(self, record: dict):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+            self._started = time.monotonic()
+            self._file.write(json.dumps({"k": "session", "ts": int(time.time())}) + "\n")
+        record["t"] = round(time.monotonic() - self._started, 3)
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+    def _anon_id(self, value) -> Optional[int]:
+        if value is None:
+            return None
+        digest = hmac.new(self._salt, str(value).encode(), "sha256").hexdigest()
+        anon = int(digest[:10], 16)
+        return -anon if int(value) < 0 else anon
+
+    def _anon_token(self, value: str) -> str:
+        return hmac.new(self._salt, value.encode(), "sha256").hexdigest()[:16]
+
+    def _user(self, user: Optional[types.User]) -> Optional[dict]:
+        if user is None:
+            return None
+        return {"id": self._anon_id(user.id), "is_bot": user.is_bot, "first_name": "U"}
+
+    def _chat(self, chat: types.Chat) -> dict:
+        return {"id": self._anon_id(chat.id), "type": chat.type}
+
+    def _message(self, message: types.Message) -> dict:
+        data = {
+            "message_id": message.message_id,
+            "date": int(message.date.timestamp()),
+            "chat": self._chat(message.chat),
+        }
+        if message.from_user:
+            data["from"] = self._user(message.from_user)
+        if message.text is not None:
+            data["text"] = recordable_text(message.text)
+            if data["text"].startswith("/"):
+                data["entities"] = [
+                    {"type": "bot_command", "offset": 0, "length": len(data["text"])}
+                ]
+        if message.caption is not None:
+            data["caption"] = recordable_text(message.caption)
+        if message.photo:
+            largest = message.photo[-1]
+            file_id = self._anon_token(largest.file_id)
+            data["photo"] = [
+                {
+                    "file_id": file_id,
+                    "file_unique_id": file_id,
+                    "width": largest.width,
+                    "height": largest.height,
+                }
+            ]
+        if message.media_group_id:
+            data["media_group_id"] = self._anon_token(message.media_group_id)
+        return data
+
+    def record_update(self, update: types.Update):
+        if update.message:
+            payload = {"message": self._message(update.message)}
+        elif update.callback_query:
+            call = update.callback_query
+            self._callbacks += 1
+            payload = {
+                "callback_query": {
+                    "id": f"cq{self._callbacks}",
+                    "from": self._user(call.from_user),
+                    "chat_instance": "0",
+                    "data": call.data,
+                }
+            }
+            if call.message:
+                payload["callback_query"]["message"] = {
+                    "message_id": call.message.message_id,
+                    "date": int(call.message.date.timestamp()),
+                    "chat": self._chat(call.message.chat),
+                }
+        else:
+            return
+        self.updates += 1
+        self._write({"k": "in", "u": payload})
+
+    def record_call(self, method: str, chat_id, seconds: float, error: Optional[str]):
+        record = {"k": "out", "m": method, "ms": round(seconds * 1000, 1)}
+        if chat_id is not None:
+            record["c"] = self._anon_id(chat_id)
+        if error:
+            record["e"] = error
+        self.calls += 1
+        self._write(record)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+TRAFFIC_RECORDER = (
+    TrafficRecorder(TRAFFIC_RECORD_PATH, TRAFFIC_RECORD_SALT) if TRAFFIC_RECORD_PATH else None
+)
+
+
+# Отправки и правки в чат, которые считаются в лимитах Telegram
+RATE_LIMITED_METHODS = frozenset({
+    "sendMessage", "sendPhoto", "sendMediaGroup", "sendDocument",
+    "copyMessage", "forwardMessage",
+    "editMessageText", "editMessageCaption", "editMessageReplyMarkup",
+})
+
+
+class ObservedBot(Bot):
+    """Bot, у которого все вызовы Bot API проходят через request() — здесь их замеряем и записываем."""
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        # Прямые ответы хэндлеров (message.answer, call.message.edit_*)
+        # тоже ставим в очередь исходящих — срочными, чтобы они считались
+        # в лимитах чата вместе с уведомлениями и рассылками
+        chat_id = (data or {}).get("chat_id")
+        if (
+            method in RATE_LIMITED_METHODS
+            and isinstance(chat_id, int)
+            and OUTBOUND.running
+            and not in_outbound_worker()
+        ):
+            async def send(chat_id):
+                return await self._observed_request(method, data, files, **kwargs)
+
+            return await OUTBOUND.send(send, priority=PRIORITY_HIGH, chat_id=chat_id)
+        return await self._observed_request(method, data, files, **kwargs)
+
+    async def _observed_request(self, method, data=None, files=None, **kwargs):
+        # Long polling не замеряем: getUpdates висит до POLLING_TIMEOUT,
+        # а обновления пишутся при постановке в линию
+        if method == "getUpdates":
+            return await super().request(method, data, files, **kwargs)
+        started = time.monotonic()
+        error = None
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            observe_api_call(method, error, elapsed)
+            if TRAFFIC_RECORDER is not None:
+                TRAFFIC_RECORDER.record_call(
+                    method, (data or {}).get("chat_id"), elapsed, error
+                )
+
+
+TELEGRAM_API_SERVER = (
+    TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else TELEGRAM_PRODUCTION
+)
+
+bot = ObservedBot(token=BOT_TOKEN, parse_mode="HTML", server=TELEGRAM_API_SERVER)
+dp = LaneDispatcher(
+    bot,
+    storage=FSM_STORAGE,
+    on_enqueue=TRAFFIC_RECORDER.record_update if TRAFFIC_RECORDER is not None else None,
+)
+
+
+# ============ FSM ДЛЯ СОЗДАНИЯ ЗАЯВКИ И ПРОФИЛЯ ============
+
+class TicketForm(StatesGroup):
+    equipment = State()
+    description = State()
+    priority = State()
+    photo = State()
+
+
+class UserProfile(StatesGroup):
+    waiting_for_name = State()
+    waiting_for_store = State()
+
+
+# ============ КНОПКИ ============
+
+NEW_TICKET_TEXT = "📝 Новая заявка"
+CANCEL_TEXT = "❌ Отмена"
+BACK_TEXT = "⬅ Назад"
+NO_PHOTO_TEXT = "Продолжить без фото"
+
+EQUIPMENT_CHOICES = [
+    "Весы",
+    "Видеонаблюдение",
+    "Интернет",
+    "Кассовое оборудование",
+    "Другое",
+]
+
+
+def _build_reply_keyboard(rows, one_time: bool = False):
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=one_time)
+    for row in rows:
+        kb.add(*row)
+    return kb
+
+
+# Клавиатуры без параметров собираются один раз при импорте.
+# Это общие объекты: отдавать их можно сколько угодно, менять нельзя.
+NEW_TICKET_KB = _build_reply_keyboard([[types.KeyboardButton(NEW_TICKET_TEXT)]])
+EQUIPMENT_KB = _build_reply_keyboard(
+    [
+        ["Весы", "Видеонаблюдение"],
+        ["Интернет", "Кассовое оборудование"],
+        ["Другое"],
+        [CANCEL_TEXT],
+    ],
+    one_time=True,
+)
+DESCRIPTION_KB = _build_reply_keyboard([[BACK_TEXT, CANCEL_TEXT]])
+PRIORITY_KB = _build_reply_keyboard(
+    [["обычная", "высокая"], [BACK_TEXT, CANCEL_TEXT]], one_time=True
+)
+PHOTO_KB = _build_reply_keyboard([[NO_PHOTO_TEXT], [BACK_TEXT, CANCEL_TEXT]])
+
+
+# Тексты, которые TrafficRecorder пишет как есть: нажатия кнопок
+RECORDABLE_TEXTS = frozenset(
+    [NEW_TICKET_TEXT, CANCEL_TEXT, BACK_TEXT, NO_PHOTO_TEXT, "обычная", "высокая", "нет"]
+    + EQUIPMENT_CHOICES
+)
+
+
+def new_ticket_keyboard():
+    return NEW_TICKET_KB
+
+
+def equipment_keyboard():
+    return EQUIPMENT_KB
+
+
+def description_keyboard():
+    return DESCRIPTION_KB
+
+
+def priority_keyboard():
+    return PRIORITY_KB
+
+
+def photo_keyboard():
+    return PHOTO_KB
+
+
+# Клавиатуры под заявкой зависят только от ticket_id/sender_id, поэтому
+# кешируются: одна и та же заявка рассылается всем техникам и админам.
+# Возвращаемые объекты общие — не изменять.
+KEYBOARD_CACHE_SIZE = 1024
+
+
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def tech_inline_keyboard(ticket_id: int, sender_id: int):
+    kb = types.InlineKeyboardMarkup()
+    kb.add(
+        types.InlineKeyboardButton(
+            "Принять", callback_data=f"take_{ticket_id}"
+        ),
+        types.InlineKeyboardButton(
+            "Завершить", callback_data=f"done_{ticket_id}"
+        ),
+    )
+    kb.add(
+        types.InlineKeyboardButton(
+            "Связаться с отправителем",
+            url=f"tg://user?id={sender_id}",
+        )
+    )
+    return kb
+
+
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def tech_in_progress_keyboard(ticket_id: int, sender_id: int):
+    """Копия исполнителя: заявку можно только завершить."""
+    kb = types.InlineKeyboardMarkup()
+    kb.add(
+        types.InlineKeyboardButton(
+            "Завершить", callback_data=f"done_{ticket_id}"
+        )
+    )
+    kb.add(
+        types.InlineKeyboardButton(
+            "Связаться с отправителем",
+            url=f"tg://user?id={sender_id}",
+        )
+    )
+    return kb
+
+
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def sender_contact_keyboard(sender_id: int):
+    """Копии остальных техников: действий по заявке больше нет."""
+    kb = types.InlineKeyboardMarkup()
+    kb.add(
+        types.InlineKeyboardButton(
+            "Связаться с отправителем",
+            url=f"tg://user?id={sender_id}",
+        )
+    )
+    return kb
+
+
+def tech_keyboard_for(ticket: dict, tech_id: int):
+    """Кнопки в копии заявки у конкретного техника по текущему статусу."""
+    if ticket["status"] == "Создана":
+        return tech_inline_keyboard(ticket["ticket_id"], ticket["sender_id"])
+    if ticket["status"] == "Выполняется" and ticket["executor_id"] == tech_id:
+        return tech_in_progress_keyboard(ticket["ticket_id"], ticket["sender_id"])
+    return sender_contact_keyboard(ticket["sender_id"])
+
+
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def admin_inline_keyboard(sender_id: int):
+    kb = types.InlineKeyboardMarkup()
+    kb.add(
+        types.InlineKeyboardButton(
+            "Отправитель", url=f"tg://user?id={sender_id}"
+        )
+    )
+    return kb
+
+
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def user_ticket_inline_keyboard(ticket_id: int):
+    kb = types.InlineKeyboardMarkup()
+    kb.add(
+        types.InlineKeyboardButton(
+            "Отменить заявку", callback_data=f"user_cancel_{ticket_id}"
+        )
+    )
+    return kb
+
+
+# Статусы, рядом с которыми показывается исполнитель
+STATUSES_WITH_EXECUTOR = frozenset({"Выполняется", "Выполнена"})
+
+TICKET_TEMPLATE = (
+    "#{ticket_id}\n"
+    "<b>Магазин:</b> {store} / "
+    '<a href="tg://user?id={sender_id}">{sender_label}</a>\n'
+    "{address_line}"
+    "<b>Оборудование:</b> {equipment}\n"
+    "<b>Описание:</b> {description}\n"
+    "<b>Срочность:</b> {priority}\n"
+    "<b>Статус:</b> {status_text}\n"
+).format
+
+
+def format_status_text(
+    status: str, executor_name: str = "", executor_id: Optional[int] = None
+) -> str:
+    if executor_name and status in STATUSES_WITH_EXECUTOR:
+        if executor_id:
+            return f'{status} <a href="tg://user?id={executor_id}">{executor_name}</a>'
+        return f"{status} {executor_name}"
+    return status
+
+
+@timed_phase("render")
+def format_ticket_text(
+    ticket_id: int,
+    store: str,
+    sender_id: int,
+    equipment: str,
+    description: str,
+    priority: str,
+    status: str,
+    sender_name: Optional[str] = None,
+    executor_name: str = "",
+    executor_id: Optional[int] = None,
+):
+    # Адрес и ссылки на карты собираются при загрузке stores.txt
+    address_line = CONFIG.store_lines.get(str(store).strip(), "") if store else ""
+    return TICKET_TEMPLATE(
+        ticket_id=ticket_id,
+        store=store,
+        sender_id=sender_id,
+        sender_label=sender_name or "Отправитель",
+        address_line=address_line,
+        equipment=equipment,
+        description=description,
+        priority=priority,
+        status_text=format_status_text(status, executor_name, executor_id),
+    )
+
+
+def render_ticket(ticket: dict) -> str:
+    """Текст заявки по строке из БД (словарь get_ticket_data)."""
+    return format_ticket_text(
+        ticket_id=ticket["ticket_id"],
+        store=ticket["store"],
+        sender_id=ticket["sender_id"],
+        equipment=ticket["equipment"],
+        description=ticket["description"],
+        priority=ticket["priority"],
+        status=ticket["status"],
+        sender_name=ticket["sender_name"],
+        executor_name=ticket["executor_name"] or "",
+        executor_id=ticket["executor_id"],
+    )
+
+
+# ============ СЛУЖЕБНЫЕ ПРОВЕРКИ ============
+
+def is_admin(user_id: int) -> bool:
+    return user_id in ADMIN_USER_IDS
+
+
+def is_tech(user_id: int) -> bool:
+    return user_id in CONFIG.techs
+
+
+async def cancel_creation(message: types.Message, state: FSMContext):
+    await state.finish()
+    kb = new_ticket_keyboard()
+    await message.answer("Создание заявки отменено.", reply_markup=kb)
+
+
+# ============ ИСХОДЯЩИЕ СООБЩЕНИЯ (ЛИМИТЫ TELEGRAM) ============
+
+# Очередь с лимитами — OUTBOUND из outbound.py; заявки с высокой
+# срочностью обгоняют в ней обычные сообщения
+
+def ticket_send_priority(ticket: dict) -> int:
+    return PRIORITY_HIGH if ticket.get("priority") == "высокая" else PRIORITY_NORMAL
+
+
+# ============ ОТПРАВКА УВЕДОМЛЕНИЙ О ЗАЯВКАХ (OUTBOX) ============
+
+# Сколько уведомлений отправляется одновременно. Каждое — своя задача:
+# медленное (чат руководства с его лимитом) не держит остальные
+OUTBOX_MAX_IN_FLIGHT = 50
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETRY_BASE_SECONDS = 5
+OUTBOX_RETRY_MAX_SECONDS = 600
+# Как часто проверять outbox, если нас не разбудили (отложенные повторы)
+OUTBOX_POLL_SECONDS = 5
+
+# Ошибки, при которых повторять бессмысленно (бот заблокирован, чата нет)
+OUTBOX_PERMANENT_ERRORS = (exceptions.Unauthorized, exceptions.ChatNotFound)
+
+_outbox_wakeup: Optional[asyncio.Event] = None
+_outbox_task: Optional[asyncio.Task] = None
+
+
+def wake_outbox():
+    """Сообщает диспетчеру, что в outbox появились новые уведомления."""
+    if _outbox_wakeup is not None:
+        _outbox_wakeup.set()
+
+
+def ticket_album_needed(item: dict, ticket: dict) -> bool:
+    if len(item["album"]) < 2:
+        return False
+    # Технику закрытая или отменённая заявка не отправляется вовсе
+    return item["kind"] == OUTBOX_KIND_ADMIN or ticket["status"] not in (
+        STATUS_DONE,
+        STATUS_CANCELLED,
+    )
+
+
+async def send_ticket_album(chat_id: int, photo_ids: list, priority: int):
+    media = [types.InputMediaPhoto(photo_id) for photo_id in photo_ids]
+    return await OUTBOUND.send(
+        bot.send_media_group, chat_id=chat_id, media=media, priority=priority
+    )
+
+
+def outbox_item_done(item: dict, ticket: Optional[dict], copies: list) -> bool:
+    """Уведомление больше не нужно или уже отправлено прошлой попыткой."""
+    if ticket is None:
+        return True
+    if item["kind"] == OUTBOX_KIND_ADMIN:
+        return bool(ticket["admin_msg_id"])
+    # Технику закрытая или отменённая заявка уже не нужна
+    if ticket["status"] in (STATUS_DONE, STATUS_CANCELLED):
+        return True
+    return any(copy["chat_id"] == item["chat_id"] for copy in copies)
+
+
+async def deliver_outbox_item(item: dict):
+    """
+    Отправляет уведомление и снимает его из outbox.
+
+    Отправленное сообщение записывается в заявку той же операцией, что
+    удаляет строку outbox, альбом — в строку outbox сразу после отправки.
+    Повтор после сбоя видит записанное и второй раз его не отправляет.
+    """
+    ticket = await get_ticket_data_async(item["ticket_id"])
+    copies = []
+    if ticket is not None and item["kind"] != OUTBOX_KIND_ADMIN:
+        copies = await run_db_read(get_ticket_messages, ticket["ticket_id"])
+    if outbox_item_done(item, ticket, copies):
+        await run_db_write(delete_outbox_item, item["id"])
+        return
+
+    # Текст берём по текущему состоянию заявки: если её уже взяли или
+    # отменили, пока уведомление ждало отправки, покажем актуальный статус
+    text = render_ticket(ticket)
+    photo_id = item["photo_id"]
+    priority = ticket_send_priority(ticket)
+
+    # Альбом уходит отдельным send_media_group, а кнопки к нему прикрепить
+    # нельзя — поэтому следом отправляется текстовая карточка заявки.
+    # Отправленный альбом записывается сразу: если карточка не уйдёт,
+    # повтор отправит только её
+    if ticket_album_needed(item, ticket):
+        if not item["album_message_ids"]:
+            album = await send_ticket_album(item["chat_id"], item["album"], priority)
+            message_ids = [message.message_id for message in album]
+            await run_db_write(set_outbox_album_sent, item["id"], message_ids)
+            item["album_message_ids"] = message_ids
+        photo_id = None
+
+    if item["kind"] == OUTBOX_KIND_ADMIN:
+        reply_markup = admin_inline_keyboard(ticket["sender_id"])
+    else:
+        reply_markup = tech_keyboard_for(ticket, item["chat_id"])
+    if photo_id:
+        sent = await OUTBOUND.send(
+            bot.send_photo,
+            chat_id=item["chat_id"],
+            photo=photo_id,
+            caption=text,
+            reply_markup=reply_markup,
+            priority=priority,
+        )
+    else:
+        sent = await OUTBOUND.send(
+            bot.send_message,
+            chat_id=item["chat_id"],
+            text=text,
+            reply_markup=reply_markup,
+            priority=priority,
+        )
+    kind = MESSAGE_KIND_PHOTO if photo_id else MESSAGE_KIND_TEXT
+
+    if item["kind"] == OUTBOX_KIND_ADMIN:
+        await run_db_write(
+            finish_admin_outbox_item, item["id"], ticket["ticket_id"], sent.message_id, kind
+        )
+        TICKET_CACHE.update(
+            ticket["ticket_id"], admin_msg_id=sent.message_id, admin_msg_kind=kind
+        )
+    else:
+        await run_db_write(
+            finish_tech_outbox_item,
+            item["id"],
+            ticket["ticket_id"],
+            item["chat_id"],
+            sent.message_id,
+            kind,
+        )
+
+    # Статус мог смениться, пока сообщение отправлялось, а без записанного
+    # сообщения хэндлеры не могли его отредактировать — догоняем сами.
+    # Уведомление уже снято из outbox, поэтому ошибка здесь его не повторит
+    try:
+        current = await get_ticket_data_async(ticket["ticket_id"])
+        if current is None or current["status"] == ticket["status"]:
+            return
+        if item["kind"] == OUTBOX_KIND_ADMIN:
+            ADMIN_EDITOR.schedule(
+                item["chat_id"], sent.message_id, kind, render_ticket(current), reply_markup
+            )
+        else:
+            tech_copy = {"chat_id": item["chat_id"], "message_id": sent.message_id, "kind": kind}
+            await edit_tech_copy(current, tech_copy)
+    except Exception as e:
+        logging.warning(
+            f"Не удалось обновить статус в уведомлении по заявке #{ticket['ticket_id']} "
+            f"в чате {item['chat_id']}: {e}"
+        )
+
+
+async def process_outbox_item(item: dict):
+    try:
+        await deliver_outbox_item(item)
+    except Exception as e:
+        attempts = item["attempts"] + 1
+        give_up = attempts >= OUTBOX_MAX_ATTEMPTS or isinstance(e, OUTBOX_PERMANENT_ERRORS)
+        delay = min(
+            OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1), OUTBOX_RETRY_MAX_SECONDS
+        )
+        logging.warning(
+            f"Не удалось отправить уведомление по заявке #{item['ticket_id']} "
+            f"в чат {item['chat_id']} (попытка {attempts}): {e}"
+            + (" — больше не повторяем." if give_up else f" — повтор через {delay} с.")
+        )
+        await run_db_write(
+            reschedule_outbox_item,
+            item["id"],
+            attempts,
+            time.time() + delay,
+            str(e),
+            give_up,
+        )
+
+
+async def outbox_dispatcher():
+    """
+    Фоновая задача: отправляет накопившиеся уведомления из outbox.
+
+    Как только отправка уведомления завершается, на его место берётся
+    следующее — не дожидаясь остальных, начатых вместе с ним.
+    """
+    global _outbox_wakeup
+    _outbox_wakeup = asyncio.Event()
+    in_flight: Dict[int, asyncio.Task] = {}
+
+    def finished(item_id: int, task: asyncio.Task):
+        in_flight.pop(item_id, None)
+        _outbox_wakeup.set()
+
+    try:
+        while True:
+            _outbox_wakeup.clear()
+            free = OUTBOX_MAX_IN_FLIGHT - len(in_flight)
+            items = []
+            if free > 0:
+                try:
+                    # Отправляемые ещё лежат в outbox — берём с запасом и пропускаем их
+                    due = await run_db_read(fetch_due_outbox, free + len(in_flight))
+                    items = [item for item in due if item["id"] not in in_flight][:free]
+                except Exception as e:
+                    logging.exception(f"Ошибка диспетчера уведомлений: {e}")
+            for item in items:
+                # Темп отправки задаёт OUTBOUND
+                task = asyncio.create_task(process_outbox_item(item))
+                in_flight[item["id"]] = task
+                task.add_done_callback(functools.partial(finished, item["id"]))
+
+            if len(items) < free or free <= 0:
+                # Будят новые уведомления и освободившиеся места
+                try:
+                    await asyncio.wait_for(_outbox_wakeup.wait(), OUTBOX_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+    finally:
+        # Прерванные уведомления остаются в outbox и уйдут после перезапуска
+        for task in list(in_flight.values()):
+            task.cancel()
+        await asyncio.gather(*in_flight.values(), return_exceptions=True)
+
+
+def start_outbox_dispatcher():
+    global _outbox_task
+    if _outbox_task is None:
+        _outbox_task = asyncio.create_task(outbox_dispatcher())
+
+
+async def stop_outbox_dispatcher():
+    global _outbox_task
+    if _outbox_task is not None:
+        _outbox_task.cancel()
+        try:
+            await _outbox_task
+        except asyncio.CancelledError:
+            pass
+        _outbox_task = None
+
+
+# ============ РЕДАКТИРОВАНИЕ СООБЩЕНИЙ С ЗАЯВКАМИ ============
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+_BACKGROUND_TASKS: Set[asyncio.Task] = set()
+
+
+def spawn_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro, context=detached_context())
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+    return task
+
+
+async def drain_background_tasks(timeout: float = 10):
+    """Даёт фоновым задачам доработать перед остановкой бота."""
+    if _BACKGROUND_TASKS:
+        await asyncio.wait(set(_BACKGROUND_TASKS), timeout=timeout)
+
+
+async def _send_notification(chat_id: int, text: str, what: str):
+    try:
+        await OUTBOUND.send(bot.send_message, chat_id=chat_id, text=text)
+    except Exception as e:
+        logging.warning(f"Не удалось {what}: {e}")
+
+
+def notify_in_background(chat_id: int, text: str, what: str):
+    """
+    Уведомление через очередь исходящих, не дожидаясь отправки: хэндлер не
+    держит линию, пока у чата получателя не появится место в лимите.
+    what — что не удалось сделать, для лога ("уведомить отправителя ...").
+    """
+    spawn_background(_send_notification(chat_id, text, what))
+
+
+# Окно, в котором несколько правок одного сообщения схлопываются в одну
+ADMIN_EDIT_DEBOUNCE_SECONDS = float(os.getenv("ADMIN_EDIT_DEBOUNCE_SECONDS", "0.5"))
+
+
+async def edit_ticket_message(
+    chat_id: int,
+    message_id: int,
+    kind: Optional[str],
+    text: str,
+    reply_markup,
+):
+    """
+    Меняет текст заявки в сообщении: подпись у фото, текст у обычного.
+    Для старых заявок тип неизвестен (kind=None) — пробуем оба варианта.
+    """
+    caption_kwargs = {
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "caption": text,
+        "reply_markup": reply_markup,
+    }
+    text_kwargs = {
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "text": text,
+        "reply_markup": reply_markup,
+        "disable_web_page_preview": True,
+    }
+    try:
+        if kind == MESSAGE_KIND_PHOTO:
+            await OUTBOUND.send(bot.edit_message_caption, **caption_kwargs)
+        elif kind == MESSAGE_KIND_TEXT:
+            await OUTBOUND.send(bot.edit_message_text, **text_kwargs)
+        else:
+            try:
+                await OUTBOUND.send(bot.edit_message_caption, **caption_kwargs)
+            except exceptions.MessageNotModified:
+                raise
+            except Exception:
+                await OUTBOUND.send(bot.edit_message_text, **text_kwargs)
+    except exceptions.MessageNotModified:
+        pass
+
 
+class DebouncedMessageEditor:
+    """
+    Отложенное редактирование сообщений.
 
-# ============ FSM ДЛЯ СОЗДАНИЯ ЗАЯВКИ И ПРОФИЛЯ ============
+    schedule() запоминает последнюю версию текста для сообщения и
+    отправляет её через delay секунд: если за это время статус заявки
+    успел смениться несколько раз, уйдёт один вызов API с итоговым текстом.
+    """
 
-class TicketForm(StatesGroup):
-    equipment = State()
-    description = State()
-    priority = State()
-    photo = State()
+    def __init__(self, delay: float = ADMIN_EDIT_DEBOUNCE_SECONDS):
+        self.delay = delay
+        self._pending: dict = {}
+        self._tasks: dict = {}
+        self.requested = 0
+        self.edited = 0
+
+    def schedule(
+        self,
+        chat_id: int,
+        message_id: int,
+        kind: Optional[str],
+        text: str,
+        reply_markup,
+    ):
+        key = (chat_id, message_id)
+        self._pending[key] = (kind, text, reply_markup)
+        self.requested += 1
+        if key not in self._tasks:
+            self._tasks[key] = spawn_background(self._flush_later(key))
 
+    async def _flush_later(self, key):
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self._tasks.pop(key, None)
+        await self._edit(key)
+
+    async def _edit(self, key):
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            return
+        kind, text, reply_markup = pending
+        chat_id, message_id = key
+        self.edited += 1
+        try:
+            await edit_ticket_message(chat_id, message_id, kind, text, reply_markup)
+        except Exception as e:
+            logging.warning(
+                f"Не удалось обновить сообщение {message_id} в чате {chat_id}: {e}"
+            )
 
-class UserProfile(StatesGroup):
-    waiting_for_name = State()
-    waiting_for_store = State()
+    async def flush(self):
+        """Отправляет все отложенные правки сразу (при остановке бота)."""
+        for task in list(self._tasks.values()):
+            task.cancel()
+        self._tasks.clear()
+        await asyncio.gather(*(self._edit(key) for key in list(self._pending)))
 
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "requested": self.requested,
+            "edited": self.edited,
+        }
 
-# ============ КНОПКИ ============
 
-CANCEL_TEXT = "❌ Отмена"
-BACK_TEXT = "⬅ Назад"
-NO_PHOTO_TEXT = "Продолжить без фото"
+ADMIN_EDITOR = DebouncedMessageEditor()
 
-EQUIPMENT_CHOICES = [
-    "Весы",
-    "Видеонаблюдение",
-    "Интернет",
-    "Кассовое оборудование",
-    "Другое",
-]
 
+# ============ КОПИИ ЗАЯВКИ У ТЕХНИКОВ ============
 
-def equipment_keyboard():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    kb.add("Весы", "Видеонаблюдение")
-    kb.add("Интернет", "Кассовое оборудование")
-    kb.add("Другое")
-    kb.add(CANCEL_TEXT)
-    return kb
+async def edit_tech_copy(ticket: dict, copy: dict):
+    """Обновляет текст и кнопки одной копии заявки у техника."""
+    try:
+        await edit_ticket_message(
+            copy["chat_id"],
+            copy["message_id"],
+            copy["kind"],
+            render_ticket(ticket),
+            tech_keyboard_for(ticket, copy["chat_id"]),
+        )
+    except Exception as e:
+        logging.warning(
+            f"Не удалось обновить копию заявки #{ticket['ticket_id']} "
+            f"у техника {copy['chat_id']}: {e}"
+        )
 
 
-def description_keyboard():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add(BACK_TEXT, CANCEL_TEXT)
-    return kb
+async def sync_tech_copies(ticket: dict):
+    """После смены статуса обновляет все копии заявки у техников разом."""
+    copies = await run_db_read(get_ticket_messages, ticket["ticket_id"])
+    await asyncio.gather(*(edit_tech_copy(ticket, copy) for copy in copies))
 
 
-def priority_keyboard():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    kb.add("обычная", "высокая")
-    kb.add(BACK_TEXT, CANCEL_TEXT)
-    return kb
+class TechCopySyncer:
+    """
+    Синхронизация копий у техников — не больше одной на заявку.
 
+    Если статус меняется, пока копии ещё правятся, schedule() лишь отмечает,
+    что нужен ещё проход. Каждый проход заново читает заявку, поэтому
+    последней в копии уходит её текущая версия, а не снимок из хэндлера,
+    и быстрые смены статуса не обгоняют друг друга.
+    """
 
-def photo_keyboard():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add(NO_PHOTO_TEXT)
-    kb.add(BACK_TEXT, CANCEL_TEXT)
-    return kb
+    def __init__(self):
+        self._running: dict = {}  # ticket_id -> задача синхронизации
+        self._dirty: Set[int] = set()
+        self.requested = 0
+        self.synced = 0
 
+    def schedule(self, ticket_id: int):
+        self.requested += 1
+        if ticket_id in self._running:
+            self._dirty.add(ticket_id)
+            return
+        self._running[ticket_id] = spawn_background(self._run(ticket_id))
 
-def tech_inline_keyboard(ticket_id: int, sender_id: int):
-    kb = types.InlineKeyboardMarkup()
-    kb.add(
-        types.InlineKeyboardButton(
-            "Принять", callback_data=f"take_{ticket_id}"
-        ),
-        types.InlineKeyboardButton(
-            "Завершить", callback_data=f"done_{ticket_id}"
-        ),
+    async def _run(self, ticket_id: int):
+        try:
+            while True:
+                self._dirty.discard(ticket_id)
+                try:
+                    ticket = await get_ticket_data_async(ticket_id)
+                    if ticket is not None:
+                        await sync_tech_copies(ticket)
+                        self.synced += 1
+                except Exception as e:
+                    logging.warning(f"Не удалось обновить копии заявки #{ticket_id}: {e}")
+                if ticket_id not in self._dirty:
+                    break
+        finally:
+            self._running.pop(ticket_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "running": len(self._running),
+            "requested": self.requested,
+            "synced": self.synced,
+        }
+
+
+TECH_COPY_SYNCER = TechCopySyncer()
+
+
+# ============ ФОНОВЫЕ РАССЫЛКИ ============
+
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "50"))
+# Не чаще, чем раз в столько секунд, обновляем сообщение с прогрессом
+BROADCAST_PROGRESS_INTERVAL = 3
+
+BROADCAST_STATUS_LABELS = {
+    BROADCAST_RUNNING: "идёт",
+    BROADCAST_PAUSED: "на паузе",
+    BROADCAST_CANCELLED: "отменена",
+    BROADCAST_DONE: "завершена",
+}
+
+# id рассылки -> задача, которая её выполняет в этом процессе
+BROADCAST_TASKS: dict = {}
+_broadcasts_stopping = False
+
+
+def format_broadcast_progress(broadcast: dict) -> str:
+    done = broadcast["sent"] + broadcast["failed"]
+    total = max(broadcast["total"], done)
+    percent = (done / total * 100) if total else 100.0
+    status = BROADCAST_STATUS_LABELS.get(broadcast["status"], broadcast["status"])
+    text = (
+        f"📢 <b>Рассылка #{broadcast['id']}</b> — {status}\n\n"
+        f"Обработано: <b>{done}</b> из {total} ({percent:.0f}%)\n"
+        f"Отправлено: <b>{broadcast['sent']}</b>\n"
+        f"Не удалось отправить: <b>{broadcast['failed']}</b>"
     )
-    kb.add(
-        types.InlineKeyboardButton(
-            "Связаться с отправителем",
-            url=f"tg://user?id={sender_id}",
+    if broadcast["status"] in (BROADCAST_RUNNING, BROADCAST_PAUSED):
+        text += (
+            "\n\n"
+            f"/broadcast_pause {broadcast['id']} · "
+            f"/broadcast_resume {broadcast['id']} · "
+            f"/broadcast_cancel {broadcast['id']}"
         )
-    )
-    return kb
+    return text
 
 
-def admin_inline_keyboard(sender_id: int):
-    kb = types.InlineKeyboardMarkup()
-    kb.add(
-        types.InlineKeyboardButton(
-            "Отправитель", url=f"tg://user?id={sender_id}"
+async def update_broadcast_progress(broadcast: dict):
+    if not broadcast["progress_msg_id"]:
+        return
+    try:
+        await OUTBOUND.send(
+            bot.edit_message_text,
+            chat_id=broadcast["admin_chat_id"],
+            message_id=broadcast["progress_msg_id"],
+            text=format_broadcast_progress(broadcast),
         )
-    )
-    return kb
+    except exceptions.MessageNotModified:
+        pass
+    except Exception as e:
+        logging.warning(f"Не удалось обновить прогресс рассылки #{broadcast['id']}: {e}")
 
 
-def user_ticket_inline_keyboard(ticket_id: int):
-    kb = types.InlineKeyboardMarkup()
-    kb.add(
-        types.InlineKeyboardButton(
-            "Отменить заявку", callback_data=f"user_cancel_{ticket_id}"
+async def send_broadcast_message(user_id: int, text: str) -> bool:
+    try:
+        await OUTBOUND.send(
+            bot.send_message,
+            chat_id=user_id,
+            text="📢 <b>Объявление техподдержки:</b>\n\n" + text,
+            priority=PRIORITY_BULK,
         )
-    )
-    return kb
+        return True
+    except Exception as e:
+        logging.warning(f"Не удалось отправить объявление пользователю {user_id}: {e}")
+        return False
 
 
-def format_ticket_text(
-    ticket_id: int,
-    store: str,
-    sender_id: int,
-    equipment: str,
-    description: str,
-    priority: str,
-    status: str,
-    sender_name: Optional[str] = None,
-    executor_name: str = "",
-    executor_id: Optional[int] = None,
-):
-    # Статус
-    if status == "Создана":
-        status_text = "Создана"
-    elif status == "Выполняется" and executor_name:
-        if executor_id:
-            status_text = (
-                f'Выполняется <a href="tg://user?id={executor_id}">{executor_name}</a>'
+async def run_broadcast(broadcast_id: int):
+    """Выполняет рассылку пачками до конца, паузы или отмены."""
+    last_progress = 0.0
+    try:
+        while not _broadcasts_stopping:
+            # Статус перечитываем перед каждой пачкой: так пауза/отмена
+            # срабатывает даже из другого процесса
+            broadcast = await run_db_read(get_broadcast, broadcast_id)
+            if broadcast is None or broadcast["status"] != BROADCAST_RUNNING:
+                break
+
+            recipients = await run_db_read(
+                get_broadcast_recipients, broadcast["last_user_id"], BROADCAST_BATCH_SIZE
             )
-        else:
-            status_text = f"Выполняется {executor_name}"
-    elif status == "Выполнена" and executor_name:
-        if executor_id:
-            status_text = (
-                f'Выполнена <a href="tg://user?id={executor_id}">{executor_name}</a>'
+            if not recipients:
+                await run_db_write(
+                    set_broadcast_status,
+                    broadcast_id,
+                    BROADCAST_DONE,
+                    (BROADCAST_RUNNING,),
+                )
+                break
+
+            results = await asyncio.gather(
+                *(send_broadcast_message(uid, broadcast["text"]) for uid in recipients)
             )
-        else:
-            status_text = f"Выполнена {executor_name}"
-    elif status == "Аннулирована пользователем":
-        status_text = "Аннулирована пользователем"
-    else:
-        status_text = status
-
-    sender_label = sender_name or "Отправитель"
-
-    # Адрес магазина + ссылки на карты
-    address_line = ""
-    if store and STORE_ADDRESS_MAP:
-        address = STORE_ADDRESS_MAP.get(str(store).strip())
-        if address:
-            q = quote_plus(address)
-            yandex_url = f"https://yandex.ru/maps/?text={q}"
-            google_url = f"https://maps.google.com/?q={q}"
-            dgis_url = f"https://2gis.ru/search/{q}"
-            address_line = (
-                f"<b>Адрес:</b> {address}\n"
-                f"Открыть в: "
-                f'<a href="{yandex_url}">Яндекс</a> | '
-                f'<a href="{dgis_url}">2ГИС</a> | '
-                f'<a href="{google_url}">Google</a>\n'
+            sent = sum(1 for ok in results if ok)
+            await run_db_write(
+                save_broadcast_checkpoint,
+                broadcast_id,
+                recipients[-1],
+                sent,
+                len(results) - sent,
             )
 
-    text = (
-        f"#{ticket_id}\n"
-        f"<b>Магазин:</b> {store} / "
-        f'<a href="tg://user?id={sender_id}">{sender_label}</a>\n'
-        f"{address_line}"
-        f"<b>Оборудование:</b> {equipment}\n"
-        f"<b>Описание:</b> {description}\n"
-        f"<b>Срочность:</b> {priority}\n"
-        f"<b>Статус:</b> {status_text}\n"
-    )
-    return text
+            if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                broadcast = await run_db_read(get_broadcast, broadcast_id)
+                await update_broadcast_progress(broadcast)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logging.exception(f"Рассылка #{broadcast_id} прервана ошибкой: {e}")
+    finally:
+        BROADCAST_TASKS.pop(broadcast_id, None)
+
+    broadcast = await run_db_read(get_broadcast, broadcast_id)
+    if broadcast is not None:
+        await update_broadcast_progress(broadcast)
+        logging.info(
+            f"Рассылка #{broadcast_id}: {broadcast['status']}, "
+            f"отправлено {broadcast['sent']}, ошибок {broadcast['failed']}"
+        )
 
 
-# ============ СЛУЖЕБНЫЕ ПРОВЕРКИ ============
+def start_broadcast_task(broadcast_id: int):
+    if broadcast_id not in BROADCAST_TASKS:
+        BROADCAST_TASKS[broadcast_id] = asyncio.create_task(
+            run_broadcast(broadcast_id), context=detached_context()
+        )
 
-def is_admin(user_id: int) -> bool:
-    return user_id in ADMIN_USER_IDS
+
+async def resume_broadcasts():
+    """После перезапуска продолжаем рассылки, которые не были завершены."""
+    for broadcast in await run_db_read(get_broadcasts_by_status, (BROADCAST_RUNNING,)):
+        logging.info(
+            f"Продолжаем рассылку #{broadcast['id']} после user_id {broadcast['last_user_id']}"
+        )
+        start_broadcast_task(broadcast["id"])
 
 
-def is_tech(user_id: int) -> bool:
-    return user_id in TECH_USER_IDS
+async def stop_broadcasts(timeout: float = 10):
+    """Даёт текущим пачкам дойти до чекпоинта, остальное — после рестарта."""
+    global _broadcasts_stopping
+    _broadcasts_stopping = True
+    tasks = list(BROADCAST_TASKS.values())
+    if not tasks:
+        return
+    _, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
 
 
-async def cancel_creation(message: types.Message, state: FSMContext):
-    await state.finish()
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add(types.KeyboardButton("📝 Новая заявка"))
-    await message.answer("Создание заявки отменено.", reply_markup=kb)
+# ============ АЛЬБОМЫ ФОТО ============
+
+# Telegram присылает альбом отдельными сообщениями с общим media_group_id.
+# Ждём, пока части перестанут приходить, и собираем их в одну заявку.
+ALBUM_COLLECT_SECONDS = float(os.getenv("ALBUM_COLLECT_SECONDS", "1.0"))
+# Больше 10 фото в одном send_media_group Telegram не принимает
+ALBUM_MAX_PHOTOS = 10
+# Собранный альбом помним ещё немного, чтобы опоздавшие части не создали
+# вторую заявку; после этого запись удаляется
+MEDIA_GROUP_TTL_SECONDS = float(os.getenv("MEDIA_GROUP_TTL_SECONDS", "120"))
+MEDIA_GROUP_BUFFER_SIZE = int(os.getenv("MEDIA_GROUP_BUFFER_SIZE", "1000"))
+
+
+class MediaGroupBuffer:
+    """
+    Буфер частей альбомов с ограничением по размеру и времени жизни.
+
+    add() не блокирует хэндлер: первая часть заводит таймер, каждая
+    следующая его перезапускает. Когда части перестали приходить,
+    on_complete(photo_ids) запускается фоновой задачей.
+    """
+
+    def __init__(self, collect_seconds: float, ttl: float, maxsize: int):
+        self.collect_seconds = collect_seconds
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._groups: "OrderedDict[str, dict]" = OrderedDict()
+        self.completed = 0
+        self.late_parts = 0
+        self.evicted = 0
+
+    def add(self, media_group_id: str, message_id: int, photo_id: str, on_complete) -> bool:
+        """Добавляет часть альбома; False — альбом уже собран, часть опоздала."""
+        self._expire()
+        group = self._groups.get(media_group_id)
+        if group is None:
+            group = {
+                "parts": {},
+                "created": time.monotonic(),
+                "timer": None,
+                "done": False,
+                "on_complete": on_complete,
+            }
+            self._groups[media_group_id] = group
+            while len(self._groups) > self.maxsize:
+                _, old = self._groups.popitem(last=False)
+                if old["timer"] is not None:
+                    old["timer"].cancel()
+                self.evicted += 1
+        if group["done"]:
+            self.late_parts += 1
+            return False
+        group["parts"][message_id] = photo_id
+        if group["timer"] is not None:
+            group["timer"].cancel()
+        group["timer"] = asyncio.get_running_loop().call_later(
+            self.collect_seconds, self._complete, media_group_id
+        )
+        return True
+
+    def _complete(self, media_group_id: str):
+        group = self._groups.get(media_group_id)
+        if group is None or group["done"]:
+            return
+        group["done"] = True
+        group["timer"] = None
+        # Части могли прийти не по порядку — сортируем по message_id
+        photo_ids = [group["parts"][mid] for mid in sorted(group["parts"])]
+        group["parts"] = {}
+        on_complete, group["on_complete"] = group["on_complete"], None
+        self.completed += 1
+        spawn_background(on_complete(photo_ids))
+
+    def _expire(self):
+        deadline = time.monotonic() - self.ttl
+        while self._groups:
+            media_group_id, group = next(iter(self._groups.items()))
+            if group["created"] > deadline:
+                break
+            if group["timer"] is not None:
+                group["timer"].cancel()
+            del self._groups[media_group_id]
+
+    def __len__(self) -> int:
+        return len(self._groups)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._groups),
+            "maxsize": self.maxsize,
+            "completed": self.completed,
+            "late_parts": self.late_parts,
+            "evicted": self.evicted,
+        }
+
+
+MEDIA_GROUPS = MediaGroupBuffer(
+    ALBUM_COLLECT_SECONDS, MEDIA_GROUP_TTL_SECONDS, MEDIA_GROUP_BUFFER_SIZE
+)
 
 
 # ============ ХЭНДЛЕРЫ ПОЛЬЗОВАТЕЛЕЙ / РЕГИСТРАЦИЯ ============
@@ -615,14 +3068,13 @@ async def cmd_start(message: types.Message, state: FSMContext):
         )
         return
 
-    profile = get_sender_profile(user_id)
+    profile = await get_sender_profile_async(user_id)
 
     # Есть и имя, и магазин – обычный старт
     if profile and profile.get("display_name") and profile.get("store"):
         name = profile["display_name"]
         store = profile["store"]
-        kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        kb.add(types.KeyboardButton("📝 Новая заявка"))
+        kb = new_ticket_keyboard()
         await message.answer(
             f"Здравствуйте, {name}!\n\n"
             f"Ваш магазин: №{store}.\n\n"
@@ -675,7 +3127,8 @@ async def process_store_registration(message: types.Message, state: FSMContext):
 
     store = text
     # Если есть файл с магазинами — проверяем существование
-    if STORE_ADDRESS_MAP and store not in STORE_ADDRESS_MAP:
+    stores = CONFIG.stores
+    if stores and store not in stores:
         await message.answer(
             "Такой номер магазина не найден в списке.\n"
             "Проверьте номер и введите ещё раз.\n\n"
@@ -687,12 +3140,11 @@ async def process_store_registration(message: types.Message, state: FSMContext):
     name = data.get("name") or "Без имени"
 
     user_id = message.from_user.id
-    set_sender_profile(user_id, name, store)
+    await set_sender_profile_async(user_id, name, store)
     await state.finish()
 
     # Клавиатура с "Новая заявка"
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add(types.KeyboardButton("📝 Новая заявка"))
+    kb = new_ticket_keyboard()
 
     await message.answer(
         f"Готово, {name}!\n"
@@ -704,21 +3156,19 @@ async def process_store_registration(message: types.Message, state: FSMContext):
 
     # Уведомляем админов о новой регистрации
     for admin_id in ADMIN_USER_IDS:
-        try:
-            await bot.send_message(
-                admin_id,
-                "🆕 Новая регистрация пользователя:\n"
-                f"Имя: {name}\n"
-                f"Магазин: №{store}\n"
-                f"Telegram ID: <code>{user_id}</code>",
-            )
-        except Exception as e:
-            logging.warning(f"Не удалось уведомить админа {admin_id} о новой регистрации: {e}")
+        notify_in_background(
+            admin_id,
+            "🆕 Новая регистрация пользователя:\n"
+            f"Имя: {name}\n"
+            f"Магазин: №{store}\n"
+            f"Telegram ID: <code>{user_id}</code>",
+            f"уведомить админа {admin_id} о новой регистрации",
+        )
 
 
 # ============ СОЗДАНИЕ ЗАЯВКИ ============
 
-@dp.message_handler(lambda m: m.text == "📝 Новая заявка")
+@dp.message_handler(lambda m: m.text == NEW_TICKET_TEXT)
 async def new_ticket(message: types.Message, state: FSMContext):
     """Старт создания новой заявки."""
     user_id = message.from_user.id
@@ -728,7 +3178,7 @@ async def new_ticket(message: types.Message, state: FSMContext):
         await message.answer("Создание заявок доступно только для магазинов (продавцов).")
         return
 
-    profile = get_sender_profile(user_id)
+    profile = await get_sender_profile_async(user_id)
     if not profile or not profile.get("display_name") or not profile.get("store"):
         # Пользователь еще не зарегистрирован или не указан магазин
         await message.answer(
@@ -854,7 +3304,7 @@ async def process_priority(message: types.Message, state: FSMContext):
     await TicketForm.next()
     kb = photo_keyboard()
     await message.answer(
-        "Пришлите фото/скрин проблемы (если есть).\n"
+        "Пришлите фото/скрин проблемы (если есть), можно несколько одним альбомом.\n"
         "Например, экран с ошибкой, фото весов или камеры.\n"
         f"Если фото не нужно — нажмите «{NO_PHOTO_TEXT}».\n\n"
         f"В любой момент можно нажать «{BACK_TEXT}» или «{CANCEL_TEXT}».",
@@ -881,26 +3331,24 @@ async def process_photo(message: types.Message, state: FSMContext):
             )
             return
 
-    # Если пользователь отправил альбом (несколько фото одним пакетом)
+    # Альбом (несколько фото одним пакетом): части собирает MEDIA_GROUPS,
+    # заявку создаст submit_ticket, когда придёт последняя часть
     if message.media_group_id:
-        # Чтобы не спамить, реагируем только один раз на этот media_group_id
-        if message.media_group_id not in RECENT_MEDIA_GROUPS:
-            RECENT_MEDIA_GROUPS.add(message.media_group_id)
-            await message.answer(
-                "Сейчас бот принимает только одно фото в одном сообщении.\n"
-                "Пожалуйста, отправьте одно ключевое фото или сделайте коллаж.",
+        if message.photo:
+            MEDIA_GROUPS.add(
+                message.media_group_id,
+                message.message_id,
+                message.photo[-1].file_id,
+                lambda photo_ids: submit_ticket(message, state, photo_ids),
             )
         return
 
-    data = await state.get_data()
-
-    photo_id = None
     if message.photo:
-        photo_id = message.photo[-1].file_id
+        photo_ids = [message.photo[-1].file_id]
     elif message.text and (
         message.text.lower().strip() == "нет" or message.text.strip() == NO_PHOTO_TEXT
     ):
-        photo_id = None
+        photo_ids = []
     else:
         await message.answer(
             f"Пришлите фото или нажмите «{NO_PHOTO_TEXT}», если фото не требуется.\n"
@@ -908,11 +3356,24 @@ async def process_photo(message: types.Message, state: FSMContext):
         )
         return
 
+    await submit_ticket(message, state, photo_ids)
+
+
+async def submit_ticket(message: types.Message, state: FSMContext, photo_ids: list):
+    """Создаёт заявку из черновика TicketForm с приложенными фото."""
+    # Пока собирался альбом, пользователь мог отменить заявку или
+    # продолжить без фото — тогда черновика уже нет
+    if await state.get_state() != TicketForm.photo.state:
+        return
+    data = await state.get_data()
     await state.finish()
 
+    if len(photo_ids) > ALBUM_MAX_PHOTOS:
+        photo_ids = photo_ids[:ALBUM_MAX_PHOTOS]
+
     sender = message.from_user
     sender_id = sender.id
-    profile = get_sender_profile(sender_id)
+    profile = await get_sender_profile_async(sender_id)
 
     if profile:
         store = profile.get("store") or "не указан"
@@ -925,77 +3386,28 @@ async def process_photo(message: types.Message, state: FSMContext):
     description = data["description"]
     priority = data["priority"]
 
-    ticket_id = get_next_ticket_id()
-    status = "Создана"
-
-    text = format_ticket_text(
-        ticket_id=ticket_id,
-        store=store,
-        sender_id=sender_id,
-        equipment=equipment,
-        description=description,
-        priority=priority,
-        status=status,
-        sender_name=sender_name,
-    )
-
-    # В чат руководства
-    admin_kb = admin_inline_keyboard(sender_id)
-    if photo_id:
-        admin_msg = await bot.send_photo(
-            ADMIN_CHAT_ID,
-            photo=photo_id,
-            caption=text,
-            reply_markup=admin_kb,
-        )
-    else:
-        admin_msg = await bot.send_message(
-            ADMIN_CHAT_ID,
-            text,
-            reply_markup=admin_kb,
-        )
-
-    admin_msg_id = admin_msg.message_id
-
-    # Техникам в ЛС
-    tech_kb = tech_inline_keyboard(ticket_id, sender_id)
-    for tech_id in TECH_USER_IDS:
-        try:
-            if photo_id:
-                await bot.send_photo(
-                    tech_id,
-                    photo=photo_id,
-                    caption=text,
-                    reply_markup=tech_kb,
-                )
-            else:
-                await bot.send_message(
-                    tech_id,
-                    text,
-                    reply_markup=tech_kb,
-                )
-        except Exception as e:
-            logging.warning(f"Не удалось отправить технику {tech_id}: {e}")
-
-    # Запись в БД
-    create_ticket_row(
-        ticket_id=ticket_id,
+    # Заявка и уведомления руководству/техникам — одной транзакцией,
+    # сами сообщения разошлёт outbox_dispatcher()
+    ticket = await create_ticket_async(
         store=store,
         sender_id=sender_id,
         sender_name=sender_name,
         equipment=equipment,
         description=description,
         priority=priority,
-        status=status,
-        admin_msg_id=admin_msg_id,
+        photo_ids=photo_ids,
+        tech_ids=sorted(CONFIG.techs),
     )
+    ticket_id = ticket["ticket_id"]
+    wake_outbox()
 
     # Клавиатура с "Новая заявка"
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add(types.KeyboardButton("📝 Новая заявка"))
+    kb = new_ticket_keyboard()
 
+    photos_note = f"Приложено фото: {len(photo_ids)}.\n" if len(photo_ids) > 1 else ""
     await message.answer(
         f"Заявка #{ticket_id} создана.\n"
+        f"{photos_note}"
         "Если проблема решилась или заявка отправлена по ошибке, вы можете её отменить.",
         reply_markup=kb,
     )
@@ -1013,62 +3425,32 @@ async def callback_user_cancel(call: types.CallbackQuery):
     user_id = call.from_user.id
     ticket_id = int(call.data.split("_")[2])
 
-    ticket = get_ticket_data(ticket_id)
+    cancelled, ticket = await cancel_ticket_by_sender_async(ticket_id, user_id)
     if not ticket:
         await call.answer("Заявка не найдена.", show_alert=True)
         return
 
-    if ticket["sender_id"] != user_id:
-        await call.answer("Отменить заявку может только отправитель.", show_alert=True)
-        return
-
-    if ticket["status"] == "Выполнена":
-        await call.answer("Заявка уже выполнена и не может быть отменена.", show_alert=True)
-        return
-
-    if ticket["status"] == "Аннулирована пользователем":
-        await call.answer("Заявка уже аннулирована.", show_alert=True)
+    if not cancelled:
+        if ticket["sender_id"] != user_id:
+            await call.answer("Отменить заявку может только отправитель.", show_alert=True)
+        elif ticket["status"] == "Выполнена":
+            await call.answer("Заявка уже выполнена и не может быть отменена.", show_alert=True)
+        else:
+            await call.answer("Заявка уже аннулирована.", show_alert=True)
         return
 
-    update_ticket(ticket_id, status="Аннулирована пользователем")
-
-    new_text = format_ticket_text(
-        ticket_id=ticket_id,
-        store=ticket["store"],
-        sender_id=ticket["sender_id"],
-        equipment=ticket["equipment"],
-        description=ticket["description"],
-        priority=ticket["priority"],
-        status="Аннулирована пользователем",
-        sender_name=ticket["sender_name"],
-        executor_name=ticket["executor_name"] or "",
-        executor_id=ticket["executor_id"],
-    )
-
-    admin_chat_id = ADMIN_CHAT_ID
-    admin_msg_id = ticket["admin_msg_id"]
+    # Кнопки во всех копиях у техников — в фоне, не задерживая ответ
+    TECH_COPY_SYNCER.schedule(ticket["ticket_id"])
 
-    if admin_msg_id:
-        try:
-            await bot.edit_message_caption(
-                chat_id=admin_chat_id,
-                message_id=admin_msg_id,
-                caption=new_text,
-                reply_markup=admin_inline_keyboard(ticket["sender_id"]),
-            )
-        except Exception:
-            try:
-                await bot.edit_message_text(
-                    chat_id=admin_chat_id,
-                    message_id=admin_msg_id,
-                    text=new_text,
-                    reply_markup=admin_inline_keyboard(ticket["sender_id"]),
-                    disable_web_page_preview=True,
-                )
-            except Exception as e:
-                logging.warning(
-                    f"Не удалось обновить сообщение в чате руководства при отмене заявки: {e}"
-                )
+    # Сообщение в чате руководства (частые смены статуса схлопываются)
+    if ticket["admin_msg_id"]:
+        ADMIN_EDITOR.schedule(
+            ADMIN_CHAT_ID,
+            ticket["admin_msg_id"],
+            ticket["admin_msg_kind"],
+            render_ticket(ticket),
+            admin_inline_keyboard(ticket["sender_id"]),
+        )
 
     await call.answer("Заявка аннулирована.")
     await call.message.edit_reply_markup()  # убираем кнопку отмены
@@ -1076,6 +3458,14 @@ async def callback_user_cancel(call: types.CallbackQuery):
 
 # ============ CALLBACK ДЛЯ ТЕХНИКОВ ============
 
+@dp.errors_handler(exception=exceptions.InvalidQueryID)
+async def stale_callback_error(update: types.Update, error: exceptions.InvalidQueryID):
+    # Нажатие из очереди, накопившейся за время простоя: действие выполнено,
+    # а всплывающий ответ Telegram уже не принимает
+    logging.info(f"Ответ на устаревшее нажатие кнопки не отправлен: {error}")
+    return True
+
+
 @dp.callback_query_handler(lambda c: c.data.startswith("take_"))
 async def callback_take(call: types.CallbackQuery):
     user_id = call.from_user.id
@@ -1084,196 +3474,330 @@ async def callback_take(call: types.CallbackQuery):
         return
 
     ticket_id = int(call.data.split("_")[1])
-    ticket = get_ticket_data(ticket_id)
+    executor_name = await get_technician_name_async(call.from_user)
+
+    # Назначаем исполнителя и меняем статус, если заявку ещё никто не взял
+    taken, ticket = await take_ticket_async(ticket_id, user_id, executor_name)
     if not ticket:
         await call.answer("Заявка не найдена.", show_alert=True)
         return
 
-    # Если уже выполнена – не трогаем
-    if ticket["status"] == "Выполнена":
-        await call.answer("Заявка уже выполнена.", show_alert=True)
-        return
-
-    if ticket["status"] == "Аннулирована пользователем":
-        await call.answer("Заявка аннулирована отправителем.", show_alert=True)
-        return
-
-    # Если уже кто-то выполняет
-    if ticket["status"] == "Выполняется":
-        if ticket["executor_id"] == user_id:
+    if not taken:
+        if ticket["status"] == "Выполнена":
+            # Если уже выполнена – не трогаем
+            await call.answer("Заявка уже выполнена.", show_alert=True)
+        elif ticket["status"] == "Аннулирована пользователем":
+            await call.answer("Заявка аннулирована отправителем.", show_alert=True)
+        elif ticket["executor_id"] == user_id:
             await call.answer("Вы уже назначены исполнителем этой заявки.")
         else:
+            # Уже кто-то выполняет
             name = ticket["executor_name"] or "другой техник"
             await call.answer(
                 f"Заявка уже выполняется: {name}.", show_alert=True
             )
         return
 
-    executor_name = get_technician_name(call.from_user)
+    # Кнопки во всех копиях у техников — в фоне, не задерживая ответ
+    TECH_COPY_SYNCER.schedule(ticket["ticket_id"])
 
-    # Назначаем исполнителя и меняем статус
-    update_ticket(
-        ticket_id,
-        status="Выполняется",
-        executor_id=user_id,
-        executor_name=executor_name,
+    # Сообщение в чате руководства (частые смены статуса схлопываются)
+    if ticket["admin_msg_id"]:
+        ADMIN_EDITOR.schedule(
+            ADMIN_CHAT_ID,
+            ticket["admin_msg_id"],
+            ticket["admin_msg_kind"],
+            render_ticket(ticket),
+            admin_inline_keyboard(ticket["sender_id"]),
+        )
+
+    # Уведомляем отправителя, что заявка принята
+    executor_link = f'<a href="tg://user?id={user_id}">{executor_name}</a>'
+    notify_in_background(
+        ticket["sender_id"],
+        f"Ваша заявка #{ticket_id} принята в работу.\n"
+        f"Исполнитель: {executor_link}.\n\n"
+        "Если появились новые детали — можно написать ответом на это сообщение.",
+        "уведомить отправителя о принятии заявки",
     )
 
-    new_text = format_ticket_text(
-        ticket_id=ticket_id,
-        store=ticket["store"],
-        sender_id=ticket["sender_id"],
-        equipment=ticket["equipment"],
-        description=ticket["description"],
-        priority=ticket["priority"],
-        status="Выполняется",
-        sender_name=ticket["sender_name"],
-        executor_name=executor_name,
-        executor_id=user_id,
+    await call.answer("Заявка взята в работу.")
+    await call.message.reply("Вы назначены исполнителем этой заявки.")
+
+
+@dp.callback_query_handler(lambda c: c.data.startswith("done_"))
+async def callback_done(call: types.CallbackQuery):
+    user_id = call.from_user.id
+    if not is_tech(user_id):
+        await call.answer("Только для техников.", show_alert=True)
+        return
+
+    ticket_id = int(call.data.split("_")[1])
+    executor_name = await get_technician_name_async(call.from_user)
+
+    # Закрыть может только назначенный исполнитель заявки в работе
+    completed, ticket = await complete_ticket_async(ticket_id, user_id, executor_name)
+    if not ticket:
+        await call.answer("Заявка не найдена.", show_alert=True)
+        return
+
+    if not completed:
+        if ticket["status"] == "Выполнена":
+            await call.answer("Заявка уже отмечена как выполненная.", show_alert=True)
+        elif ticket["status"] == "Аннулирована пользователем":
+            await call.answer("Заявка аннулирована отправителем.", show_alert=True)
+        elif ticket["executor_id"] and ticket["executor_id"] != user_id:
+            name = ticket["executor_name"] or "другой техник"
+            await call.answer(
+                f"Эту заявку сейчас выполняет {name}. Только он может её завершить.",
+                show_alert=True,
+            )
+        else:
+            # Ещё никто не взял заявку
+            await call.answer(
+                "Сначала возьмите заявку в работу (кнопка «Принять»).",
+                show_alert=True,
+            )
+        return
+
+    # Кнопки во всех копиях у техников — в фоне, не задерживая ответ
+    TECH_COPY_SYNCER.schedule(ticket["ticket_id"])
+
+    # Сообщение в чате руководства (частые смены статуса схлопываются)
+    if ticket["admin_msg_id"]:
+        ADMIN_EDITOR.schedule(
+            ADMIN_CHAT_ID,
+            ticket["admin_msg_id"],
+            ticket["admin_msg_kind"],
+            render_ticket(ticket),
+            admin_inline_keyboard(ticket["sender_id"]),
+        )
+
+    # Уведомим отправителя
+    executor_link = f'<a href="tg://user?id={user_id}">{executor_name}</a>'
+    notify_in_background(
+        ticket["sender_id"],
+        f"Ваша заявка #{ticket_id} отмечена как выполненная.\n"
+        f"Исполнитель: {executor_link}.\n"
+        "Если проблема осталась — создайте новую заявку или ответьте технику.",
+        "уведомить отправителя о выполнении заявки",
     )
 
-    admin_chat_id = ADMIN_CHAT_ID
-    admin_msg_id = ticket["admin_msg_id"]
+    await call.answer("Заявка отмечена как выполненная.")
+    await call.message.reply("Заявка закрыта.")
+
+
+# ============ ПРОФИЛИРОВАНИЕ ============
+
+# Обновления, обработанные дольше этого, попадают в лог с разбивкой по фазам
+SLOW_UPDATE_SECONDS = float(os.getenv("SLOW_UPDATE_SECONDS", "1.0"))
 
-    # Обновляем сообщение в чате руководства
-    if admin_msg_id:
-        try:
-            await bot.edit_message_caption(
-                chat_id=admin_chat_id,
-                message_id=admin_msg_id,
-                caption=new_text,
-                reply_markup=admin_inline_keyboard(ticket["sender_id"]),
-            )
-        except Exception:
-            try:
-                await bot.edit_message_text(
-                    chat_id=admin_chat_id,
-                    message_id=admin_msg_id,
-                    text=new_text,
-                    reply_markup=admin_inline_keyboard(ticket["sender_id"]),
-                    disable_web_page_preview=True,
-                )
-            except Exception as e:
-                logging.warning(
-                    f"Не удалось обновить сообщение в чате руководства: {e}"
-                )
+# /profile N: длительность по умолчанию и предел, строк в отчёте
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 600
+PROFILE_TOP = 60
 
-    # Уведомляем отправителя, что заявка принята
-    try:
-        executor_link = f'<a href="tg://user?id={user_id}">{executor_name}</a>'
-        await bot.send_message(
-            ticket["sender_id"],
-            f"Ваша заявка #{ticket_id} принята в работу.\n"
-            f"Исполнитель: {executor_link}.\n\n"
-            "Если появились новые детали — можно написать ответом на это сообщение.",
-        )
-    except Exception as e:
-        logging.warning(f"Не удалось уведомить отправителя о принятии заявки: {e}")
+# /memsnap: глубина стеков tracemalloc и строк в отчёте
+MEMSNAP_FRAMES = 10
+MEMSNAP_TOP = 40
 
-    await call.answer("Заявка взята в работу.")
-    await call.message.reply("Вы назначены исполнителем этой заявки.")
 
+class UpdateProfilerMiddleware(BaseMiddleware):
+    """
+    Замеряет обработку каждого обновления целиком. Если она заняла больше
+    threshold секунд, пишет в лог, сколько из этого ушло на БД, отрисовку
+    текста заявок и Bot API (суммарно по вызовам) и какой хэндлер сработал.
+    """
 
-@dp.callback_query_handler(lambda c: c.data.startswith("done_"))
-async def callback_done(call: types.CallbackQuery):
-    user_id = call.from_user.id
-    if not is_tech(user_id):
-        await call.answer("Только для техников.", show_alert=True)
-        return
+    def __init__(self, threshold: float = SLOW_UPDATE_SECONDS):
+        super().__init__()
+        self.threshold = threshold
+        self.slow = 0
 
-    ticket_id = int(call.data.split("_")[1])
-    ticket = get_ticket_data(ticket_id)
-    if not ticket:
-        await call.answer("Заявка не найдена.", show_alert=True)
-        return
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        # Каждое обновление обрабатывается в своей задаче (LaneDispatcher),
+        # поэтому значение видно только ей и её дочерним задачам
+        UPDATE_PHASES.set({"started": time.perf_counter()})
 
-    # Если ещё никто не взял заявку
-    if ticket["status"] == "Создана" and not ticket["executor_id"]:
-        await call.answer(
-            "Сначала возьмите заявку в работу (кнопка «Принять»).",
-            show_alert=True,
-        )
-        return
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        phases = UPDATE_PHASES.get()
+        if phases is None:
+            return
+        total = time.perf_counter() - phases["started"]
+        if total < self.threshold:
+            return
+        self.slow += 1
+        logging.warning(format_slow_update(update.update_id, total, phases))
+
+
+def format_slow_update(update_id: int, total: float, phases: dict) -> str:
+    parts = []
+    accounted = 0.0
+    for phase, label in (("db", "БД"), ("render", "отрисовка"), ("api", "Bot API")):
+        seconds = phases.get(phase, 0.0)
+        accounted += seconds
+        parts.append(f"{label} {seconds * 1000:.0f} мс ({phases.get(f'{phase}_calls', 0)})")
+    parts.append(f"прочее {max(total - accounted, 0.0) * 1000:.0f} мс")
+    handler = phases.get("handler", "без хэндлера")
+    return (
+        f"Медленное обновление {update_id} ({handler}): {total * 1000:.0f} мс — "
+        + ", ".join(parts)
+    )
 
-    # Если уже выполнена
-    if ticket["status"] == "Выполнена":
-        await call.answer("Заявка уже отмечена как выполненная.", show_alert=True)
-        return
 
-    if ticket["status"] == "Аннулирована пользователем":
-        await call.answer("Заявка аннулирована отправителем.", show_alert=True)
-        return
+UPDATE_PROFILER = UpdateProfilerMiddleware()
+dp.middleware.setup(UPDATE_PROFILER)
 
-    # Разрешаем закрывать только назначенному исполнителю
-    if ticket["executor_id"] and ticket["executor_id"] != user_id:
-        name = ticket["executor_name"] or "другой техник"
-        await call.answer(
-            f"Эту заявку сейчас выполняет {name}. Только он может её завершить.",
-            show_alert=True,
-        )
-        return
 
-    executor_name = get_technician_name(call.from_user)
+async def _send_text_document(
+    chat_id: int, filename: str, text: str, caption: Optional[str] = None
+):
+    # Файл собирается заново на каждую попытку: поток InputFile читается один раз
+    document = types.InputFile(io.BytesIO(text.encode("utf-8")), filename=filename)
+    return await bot.send_document(chat_id, document, caption=caption)
 
-    update_ticket(
-        ticket_id,
-        status="Выполнена",
-        executor_id=user_id,
-        executor_name=executor_name,
-    )
 
-    new_text = format_ticket_text(
-        ticket_id=ticket_id,
-        store=ticket["store"],
-        sender_id=ticket["sender_id"],
-        equipment=ticket["equipment"],
-        description=ticket["description"],
-        priority=ticket["priority"],
-        status="Выполнена",
-        sender_name=ticket["sender_name"],
-        executor_name=executor_name,
-        executor_id=user_id,
+async def send_text_document(
+    chat_id: int, filename: str, text: str, caption: Optional[str] = None
+):
+    """Отправляет текст файлом через очередь исходящих."""
+    await OUTBOUND.send(
+        _send_text_document, chat_id=chat_id, filename=filename, text=text, caption=caption
     )
 
-    admin_chat_id = ADMIN_CHAT_ID
-    admin_msg_id = ticket["admin_msg_id"]
 
-    if admin_msg_id:
-        try:
-            await bot.edit_message_caption(
-                chat_id=admin_chat_id,
-                message_id=admin_msg_id,
-                caption=new_text,
-                reply_markup=admin_inline_keyboard(ticket["sender_id"]),
-            )
-        except Exception:
-            try:
-                await bot.edit_message_text(
-                    chat_id=admin_chat_id,
-                    message_id=admin_msg_id,
-                    text=new_text,
-                    reply_markup=admin_inline_keyboard(ticket["sender_id"]),
-                    disable_web_page_preview=True,
-                )
-            except Exception as e:
-                logging.warning(
-                    f"Не удалось обновить сообщение в чате руководства: {e}"
-                )
+# ---- cProfile по команде /profile ----
 
-    # Уведомим отправителя
+_profile_task: Optional[asyncio.Task] = None
+
+
+def format_profile(profiler: cProfile.Profile, seconds: float) -> str:
+    stream = io.StringIO()
+    stream.write(
+        f"Профиль цикла событий за {seconds:.0f} с, {datetime.now():%Y-%m-%d %H:%M:%S}\n"
+        f"Медленных обновлений (> {UPDATE_PROFILER.threshold:.1f} с) с запуска: "
+        f"{UPDATE_PROFILER.slow}\n\n"
+    )
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.strip_dirs()
+    stream.write(f"==== Топ-{PROFILE_TOP} по суммарному времени (cumulative) ====\n")
+    stats.sort_stats("cumulative").print_stats(PROFILE_TOP)
+    stream.write(f"\n==== Топ-{PROFILE_TOP} по собственному времени (tottime) ====\n")
+    stats.sort_stats("tottime").print_stats(PROFILE_TOP)
+    return stream.getvalue()
+
+
+async def run_profile(chat_id: int, seconds: float):
+    """Профилирует поток цикла событий seconds секунд и присылает отчёт файлом."""
+    profiler = cProfile.Profile()
+    profiler.enable()
     try:
-        executor_link = f'<a href="tg://user?id={user_id}">{executor_name}</a>'
-        await bot.send_message(
-            ticket["sender_id"],
-            f"Ваша заявка #{ticket_id} отмечена как выполненная.\n"
-            f"Исполнитель: {executor_link}.\n"
-            "Если проблема осталась — создайте новую заявку или ответьте технику.",
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+    text = await asyncio.to_thread(format_profile, profiler, seconds)
+    await send_text_document(
+        chat_id,
+        f"profile-{datetime.now():%Y%m%d-%H%M%S}.txt",
+        text,
+        caption=f"cProfile за {seconds:.0f} с",
+    )
+
+
+def start_profile(chat_id: int, seconds: float) -> bool:
+    """False — если профилирование уже идёт."""
+    global _profile_task
+    if _profile_task is not None and not _profile_task.done():
+        return False
+    _profile_task = spawn_background(run_profile(chat_id, seconds))
+    return True
+
+
+# ---- Снимки памяти по команде /memsnap ----
+
+_MEM_SNAPSHOT: Optional[tracemalloc.Snapshot] = None
+
+# Типы, в которые approx_size() не заходит: общие объекты, а не данные структуры
+_SIZE_SKIP_TYPES = (
+    type,
+    types_module.ModuleType,
+    types_module.FunctionType,
+    types_module.MethodType,
+)
+
+
+def approx_size(obj, seen: Optional[set] = None) -> int:
+    """Примерный размер объекта вместе с содержимым контейнеров, байт."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, _SIZE_SKIP_TYPES):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in list(obj.items()):
+            size += approx_size(key, seen) + approx_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        for item in list(obj):
+            size += approx_size(item, seen)
+    elif hasattr(obj, "__dict__") and not isinstance(obj, (asyncio.Task, asyncio.Handle)):
+        size += approx_size(vars(obj), seen)
+    return size
+
+
+def memory_structures() -> list:
+    """(название, элементов, примерный размер) для структур, которые растут со временем."""
+    structures = [
+        ("Альбомы (MEDIA_GROUPS)", MEDIA_GROUPS._groups),
+        ("Кэш заявок", TICKET_CACHE._data),
+        ("Кэш профилей отправителей", SENDER_CACHE._data),
+        ("Кэш имён техников", TECH_NAME_CACHE._data),
+        ("Лимиты чатов (OUTBOUND)", OUTBOUND._chat_buckets),
+        ("Линии обновлений", dp._lanes),
+        ("Отложенные правки (ADMIN_EDITOR)", ADMIN_EDITOR._pending),
+        ("Фоновые задачи", _BACKGROUND_TASKS),
+    ]
+    if FSM_STORAGE.cache is not None:
+        structures.append(("Кэш состояний FSM", FSM_STORAGE.cache._data))
+    return [(name, len(data), approx_size(data)) for name, data in structures]
+
+
+def format_memory_report(
+    snapshot: tracemalloc.Snapshot, previous: tracemalloc.Snapshot, structures: list
+) -> str:
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [
+        f"Снимок памяти {datetime.now():%Y-%m-%d %H:%M:%S}",
+        f"Отслеживается: {current / 1024 / 1024:.1f} МБ, пик {peak / 1024 / 1024:.1f} МБ",
+        "",
+        "==== Структуры бота ====",
+    ]
+    for name, count, size in structures:
+        lines.append(f"{name:<36}{count:>8} шт.{size / 1024:>12.1f} КБ")
+
+    lines += ["", f"==== Топ-{MEMSNAP_TOP} изменений с прошлого снимка (по строкам) ===="]
+    for stat in snapshot.compare_to(previous, "lineno")[:MEMSNAP_TOP]:
+        lines.append(str(stat))
+
+    lines += ["", f"==== Топ-{MEMSNAP_TOP} изменений в bot.py (по стекам) ===="]
+    own = tracemalloc.Filter(True, __file__)
+    diff = snapshot.filter_traces([own]).compare_to(previous.filter_traces([own]), "traceback")
+    for stat in diff[:MEMSNAP_TOP]:
+        lines.append(f"{stat.size_diff / 1024:+.1f} КБ, {stat.count_diff:+d} блоков")
+        lines.extend(
+            f"    {line}"
+            for line in stat.traceback.format(limit=MEMSNAP_FRAMES, most_recent_first=True)
         )
-    except Exception as e:
-        logging.warning(f"Не удалось уведомить отправителя: {e}")
+    return "\n".join(lines) + "\n"
 
-    await call.answer("Заявка отмечена как выполненная.")
-    await call.message.reply("Заявка закрыта.")
+
+def take_memory_snapshot() -> tracemalloc.Snapshot:
+    return tracemalloc.take_snapshot().filter_traces(
+        [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ]
+    )
 
 
 # ============ АДМИН-КОМАНДЫ / ПАНЕЛЬ ============
@@ -1284,39 +3808,17 @@ async def cmd_admin(message: types.Message):
         await message.answer("Эта команда доступна только администратору.")
         return
 
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-
-    cur.execute("SELECT COUNT(*) FROM senders;")
-    users_count = cur.fetchone()[0]
-
-    cur.execute("SELECT COUNT(*) FROM technicians;")
-    tech_count = cur.fetchone()[0]
-
-    cur.execute("SELECT COUNT(*) FROM tickets;")
-    tickets_total = cur.fetchone()[0]
-
-    cur.execute(
-        "SELECT status, COUNT(*) FROM tickets GROUP BY status;"
-    )
-    rows = cur.fetchall()
-    conn.close()
-
-    status_counts = {
-        "Создана": 0,
-        "Выполняется": 0,
-        "Выполнена": 0,
-        "Аннулирована пользователем": 0,
-    }
-    for status, cnt in rows:
-        if status in status_counts:
-            status_counts[status] = cnt
+    stats = await get_admin_stats_async()
+    users_count = stats["users_count"]
+    tech_count = stats["tech_count"]
+    tickets_total = stats["tickets_total"]
+    status_counts = stats["status_counts"]
 
     text = (
         "🛠 <b>Админ-панель</b>\n\n"
         f"Пользователей (продавцов): <b>{users_count}</b>\n"
         f"Техников в БД: <b>{tech_count}</b>\n"
-        f"Техников в списке техников (TECH_USER_IDS): <b>{len(TECH_USER_IDS)}</b>\n"
+        f"Техников в списке техников (techs.txt): <b>{len(CONFIG.techs)}</b>\n"
         f"Заявок всего: <b>{tickets_total}</b>\n"
         f" — Создано: <b>{status_counts['Создана']}</b>\n"
         f" — В работе: <b>{status_counts['Выполняется']}</b>\n"
@@ -1332,6 +3834,14 @@ async def cmd_admin(message: types.Message):
         "• /settechname – задать/изменить имя техника (по ответу)\n"
         "• /deluser – удалить пользователя из базы (по ответу)\n"
         "• /broadcast текст – разослать объявление всем пользователям\n"
+        "• /broadcasts – активные рассылки (пауза/продолжение/отмена)\n"
+        "• /dbstats – статистика соединений и записи в БД\n"
+        "• /reconcile_stats – пересчитать счётчики админ-панели\n"
+        "• /sendstats – очередь исходящих сообщений\n"
+        "• /lanestats – очередь входящих обновлений по чатам\n"
+        "• /profile N – профиль бота за N секунд (файлом)\n"
+        "• /memsnap – снимок памяти и разница с прошлым (/memsnap stop – выключить)\n"
+        "• /loopstats – задержка цикла событий и последние зависания\n"
         "• /wipe_db CONFIRM – <b>очистить ВСЮ базу</b> (заявки, пользователи, техники)\n"
     )
     await message.answer(text)
@@ -1343,7 +3853,7 @@ async def cmd_list_users(message: types.Message):
         await message.answer("Эта команда доступна только администратору.")
         return
 
-    users = get_all_senders(limit=15)
+    users = await get_all_senders_async(limit=15)
     if not users:
         await message.answer("Пользователей пока нет.")
         return
@@ -1368,8 +3878,9 @@ async def cmd_list_techs(message: types.Message):
         await message.answer("Эта команда доступна только администратору.")
         return
 
-    techs_db = get_all_technicians()
-    if not techs_db and not TECH_USER_IDS:
+    techs_db = await get_all_technicians_async()
+    config = CONFIG
+    if not techs_db and not config.techs:
         await message.answer("Техники пока не настроены.")
         return
 
@@ -1379,21 +3890,26 @@ async def cmd_list_techs(message: types.Message):
     for t in techs_db:
         uid = t["user_id"]
         name = t["display_name"] or "без имени"
-        mark = "✅" if uid in TECH_USER_IDS else "⚠️"
+        mark = "✅" if uid in config.techs else "⚠️"
         lines.append(
             f"{mark} ID: <code>{uid}</code>\n"
             f"Имя: {name}\n"
-            f"В списке техников: {'да' if uid in TECH_USER_IDS else 'нет'}\n"
+            f"В списке техников: {'да' if uid in config.techs else 'нет'}\n"
             "———"
         )
 
-    # Техники, которые в TECH_USER_IDS, но нет записи в БД
+    # Техники, которые есть в techs.txt, но нет записи в БД
     ids_in_db = {t["user_id"] for t in techs_db}
-    extra_ids = TECH_USER_IDS - ids_in_db
+    extra_ids = config.techs - ids_in_db
     if extra_ids:
         lines.append("Дополнительно в списке техников есть ID без имени:")
         for uid in sorted(extra_ids):
-            lines.append(f"• <code>{uid}</code> (имя не задано, используйте /settechname по ответу)")
+            comment = config.tech_comments.get(uid)
+            note = f" — {comment}" if comment else ""
+            lines.append(
+                f"• <code>{uid}</code>{note} "
+                "(имя не задано, используйте /settechname по ответу)"
+            )
 
     await message.answer("\n".join(lines))
 
@@ -1427,7 +3943,7 @@ async def cmd_setusername(message: types.Message):
     target_user = message.reply_to_message.from_user
     target_id = target_user.id
 
-    set_sender_name(target_id, args)
+    await set_sender_name_async(target_id, args)
     await message.answer(
         f"Имя пользователя <code>{target_id}</code> изменено на: <b>{args}</b>."
     )
@@ -1462,14 +3978,14 @@ async def cmd_settechname(message: types.Message):
     target_user = message.reply_to_message.from_user
     target_id = target_user.id
 
-    if target_id not in TECH_USER_IDS:
+    if target_id not in CONFIG.techs:
         await message.answer(
             "Этот пользователь не отмечен как техник (его ID нет в списке техников).\n"
             "Сначала добавьте его через /addtech."
         )
         return
 
-    set_technician_name(target_id, args)
+    await set_technician_name_async(target_id, args)
     await message.answer(
         f"Готово! Теперь техник <code>{target_id}</code> будет отображаться как: <b>{args}</b>."
     )
@@ -1478,7 +3994,7 @@ async def cmd_settechname(message: types.Message):
 @dp.message_handler(commands=["addtech"])
 async def cmd_addtech(message: types.Message):
     """
-    Добавить техника в список TECH_USER_IDS и при желании задать ему имя.
+    Добавить техника в techs.txt и при желании задать ему имя.
     Варианты использования:
     1) Ответом на сообщение техника: /addtech Илья (камеры)
     2) Без ответа: /addtech 123456789 Илья (камеры)
@@ -1522,24 +4038,23 @@ async def cmd_addtech(message: types.Message):
         await message.answer("Не удалось определить ID пользователя.")
         return
 
-    TECH_USER_IDS.add(target_id)
-    save_tech_ids_to_file()
+    config = await add_tech(target_id, display_name or "")
 
     if display_name:
-        set_technician_name(target_id, display_name)
+        await set_technician_name_async(target_id, display_name)
 
     await message.answer(
         "Техник добавлен.\n"
         f"ID: <code>{target_id}</code>\n"
         f"Имя: <b>{display_name or 'не задано'}</b>\n"
-        f"Техников в списке: <b>{len(TECH_USER_IDS)}</b>"
+        f"Техников в списке: <b>{len(config.techs)}</b>"
     )
 
 
 @dp.message_handler(commands=["deltech"])
 async def cmd_deltech(message: types.Message):
     """
-    Удалить техника из списка TECH_USER_IDS.
+    Удалить техника из techs.txt.
     Варианты:
     1) По ответу: /deltech
     2) По ID: /deltech 123456789
@@ -1562,14 +4077,13 @@ async def cmd_deltech(message: types.Message):
             return
         target_id = int(args)
 
-    if target_id not in TECH_USER_IDS:
+    if target_id not in CONFIG.techs:
         await message.answer(
             f"ID <code>{target_id}</code> не значится в списке техников."
         )
         return
 
-    TECH_USER_IDS.remove(target_id)
-    save_tech_ids_to_file()
+    await remove_tech(target_id)
 
     await message.answer(
         f"ID <code>{target_id}</code> удалён из списка техников.\n"
@@ -1579,15 +4093,17 @@ async def cmd_deltech(message: types.Message):
 
 @dp.message_handler(commands=["reloadtechs"])
 async def cmd_reloadtechs(message: types.Message):
-    """Перечитать список техников из файла techs.txt."""
+    """Перечитать techs.txt и stores.txt, не дожидаясь наблюдателя."""
     if not is_admin(message.from_user.id):
         await message.answer("Эта команда доступна только администратору.")
         return
 
-    load_tech_ids_from_file()
+    await reload_config(force=True)
+    config = CONFIG
     await message.answer(
         f"Список техников перечитан из файла.\n"
-        f"Техников в списке: <b>{len(TECH_USER_IDS)}</b>"
+        f"Техников в списке: <b>{len(config.techs)}</b>\n"
+        f"Магазинов в списке: <b>{len(config.stores)}</b>"
     )
 
 
@@ -1607,7 +4123,7 @@ async def cmd_deluser(message: types.Message):
     target_user = message.reply_to_message.from_user
     target_id = target_user.id
 
-    delete_sender(target_id)
+    await delete_sender_async(target_id)
     await message.answer(
         f"Пользователь с ID <code>{target_id}</code> удалён из базы отправителей.\n"
         "Его заявки в таблице заявок сохранены."
@@ -1630,32 +4146,312 @@ async def cmd_broadcast(message: types.Message):
         )
         return
 
-    users = get_all_senders()
-    if not users:
+    broadcast = await run_db_write(create_broadcast, text, message.chat.id)
+    if not broadcast["total"]:
+        await run_db_write(
+            set_broadcast_status, broadcast["id"], BROADCAST_DONE, (BROADCAST_RUNNING,)
+        )
         await message.answer("В базе нет ни одного пользователя для рассылки.")
         return
 
-    sent = 0
-    failed = 0
+    progress = await message.answer(format_broadcast_progress(broadcast))
+    await run_db_write(set_broadcast_progress_msg, broadcast["id"], progress.message_id)
+    start_broadcast_task(broadcast["id"])
 
-    for u in users:
-        try:
-            await bot.send_message(
-                u["user_id"],
-                "📢 <b>Объявление техподдержки:</b>\n\n" + text,
-            )
-            sent += 1
-        except Exception as e:
-            logging.warning(f"Не удалось отправить объявление пользователю {u['user_id']}: {e}")
-            failed += 1
 
+def _parse_broadcast_id(message: types.Message) -> Optional[int]:
+    args = message.get_args().strip()
+    return int(args) if args.isdigit() else None
+
+
+async def _change_broadcast_status(
+    message: types.Message, status: str, from_statuses, done_text: str
+):
+    if not is_admin(message.from_user.id):
+        await message.answer("Эта команда доступна только администратору.")
+        return
+
+    broadcast_id = _parse_broadcast_id(message)
+    if broadcast_id is None:
+        await message.answer(
+            "Укажите номер рассылки, например: <code>/broadcast_pause 3</code>\n"
+            "Список рассылок: /broadcasts"
+        )
+        return
+
+    changed, broadcast = await run_db_write(
+        set_broadcast_status, broadcast_id, status, from_statuses
+    )
+    if broadcast is None:
+        await message.answer(f"Рассылка #{broadcast_id} не найдена.")
+        return
+    if not changed:
+        label = BROADCAST_STATUS_LABELS.get(broadcast["status"], broadcast["status"])
+        await message.answer(f"Рассылка #{broadcast_id} сейчас {label}, команда не применима.")
+        return
+
+    if status == BROADCAST_RUNNING:
+        start_broadcast_task(broadcast_id)
+    await update_broadcast_progress(broadcast)
+    await message.answer(done_text.format(id=broadcast_id))
+
+
+@dp.message_handler(commands=["broadcast_pause"])
+async def cmd_broadcast_pause(message: types.Message):
+    await _change_broadcast_status(
+        message, BROADCAST_PAUSED, (BROADCAST_RUNNING,), "Рассылка #{id} поставлена на паузу."
+    )
+
+
+@dp.message_handler(commands=["broadcast_resume"])
+async def cmd_broadcast_resume(message: types.Message):
+    await _change_broadcast_status(
+        message, BROADCAST_RUNNING, (BROADCAST_PAUSED,), "Рассылка #{id} продолжена."
+    )
+
+
+@dp.message_handler(commands=["broadcast_cancel"])
+async def cmd_broadcast_cancel(message: types.Message):
+    await _change_broadcast_status(
+        message,
+        BROADCAST_CANCELLED,
+        (BROADCAST_RUNNING, BROADCAST_PAUSED),
+        "Рассылка #{id} отменена.",
+    )
+
+
+@dp.message_handler(commands=["broadcasts"])
+async def cmd_broadcasts(message: types.Message):
+    """Список незавершённых рассылок."""
+    if not is_admin(message.from_user.id):
+        await message.answer("Эта команда доступна только администратору.")
+        return
+
+    active = await run_db_read(
+        get_broadcasts_by_status, (BROADCAST_RUNNING, BROADCAST_PAUSED)
+    )
+    if not active:
+        await message.answer("Активных рассылок нет.")
+        return
+
+    await message.answer("\n\n———\n\n".join(format_broadcast_progress(b) for b in active))
+
+
+def format_cache_stats(cache: LRUCache) -> str:
+    stats = cache.stats()
+    return (
+        f"Записей: <b>{stats['size']}</b> из {stats['maxsize']}\n"
+        f"Попаданий: <b>{stats['hits']}</b>, промахов: <b>{stats['misses']}</b> "
+        f"({stats['hit_rate'] * 100:.1f}% попаданий), вытеснено: {stats['evictions']}"
+    )
+
+
+def format_fsm_storage_stats(storage: SQLiteStorage) -> str:
+    cache = format_cache_stats(storage.cache) if storage.cache else "Кэш в памяти выключен"
+    return (
+        f"{cache}\n"
+        f"Время жизни: {storage.ttl // 3600} ч, удалено протухших: <b>{storage.expired}</b>"
+    )
+
+
+@dp.message_handler(commands=["dbstats"])
+async def cmd_dbstats(message: types.Message):
+    """Счётчики пула соединений с БД."""
+    if not is_admin(message.from_user.id):
+        await message.answer("Эта команда доступна только администратору.")
+        return
+
+    stats = DB_POOL.stats()
+    writer = DB_WRITER.stats()
+    await message.answer(
+        "🗄 <b>Соединения с БД</b>\n\n"
+        f"Открыто соединений: <b>{stats['opened']}</b>\n"
+        f"Переиспользований: <b>{stats['reused']}</b>\n"
+        f"Среднее время открытия: <b>{stats['avg_open_ms']:.2f} мс</b>\n"
+        f"Сэкономлено (оценка): <b>{stats['saved_ms']:.0f} мс</b>\n\n"
+        "✍️ <b>Групповая запись</b>\n\n"
+        f"В очереди: <b>{writer['queue_depth']}</b>\n"
+        f"Транзакций: <b>{writer['batches']}</b>, операций: <b>{writer['ops']}</b> "
+        f"(ошибок: {writer['failed_ops']})\n"
+        f"Размер пачки: в среднем <b>{writer['avg_batch']:.1f}</b>, максимум <b>{writer['max_batch']}</b>\n"
+        f"Коммит: в среднем <b>{writer['avg_commit_ms']:.1f} мс</b>, "
+        f"последний {writer['last_commit_ms']:.1f} мс, максимум {writer['max_commit_ms']:.1f} мс\n\n"
+        "🗂 <b>Кэш заявок</b>\n\n"
+        f"{format_cache_stats(TICKET_CACHE)}\n\n"
+        "👤 <b>Кэш профилей отправителей</b>\n\n"
+        f"{format_cache_stats(SENDER_CACHE)}\n\n"
+        "🧑‍🔧 <b>Кэш имён техников</b>\n\n"
+        f"{format_cache_stats(TECH_NAME_CACHE)}\n\n"
+        "📝 <b>Черновики (состояния FSM)</b>\n\n"
+        f"{format_fsm_storage_stats(FSM_STORAGE)}"
+    )
+
+
+@dp.message_handler(commands=["sendstats"])
+async def cmd_sendstats(message: types.Message):
+    """Состояние очереди исходящих сообщений."""
+    if not is_admin(message.from_user.id):
+        await message.answer("Эта команда доступна только администратору.")
+        return
+
+    stats = OUTBOUND.stats()
+    editor = ADMIN_EDITOR.stats()
+    copies = TECH_COPY_SYNCER.stats()
+    albums = MEDIA_GROUPS.stats()
+    await message.answer(
+        "📤 <b>Исходящие сообщения</b>\n\n"
+        f"В очереди: <b>{stats['queue_depth']}</b> "
+        f"(ждут лимита: {stats['delayed']}, отправляются: {stats['in_flight']})\n"
+        f"Отправлено: <b>{stats['sent']}</b>, ошибок: <b>{stats['failed']}</b>\n"
+        f"Flood wait (429): <b>{stats['flood_waits']}</b>\n"
+        f"Задержка: p50 <b>{stats['latency_p50_ms']:.0f} мс</b>, "
+        f"p95 <b>{stats['latency_p95_ms']:.0f} мс</b>\n\n"
+        "✏️ <b>Правки сообщений руководству</b>\n\n"
+        f"Запрошено: <b>{editor['requested']}</b>, отправлено: <b>{editor['edited']}</b>, "
+        f"ждут: {editor['pending']}\n"
+        f"Копии у техников: запрошено <b>{copies['requested']}</b>, "
+        f"обновлено <b>{copies['synced']}</b>, идёт: {copies['running']}\n\n"
+        "🖼 <b>Альбомы</b>\n\n"
+        f"В буфере: <b>{albums['size']}</b> из {albums['maxsize']}, "
+        f"собрано: <b>{albums['completed']}</b>, опоздавших частей: {albums['late_parts']}, "
+        f"вытеснено: {albums['evicted']}"
+    )
+
+
+@dp.message_handler(commands=["lanestats"])
+async def cmd_lanestats(message: types.Message):
+    """Очередь входящих обновлений по линиям (чат, пользователь)."""
+    if not is_admin(message.from_user.id):
+        await message.answer("Эта команда доступна только администратору.")
+        return
+
+    stats = dp.stats()
     await message.answer(
-        f"Рассылка завершена.\n"
-        f"Отправлено: <b>{sent}</b>\n"
-        f"Не удалось отправить: <b>{failed}</b>"
+        "📥 <b>Входящие обновления</b>\n\n"
+        f"Ждут обработки: <b>{stats['pending']}</b> из {dp.max_pending}\n"
+        f"Линий: <b>{stats['lanes']}</b>, выполняются: <b>{stats['running']}</b> "
+        f"из {stats['max_concurrency']}\n"
+        f"Самая длинная линия: сейчас <b>{stats['deepest_lane']}</b>, "
+        f"максимум {stats['max_lane_depth']}\n"
+        f"Обработано: <b>{stats['processed']}</b>, ошибок: <b>{stats['errors']}</b>\n"
+        f"Ожиданий из-за переполнения: <b>{stats['backpressure_waits']}</b>\n"
+        f"Ожидание в очереди: p50 <b>{stats['wait_p50_ms']:.0f} мс</b>, "
+        f"p95 <b>{stats['wait_p95_ms']:.0f} мс</b>"
+    )
+
+
+@dp.message_handler(commands=["profile"])
+async def cmd_profile(message: types.Message):
+    """cProfile цикла событий на N секунд, отчёт приходит файлом."""
+    if not is_admin(message.from_user.id):
+        await message.answer("Эта команда доступна только администратору.")
+        return
+
+    args = message.get_args().strip()
+    if args and not args.isdigit():
+        await message.answer("Использование: /profile [секунд], например /profile 30")
+        return
+    seconds = min(int(args) if args else PROFILE_DEFAULT_SECONDS, PROFILE_MAX_SECONDS)
+    if seconds <= 0:
+        await message.answer("Длительность должна быть больше нуля.")
+        return
+
+    if not start_profile(message.chat.id, seconds):
+        await message.answer("Профилирование уже идёт, дождитесь отчёта.")
+        return
+    await message.answer(f"⏱ Профилирую {seconds} с, отчёт придёт файлом.")
+
+
+@dp.message_handler(commands=["memsnap"])
+async def cmd_memsnap(message: types.Message):
+    """Снимок памяти: разница с прошлым снимком и размеры структур бота."""
+    global _MEM_SNAPSHOT
+    if not is_admin(message.from_user.id):
+        await message.answer("Эта команда доступна только администратору.")
+        return
+
+    args = message.get_args().strip().lower()
+    if args == "stop":
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        _MEM_SNAPSHOT = None
+        await message.answer("Отслеживание памяти остановлено.")
+        return
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(MEMSNAP_FRAMES)
+        _MEM_SNAPSHOT = await asyncio.to_thread(take_memory_snapshot)
+        await message.answer(
+            "🧠 Отслеживание памяти включено, базовый снимок сделан.\n"
+            "Повторите /memsnap позже, чтобы получить разницу. "
+            "/memsnap stop – выключить (tracemalloc замедляет бота)."
+        )
+        return
+
+    snapshot = await asyncio.to_thread(take_memory_snapshot)
+    structures = memory_structures()
+    report = await asyncio.to_thread(format_memory_report, snapshot, _MEM_SNAPSHOT, structures)
+    _MEM_SNAPSHOT = snapshot
+    await send_text_document(
+        message.chat.id,
+        f"memsnap-{datetime.now():%Y%m%d-%H%M%S}.txt",
+        report,
+        caption="Снимок памяти: разница с прошлым снимком",
     )
 
 
+@dp.message_handler(commands=["loopstats"])
+async def cmd_loopstats(message: types.Message):
+    """Задержка цикла событий и последние зависания."""
+    if not is_admin(message.from_user.id):
+        await message.answer("Эта команда доступна только администратору.")
+        return
+
+    stats = LOOP_WATCHDOG.stats()
+    if not stats["running"]:
+        await message.answer("Наблюдение за циклом событий не запущено.")
+        return
+
+    lines = [
+        "🫀 <b>Цикл событий</b>\n",
+        f"Задержка: p50 <b>{stats['lag_p50_ms']:.1f} мс</b>, "
+        f"p99 <b>{stats['lag_p99_ms']:.1f} мс</b>, максимум {stats['max_lag_ms']:.0f} мс",
+        f"Зависаний дольше {stats['threshold_ms']:.0f} мс: <b>{stats['stalls']}</b> "
+        f"(без стека: {stats['uncaptured']})",
+    ]
+    if stats["recent"]:
+        lines.append("\nПоследние (стеки — в логе):")
+        for stall in reversed(stats["recent"]):
+            where = f" — {html.escape(stall['where'])}" if stall["where"] else ""
+            lines.append(
+                f"{stall['at']:%d.%m %H:%M:%S} <b>{stall['lag_ms']:.0f} мс</b> "
+                f"{html.escape(stall['handler'])}{where}"
+            )
+    await message.answer("\n".join(lines))
+
+
+@dp.message_handler(commands=["reconcile_stats"])
+async def cmd_reconcile_stats(message: types.Message):
+    """Пересчёт счётчиков админ-панели по таблицам."""
+    if not is_admin(message.from_user.id):
+        await message.answer("Эта команда доступна только администратору.")
+        return
+
+    before = await get_admin_stats_async()
+    await rebuild_stats_counters_async()
+    after = await get_admin_stats_async()
+
+    if before == after:
+        await message.answer("Счётчики пересчитаны, расхождений нет.")
+    else:
+        await message.answer(
+            "Счётчики пересчитаны и исправлены.\n"
+            f"Заявок всего: <b>{before['tickets_total']}</b> → <b>{after['tickets_total']}</b>\n"
+            f"Пользователей: <b>{before['users_count']}</b> → <b>{after['users_count']}</b>\n"
+            f"Техников в БД: <b>{before['tech_count']}</b> → <b>{after['tech_count']}</b>"
+        )
+
+
 @dp.message_handler(commands=["wipe_db"])
 async def cmd_wipe_db(message: types.Message):
     """Полная очистка БД (заявки, пользователи, техники). Требует подтверждения."""
@@ -1667,28 +4463,409 @@ async def cmd_wipe_db(message: types.Message):
     if args != "CONFIRM":
         await message.answer(
             "⚠️ <b>ВНИМАНИЕ!</b>\n\n"
-            "Команда /wipe_db полностью очищает таблицы заявок, пользователей и техников.\n"
+            "Команда /wipe_db полностью очищает таблицы заявок, пользователей и техников, "
+            "а также рассылки.\n"
             "Это действие необратимо.\n\n"
             "Если вы уверены, выполните:\n"
             "<code>/wipe_db CONFIRM</code>"
         )
         return
 
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("DELETE FROM tickets;")
-    cur.execute("DELETE FROM senders;")
-    cur.execute("DELETE FROM technicians;")
-    conn.commit()
-    conn.close()
+    await wipe_all_tables_async()
 
     await message.answer("База данных очищена. Все заявки, пользователи и техники удалены.")
 
 
 # ============ ЗАПУСК ============
 
-if __name__ == "__main__":
+# ---- Метрики хэндлеров и эндпоинт /metrics ----
+
+def _observed_handler(handler):
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await handler(*args, **kwargs)
+            outcome = "ok"
+            return result
+        finally:
+            HANDLER_CALLS.inc(name, outcome)
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+            phases = UPDATE_PHASES.get()
+            if phases is not None:
+                phases.setdefault("handler", name)
+
+    wrapper.observed = True
+    return wrapper
+
+
+def observe_handlers(dispatcher: Dispatcher):
+    """Оборачивает зарегистрированные хэндлеры сообщений и нажатий замером времени."""
+    for handlers in (dispatcher.message_handlers, dispatcher.callback_query_handlers):
+        for handler_obj in handlers.handlers:
+            if not getattr(handler_obj.handler, "observed", False):
+                # spec для подстановки аргументов остаётся от исходной функции
+                handler_obj.handler = _observed_handler(handler_obj.handler)
+
+
+async def collect_runtime_metrics():
+    """Переносит в METRICS текущие значения из stats() очередей, кэшей и линий."""
+    FSM_STATES.clear()
+    states = await run_db_read(count_fsm_states, int(time.time() - FSM_STATE_TTL_SECONDS))
+    for state, count in states.items():
+        FSM_STATES.set(count, state)
+
+    caches = {
+        "tickets": TICKET_CACHE,
+        "senders": SENDER_CACHE,
+        "tech_names": TECH_NAME_CACHE,
+    }
+    if FSM_STORAGE.cache is not None:
+        caches["fsm"] = FSM_STORAGE.cache
+    for name, cache in caches.items():
+        stats = cache.stats()
+        CACHE_ENTRIES.set(stats["size"], name)
+        CACHE_HITS.set_total(stats["hits"], name)
+        CACHE_MISSES.set_total(stats["misses"], name)
+
+    outbound = OUTBOUND.stats()
+    OUTBOUND_QUEUE.set(outbound["queue_depth"])
+    OUTBOUND_SENT.set_total(outbound["sent"])
+    OUTBOUND_FAILED.set_total(outbound["failed"])
+    OUTBOUND_FLOOD_WAITS.set_total(outbound["flood_waits"])
+
+    lanes = dp.stats()
+    LANES_PENDING.set(lanes["pending"])
+    LANES_RUNNING.set(lanes["running"])
+    UPDATES_PROCESSED.set_total(lanes["processed"])
+    UPDATE_ERRORS.set_total(lanes["errors"])
+
+    writer = DB_WRITER.stats()
+    DB_WRITE_QUEUE.set(writer["queue_depth"])
+    DB_COMMITS.set_total(writer["batches"])
+
+    MEDIA_GROUPS_BUFFERED.set(MEDIA_GROUPS.stats()["size"])
+    BACKGROUND_TASKS.set(len(_BACKGROUND_TASKS))
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    try:
+        await collect_runtime_metrics()
+    except Exception as e:
+        # Замеры на месте отдаём и без снимка stats()
+        logging.warning(f"Не удалось собрать метрики: {e}")
+    return web.Response(
+        body=METRICS.render().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+_metrics_runner: Optional[web.AppRunner] = None
+
+
+async def start_metrics_server():
+    global _metrics_runner
+    if not METRICS_PORT or _metrics_runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    _metrics_runner = runner
+    logging.info(f"Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+
+async def stop_metrics_server():
+    global _metrics_runner
+    if _metrics_runner is not None:
+        await _metrics_runner.cleanup()
+        _metrics_runner = None
+
+
+async def on_startup(dispatcher: Dispatcher):
+    observe_handlers(dispatcher)
+    LOOP_WATCHDOG.start(dispatcher)
+    await start_metrics_server()
+    OUTBOUND.start()
+    start_outbox_dispatcher()
+    start_config_watcher()
+    FSM_STORAGE.start_cleanup()
+    await resume_broadcasts()
+
+
+# Сколько ждать обработки уже принятых обновлений при остановке
+UPDATE_DRAIN_TIMEOUT = 15
+
+
+async def on_shutdown(dispatcher: LaneDispatcher):
+    await stop_broadcasts()
+    if not await dispatcher.wait_idle(timeout=UPDATE_DRAIN_TIMEOUT):
+        logging.warning("Не все обновления успели обработаться до остановки.")
+    await drain_background_tasks()
+    await stop_outbox_dispatcher()
+    await stop_config_watcher()
+    await dispatcher.storage.close()
+    await dispatcher.storage.wait_closed()
+    await ADMIN_EDITOR.flush()
+    await OUTBOUND.stop()
+    await stop_metrics_server()
+    await LOOP_WATCHDOG.stop()
+    shutdown_db_executors()
+    DB_POOL.close_all()
+    session = await dispatcher.bot.get_session()
+    await session.close()
+    if TRAFFIC_RECORDER is not None:
+        TRAFFIC_RECORDER.close()
+
+
+# Long polling: сколько секунд Telegram держит getUpdates и пауза после ошибки
+POLLING_TIMEOUT = 20
+POLLING_ERROR_SLEEP = 5
+
+# Сообщения, пролежавшие в очереди Telegram дольше этого, при старте
+# не обрабатываются. Нажатия кнопок даты не содержат и не отбрасываются
+BACKLOG_MAX_AGE_SECONDS = int(os.getenv("BACKLOG_MAX_AGE_SECONDS", str(6 * 3600)))
+BACKLOG_PAGE_SIZE = 100
+
+# Последний принятый update_id — чтобы после аварийной остановки не обработать
+# повторно то, что Telegram выдаст ещё раз. Telegram хранит обновления сутки,
+# а после недели простоя начинает нумерацию заново, поэтому старая отметка
+# не учитывается
+LAST_UPDATE_KEY = "last_update_id"
+LAST_UPDATE_MAX_AGE_SECONDS = 24 * 3600
+
+
+def is_stale_update(update: types.Update, cutoff: float) -> bool:
+    message = update.message
+    return message is not None and message.date.timestamp() < cutoff
+
+
+_saved_update_mark = 0
+
+
+async def remember_completed_updates():
+    """
+    Сохраняет отметку: все обновления до неё включительно обработаны.
+    Отметка принятых, но не обработанных обновлений дала бы потерять их при
+    аварийной остановке — после перезапуска они отбросились бы как повторы.
+    """
+    global _saved_update_mark
+    mark = dp.completed_update_id()
+    if mark > _saved_update_mark:
+        await run_db_write(set_bot_state, LAST_UPDATE_KEY, mark)
+        _saved_update_mark = mark
+
+
+async def drain_backlog() -> Optional[int]:
+    """
+    Обрабатывает обновления, накопившиеся, пока бот был остановлен.
+
+    Повторы (update_id уже принят) и устаревшие сообщения отбрасываются,
+    остальное идёт через обычные линии обработки. Возвращает offset для
+    дальнейшего long polling.
+    """
+    started = time.monotonic()
+    # getUpdates не работает, пока установлен вебхук; накопленное не сбрасываем
+    await bot.delete_webhook(drop_pending_updates=False)
+
+    last_seen = 0
+    mark = await run_db_read(get_bot_state, LAST_UPDATE_KEY)
+    if mark and mark[1] > time.time() - LAST_UPDATE_MAX_AGE_SECONDS:
+        last_seen = mark[0]
+
+    cutoff = time.time() - BACKLOG_MAX_AGE_SECONDS
+    offset = last_seen + 1 if last_seen else None
+    if last_seen:
+        dp.mark_received(last_seen)
+    seen: Set[int] = set()
+    accepted = stale = duplicates = 0
+    while True:
+        updates = await bot.get_updates(
+            offset=offset,
+            limit=BACKLOG_PAGE_SIZE,
+            timeout=0,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+        if not updates:
+            break
+        fresh = []
+        for update in updates:
+            if update.update_id <= last_seen or update.update_id in seen:
+                duplicates += 1
+            elif is_stale_update(update, cutoff):
+                stale += 1
+            else:
+                fresh.append(update)
+            seen.add(update.update_id)
+        accepted += len(fresh)
+        await dp.process_updates(fresh)
+        dp.mark_received(updates[-1].update_id)
+        # Следующая страница запрашивается с offset за этой и тем самым
+        # подтверждает её Telegram — поэтому сначала дорабатываем страницу
+        await dp.wait_idle()
+        await remember_completed_updates()
+        offset = updates[-1].update_id + 1
+
+    logging.info(
+        f"Очередь обновлений за время простоя: обработано {accepted}, "
+        f"устаревших {stale}, повторов {duplicates} "
+        f"за {time.monotonic() - started:.2f} с"
+    )
+    return offset
+
+
+async def run_polling(stop: asyncio.Event):
+    await drain_backlog()
+    logging.info("Запущен long polling.")
+    stopped = asyncio.create_task(stop.wait())
+    try:
+        while not stop.is_set():
+            # offset подтверждает Telegram всё, что до него, поэтому запрашиваем
+            # только после обработанного: принятое, но не обработанное к моменту
+            # падения он выдаст ещё раз. Такие повторы в линии не ставятся.
+            # Пока самое раннее из них не обработано, Telegram отдаёт не больше
+            # страницы (100) следующих за ним — это и ограничивает приём
+            completed = dp.completed_update_id()
+            request = asyncio.create_task(
+                bot.get_updates(
+                    offset=completed + 1 if completed else None,
+                    timeout=POLLING_TIMEOUT,
+                    allowed_updates=ALLOWED_UPDATES,
+                )
+            )
+            await asyncio.wait({request, stopped}, return_when=asyncio.FIRST_COMPLETED)
+            if not request.done():
+                request.cancel()
+                await asyncio.gather(request, return_exceptions=True)
+                break
+            try:
+                updates = request.result()
+            except Exception as e:
+                logging.warning(f"Ошибка getUpdates: {e}")
+                await asyncio.wait({stopped}, timeout=POLLING_ERROR_SLEEP)
+                continue
+            fresh = [update for update in updates if not dp.was_received(update.update_id)]
+            if fresh:
+                # Ждёт только при переполнении очереди — тогда и
+                # следующий getUpdates подождёт (backpressure)
+                await dp.process_updates(fresh)
+            elif updates:
+                # Telegram вернул только то, что ещё обрабатывается, и вернёт
+                # сразу же снова — ждём, пока обработка продвинется
+                progress = asyncio.create_task(
+                    dp.wait_completed(completed, timeout=POLLING_TIMEOUT)
+                )
+                await asyncio.wait({progress, stopped}, return_when=asyncio.FIRST_COMPLETED)
+                progress.cancel()
+                await asyncio.gather(progress, return_exceptions=True)
+            await remember_completed_updates()
+    finally:
+        stopped.cancel()
+
+    # Подтверждаем Telegram только обработанное: что не успело обработаться,
+    # после перезапуска он выдаст ещё раз
+    if not await dp.wait_idle(timeout=UPDATE_DRAIN_TIMEOUT):
+        logging.warning("Не все обновления успели обработаться до остановки.")
+    await remember_completed_updates()
+    completed = dp.completed_update_id()
+    if completed:
+        try:
+            await bot.get_updates(offset=completed + 1, limit=1, timeout=0)
+        except Exception as e:
+            logging.warning(f"Не удалось подтвердить offset {completed + 1}: {e}")
+    logging.info("Long polling остановлен.")
+
+
+# ---- Вебхук ----
+
+WEBHOOK_SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+async def handle_webhook(request: web.Request) -> web.Response:
+    expected = request.app["webhook_secret"].encode()
+    received = request.headers.get(WEBHOOK_SECRET_HEADER, "").encode()
+    if not hmac.compare_digest(received, expected):
+        logging.warning(f"Вебхук: запрос с неверным секретом от {request.remote}")
+        return web.Response(status=403)
+
+    try:
+        update = types.Update(**await request.json())
+    except (ValueError, TypeError):
+        return web.Response(status=400)
+
+    # Обновление только ставится в линию, ответ Telegram уходит сразу.
+    # Если очередь переполнена, ответ задерживается — Telegram притормозит
+    await dp.process_updates([update])
+    return web.Response(text="ok")
+
+
+def create_webhook_app(secret: str) -> web.Application:
+    app = web.Application()
+    app["webhook_secret"] = secret
+    app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    return app
+
+
+async def run_webhook(stop: asyncio.Event):
+    if not WEBHOOK_URL:
+        raise RuntimeError("BOT_MODE=webhook: укажите публичный адрес в WEBHOOK_URL")
+    secret = WEBHOOK_SECRET
+    if not secret:
+        secret = secrets.token_urlsafe(32)
+        logging.warning(
+            "WEBHOOK_SECRET не задан — используется случайный секрет до перезапуска. "
+            "Для нескольких процессов задайте общий WEBHOOK_SECRET."
+        )
+
+    runner = web.AppRunner(create_webhook_app(secret))
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_LISTEN_HOST, WEBHOOK_LISTEN_PORT)
+    await site.start()
+    logging.info(
+        f"Вебхук слушает {WEBHOOK_LISTEN_HOST}:{WEBHOOK_LISTEN_PORT}{WEBHOOK_PATH}"
+    )
+    try:
+        await bot.set_webhook(
+            WEBHOOK_URL, allowed_updates=ALLOWED_UPDATES, secret_token=secret
+        )
+        await stop.wait()
+    finally:
+        # Новые запросы больше не принимаем. Вебхук у Telegram не снимаем:
+        # обновления, пришедшие во время перезапуска, он доставит позже
+        await runner.cleanup()
+
+
+async def run_bot():
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await on_startup(dp)
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(stop)
+        else:
+            await run_polling(stop)
+    finally:
+        await on_shutdown(dp)
+
+
+def main():
+    if BOT_MODE not in ("polling", "webhook"):
+        raise SystemExit(f"Неизвестный BOT_MODE={BOT_MODE!r}: ожидается polling или webhook")
     init_db()
-    load_store_addresses()
-    load_tech_ids_from_file()
-    executor.start_polling(dp, skip_updates=True)
+    warm_profile_caches()
+    load_config()
+    asyncio.run(run_bot())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+"""Доступ к SQLite: соединения, групповая запись и пулы потоков.
+
+Хелперы БД в bot.py синхронные. Из асинхронного кода чтение идёт через
+run_db_read() в небольшой пул потоков, запись — через run_db_write()
+в GroupCommitWriter, который коммитит накопившиеся операции одной
+транзакцией.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Optional
+
+from metrics import observe_db_call
+
+DB_PATH = os.getenv("DB_PATH", "tickets.db")
+
+# Настройки соединения: WAL позволяет читать параллельно с записью,
+# synchronous=NORMAL в WAL-режиме не делает fsync на каждый коммит.
+DB_PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("mmap_size", 64 * 1024 * 1024),  # 64 МБ
+    ("cache_size", -16000),  # ~16 МБ страничного кэша
+    ("busy_timeout", 5000),  # мс ожидания блокировки вместо "database is locked"
+    ("temp_store", "MEMORY"),
+)
+
+# Сколько подготовленных выражений sqlite3 держит в кэше на соединение
+DB_CACHED_STATEMENTS = 256
+
+
+class SQLiteConnectionManager:
+    """
+    Долгоживущие соединения с SQLite: по одному на поток.
+
+    Соединение открывается один раз, настраивается через PRAGMA и дальше
+    переиспользуется всеми хелперами (вместе с кэшем подготовленных выражений).
+    Счётчики opened/reused показывают, сколько открытий БД мы сэкономили.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        pragmas=DB_PRAGMAS,
+        cached_statements: int = DB_CACHED_STATEMENTS,
+    ):
+        self.path = path
+        self.pragmas = pragmas
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: list = []
+        self.opened = 0
+        self.reused = 0
+        self.open_seconds = 0.0
+
+    def _open(self) -> sqlite3.Connection:
+        started = time.perf_counter()
+        conn = sqlite3.connect(
+            self.path,
+            cached_statements=self.cached_statements,
+            check_same_thread=False,
+        )
+        for name, value in self.pragmas:
+            conn.execute(f"PRAGMA {name} = {value};")
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._connections.append(conn)
+            self.opened += 1
+            self.open_seconds += elapsed
+        return conn
+
+    def get(self) -> sqlite3.Connection:
+        """Соединение текущего потока (открывается при первом обращении)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._open()
+            self._local.conn = conn
+        else:
+            with self._lock:
+                self.reused += 1
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Соединение потока; коммит при успехе, откат при исключении."""
+        conn = self.get()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def close_all(self):
+        with self._lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except Exception as e:
+                    logging.warning(f"Не удалось закрыть соединение с БД: {e}")
+            self._connections = []
+            self._local = threading.local()
+
+    def stats(self) -> dict:
+        with self._lock:
+            opened = self.opened
+            reused = self.reused
+            open_seconds = self.open_seconds
+        avg_open_ms = (open_seconds / opened * 1000) if opened else 0.0
+        return {
+            "opened": opened,
+            "reused": reused,
+            "avg_open_ms": avg_open_ms,
+            # Оценка: каждое переиспользование сэкономило одно открытие + PRAGMA
+            "saved_ms": reused * avg_open_ms,
+        }
+
+
+DB_POOL = SQLiteConnectionManager(DB_PATH)
+
+
+# ---- Групповая запись (write-behind) ----
+
+# Сколько ждать попутчиков для одной транзакции и максимальный размер пачки
+DB_GROUP_COMMIT_MS = float(os.getenv("DB_GROUP_COMMIT_MS", "5"))
+DB_GROUP_COMMIT_MAX_OPS = int(os.getenv("DB_GROUP_COMMIT_MAX_OPS", "64"))
+
+_WRITER_STOP = object()
+
+
+class GroupCommitWriter:
+    """
+    Очередь записей в БД с групповым коммитом.
+
+    Все хелперы записи выполняются в одном потоке. Поток собирает операции,
+    накопившиеся за DB_GROUP_COMMIT_MS (но не больше DB_GROUP_COMMIT_MAX_OPS),
+    и выполняет их в одной транзакции — один fsync на пачку вместо одного
+    на запись. Каждая операция идёт в своём SAVEPOINT, так что ошибка одной
+    не откатывает остальные. submit() возвращает future, которая
+    завершается только после коммита — по ней можно дождаться надёжной записи.
+    """
+
+    def __init__(
+        self,
+        pool: SQLiteConnectionManager,
+        max_delay_ms: float = DB_GROUP_COMMIT_MS,
+        max_ops: int = DB_GROUP_COMMIT_MAX_OPS,
+    ):
+        self.pool = pool
+        self.max_delay = max_delay_ms / 1000
+        self.max_ops = max_ops
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.ops = 0
+        self.failed_ops = 0
+        self.max_batch = 0
+        self.commit_seconds = 0.0
+        self.max_commit_seconds = 0.0
+        self.last_commit_seconds = 0.0
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="db-writer", daemon=True
+                )
+                self._thread.start()
+
+    def stop(self):
+        """Дописывает всё, что уже в очереди, и останавливает поток."""
+        with self._start_lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            self._queue.put(_WRITER_STOP)
+            thread.join()
+
+    def submit(self, func, *args, **kwargs) -> concurrent.futures.Future:
+        """Ставит func(cur, *args, **kwargs) в очередь записи."""
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        self._queue.put((func, args, kwargs, future))
+        self.start()
+        return future
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _WRITER_STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_ops:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _WRITER_STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit_batch(batch)
+
+    def _commit_batch(self, batch: list):
+        conn = self.pool.get()
+        started = time.perf_counter()
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE;")
+            cur = conn.cursor()
+            for func, args, kwargs, future in batch:
+                cur.execute("SAVEPOINT op;")
+                try:
+                    result = func(cur, *args, **kwargs)
+                except Exception as e:
+                    cur.execute("ROLLBACK TO op;")
+                    cur.execute("RELEASE op;")
+                    results.append((future, None, e))
+                else:
+                    cur.execute("RELEASE op;")
+                    results.append((future, result, None))
+            conn.commit()
+        except Exception as e:
+            logging.warning(f"Не удалось записать пачку из {len(batch)} операций в БД: {e}")
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            results = [(item[3], None, e) for item in batch]
+
+        elapsed = time.perf_counter() - started
+        failed = sum(1 for _, _, error in results if error is not None)
+        with self._stats_lock:
+            self.batches += 1
+            self.ops += len(batch)
+            self.failed_ops += failed
+            self.max_batch = max(self.max_batch, len(batch))
+            self.commit_seconds += elapsed
+            self.last_commit_seconds = elapsed
+            self.max_commit_seconds = max(self.max_commit_seconds, elapsed)
+
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            batches = self.batches
+            return {
+                "queue_depth": self._queue.qsize(),
+                "batches": batches,
+                "ops": self.ops,
+                "failed_ops": self.failed_ops,
+                "avg_batch": (self.ops / batches) if batches else 0.0,
+                "max_batch": self.max_batch,
+                "avg_commit_ms": (self.commit_seconds / batches * 1000) if batches else 0.0,
+                "last_commit_ms": self.last_commit_seconds * 1000,
+                "max_commit_ms": self.max_commit_seconds * 1000,
+            }
+
+
+DB_WRITER = GroupCommitWriter(DB_POOL)
+
+
+# ---- Асинхронный доступ ----
+
+# sqlite3 блокирует поток на время запроса и fsync, поэтому хэндлеры
+# не вызывают хелперы напрямую: запись уходит в DB_WRITER (порядок записей
+# сохраняется), чтение — в небольшой пул потоков (в WAL-режиме читатели
+# не ждут писателя).
+DB_READ_WORKERS = int(os.getenv("DB_READ_WORKERS", "4"))
+
+DB_READ_EXECUTOR = ThreadPoolExecutor(
+    max_workers=DB_READ_WORKERS, thread_name_prefix="db-read"
+)
+
+
+async def run_db_read(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        result = await loop.run_in_executor(
+            DB_READ_EXECUTOR, functools.partial(func, *args, **kwargs)
+        )
+        outcome = "ok"
+        return result
+    finally:
+        observe_db_call(func, "read", outcome, time.perf_counter() - started)
+
+
+async def run_db_write(func, *args, **kwargs):
+    """Выполняет хелпер записи и ждёт, пока его транзакция закоммитится."""
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        result = await asyncio.wrap_future(DB_WRITER.submit(func, *args, **kwargs))
+        outcome = "ok"
+        return result
+    finally:
+        observe_db_call(func, "write", outcome, time.perf_counter() - started)
+
+
+def shutdown_db_executors():
+    DB_WRITER.stop()
+    DB_READ_EXECUTOR.shutdown(wait=True)
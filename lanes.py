@@ -0,0 +1,197 @@
+"""Обработка входящих обновлений по линиям (чат, пользователь).
+
+LaneDispatcher — Dispatcher aiogram, который обрабатывает обновления одной
+линии по очереди, а разных линий — параллельно, с ограничением на число
+одновременно работающих линий и на очередь принятых обновлений.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Callable, Optional, Set
+
+from aiogram import Dispatcher, types
+
+# Сколько линий (чатов/пользователей) обрабатывается одновременно
+UPDATE_MAX_CONCURRENCY = int(os.getenv("UPDATE_MAX_CONCURRENCY", "32"))
+# Сколько обновлений может ждать обработки; дальше приём притормаживает
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "1000"))
+
+
+def update_lane_key(update: types.Update) -> tuple:
+    """Линия обновления: (чат, пользователь), как ключ состояния FSM."""
+    if update.message:
+        return update.message.chat.id, update.message.from_user.id
+    if update.callback_query:
+        call = update.callback_query
+        chat_id = call.message.chat.id if call.message else call.from_user.id
+        return chat_id, call.from_user.id
+    # Остальные типы не запрашиваются (ALLOWED_UPDATES) — каждому своя линия
+    return "update", update.update_id
+
+
+class LaneDispatcher(Dispatcher):
+    """
+    Dispatcher, который раскладывает обновления по линиям (чат, пользователь).
+
+    Внутри линии обновления обрабатываются строго по очереди — шаги FSM
+    и повторные нажатия одного пользователя не обгоняют друг друга.
+    Разные линии идут параллельно, но не больше max_concurrency сразу.
+    Когда ждут обработки max_pending обновлений, process_updates() ждёт
+    свободного места, и приём новых обновлений притормаживает.
+    on_enqueue(update) вызывается для каждого обновления при постановке в линию.
+    """
+
+    def __init__(
+        self,
+        *args,
+        max_concurrency: int = UPDATE_MAX_CONCURRENCY,
+        max_pending: int = UPDATE_MAX_PENDING,
+        on_enqueue: Optional[Callable[[types.Update], None]] = None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        # Вызывается для каждого принятого обновления (запись трафика)
+        self.on_enqueue = on_enqueue
+        self._lanes: dict = {}
+        self._lane_tasks: Set[asyncio.Task] = set()
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._has_room = asyncio.Event()
+        self._has_room.set()
+        self._pending = 0
+        self._running = 0
+        self._waits: deque = deque(maxlen=1000)
+        self.processed = 0
+        self.errors = 0
+        self.backpressure_waits = 0
+        self.max_lane_depth = 0
+        # Принятые, но ещё не обработанные update_id и наибольший принятый —
+        # по ним completed_update_id() считает отметку для перезапуска
+        self._unfinished: Set[int] = set()
+        self._last_received = 0
+        # Взводится после каждого обработанного обновления (wait_completed)
+        self._progress = asyncio.Event()
+
+    async def process_updates(self, updates, fast: bool = True):
+        """Ставит обновления в их линии; возвращается, не дожидаясь обработки."""
+        for update in updates:
+            await self.enqueue_update(update)
+        return []
+
+    async def enqueue_update(self, update: types.Update):
+        while self._pending >= self.max_pending:
+            self.backpressure_waits += 1
+            self._has_room.clear()
+            await self._has_room.wait()
+
+        if self.on_enqueue is not None:
+            self.on_enqueue(update)
+
+        key = update_lane_key(update)
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = deque()
+            task = asyncio.create_task(self._run_lane(key, lane))
+            self._lane_tasks.add(task)
+            task.add_done_callback(self._lane_tasks.discard)
+        lane.append((update, time.monotonic()))
+        self._pending += 1
+        self._unfinished.add(update.update_id)
+        self.mark_received(update.update_id)
+        self.max_lane_depth = max(self.max_lane_depth, len(lane))
+
+    async def _run_lane(self, key, lane: deque):
+        async with self._slots:
+            self._running += 1
+            try:
+                while lane:
+                    update, enqueued = lane[0]
+                    self._waits.append(time.monotonic() - enqueued)
+                    try:
+                        # Каждое обновление — в своей задаче, как в aiogram:
+                        # фильтры (StateFilter) кэшируют состояние FSM в
+                        # contextvars, и без отдельного контекста следующее
+                        # обновление линии увидело бы состояние предыдущего
+                        await asyncio.create_task(self.updates_handler.notify(update))
+                    except Exception:
+                        self.errors += 1
+                        logging.exception(f"Ошибка при обработке обновления {update.update_id}")
+                    finally:
+                        lane.popleft()
+                        self._pending -= 1
+                        self._unfinished.discard(update.update_id)
+                        self._progress.set()
+                        self.processed += 1
+                        if self._pending < self.max_pending:
+                            self._has_room.set()
+            finally:
+                self._running -= 1
+                # Пока линия не пуста, новые обновления дописываются в неё же;
+                # между последней проверкой и удалением await нет
+                del self._lanes[key]
+
+    def mark_received(self, update_id: int):
+        """Обновление принято; пропущенные без обработки тоже отмечаются здесь."""
+        self._last_received = max(self._last_received, update_id)
+
+    def was_received(self, update_id: int) -> bool:
+        """Обновление уже принято (в линии или обработано) — повтор не ставим."""
+        return update_id <= self._last_received
+
+    async def wait_completed(self, after: int, timeout: Optional[float] = None) -> bool:
+        """Ждёт, пока completed_update_id() станет больше after."""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while self.completed_update_id() <= after:
+            self._progress.clear()
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self._progress.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def completed_update_id(self) -> int:
+        """
+        Наибольший update_id, до которого включительно всё принятое уже
+        обработано. update_id растут, поэтому это последний принятый, если
+        не обработанных нет, иначе — предшествующий самому раннему из них.
+        """
+        if self._unfinished:
+            return min(self._unfinished) - 1
+        return self._last_received
+
+    async def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """Ждёт, пока все линии опустеют; False — если не успели за timeout."""
+        if not self._lane_tasks:
+            return True
+        _, pending = await asyncio.wait(set(self._lane_tasks), timeout=timeout)
+        return not pending
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+
+        def percentile(p: float) -> float:
+            if not waits:
+                return 0.0
+            return waits[min(len(waits) - 1, int(len(waits) * p))]
+
+        depths = [len(lane) for lane in self._lanes.values()]
+        return {
+            "pending": self._pending,
+            "lanes": len(self._lanes),
+            "running": self._running,
+            "max_concurrency": self.max_concurrency,
+            "deepest_lane": max(depths, default=0),
+            "max_lane_depth": self.max_lane_depth,
+            "processed": self.processed,
+            "errors": self.errors,
+            "backpressure_waits": self.backpressure_waits,
+            "wait_p50_ms": percentile(0.5) * 1000,
+            "wait_p95_ms": percentile(0.95) * 1000,
+        }
@@ -0,0 +1,684 @@
+"""Нагрузочный прогон бота на локальной заглушке Bot API.
+
+Поднимает aiohttp-сервер, который отвечает как Telegram (getUpdates,
+sendMessage, sendPhoto, sendMediaGroup, editMessage*, answerCallbackQuery,
+ответы 429 с retry_after), и запускает bot.py против него в режиме long
+polling на временной базе. Продавцы проходят /start → имя → магазин →
+«📝 Новая заявка» → оборудование → описание → срочность → фото, техники
+наперегонки нажимают «Принять» и «Завершить» в полученных копиях заявок.
+
+В отчёте — задержки шагов и хэндлеров (p50/p95/p99), пропускная способность
+и число обращений к БД и Bot API на одну заявку. Запуск:
+
+    python loadtest.py --sellers 60 --techs 5
+    python loadtest.py --sellers 200 --no-limits --json result.json
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+FAKE_TOKEN = "123456:LOADTEST"
+
+# Id, которые раздаются участникам прогона
+SELLER_ID_BASE = 700000
+TECH_ID_BASE = 900000
+ADMIN_ID = 990000
+ADMIN_CHAT = -1000000000001
+
+# Методы, которым заглушка может ответить 429
+FLOOD_METHODS = {
+    "sendMessage",
+    "sendPhoto",
+    "sendMediaGroup",
+    "editMessageText",
+    "editMessageCaption",
+    "editMessageReplyMarkup",
+}
+
+EQUIPMENT = ["Весы", "Видеонаблюдение", "Интернет", "Кассовое оборудование", "Принтер чеков"]
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def summarize(values: List[float]) -> dict:
+    """Сводка по задержкам в секундах → миллисекунды."""
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 0.5) * 1000,
+        "p95_ms": percentile(values, 0.95) * 1000,
+        "p99_ms": percentile(values, 0.99) * 1000,
+        "max_ms": max(values, default=0.0) * 1000,
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# ============ ЗАГЛУШКА BOT API ============
+
+
+class FakeBotAPI:
+    """
+    Минимальный Bot API в памяти.
+
+    Входящие обновления кладутся через push_message()/push_callback() и
+    отдаются боту через getUpdates с учётом offset и timeout. Всё, что бот
+    отправил, попадает в очередь получателя (inbox(chat_id)), ответы на
+    нажатия — в callback_answer(). Каждый flood_every-й вызов send*/edit*
+    получает 429 с retry_after.
+    """
+
+    def __init__(self, flood_every: int = 0, retry_after: int = 1, latency: float = 0.0):
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.flood_responses = 0
+        self._flood_counter = 0
+        self._updates: List[dict] = []
+        self._next_update_id = 1
+        self._updates_changed = asyncio.Event()
+        self._message_ids: Dict[int, int] = defaultdict(int)
+        self._inboxes: Dict[int, asyncio.Queue] = defaultdict(asyncio.Queue)
+        self._answers: Dict[str, asyncio.Future] = {}
+        self._runner: Optional[web.AppRunner] = None
+
+    # ---- Запуск ----
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def start(self, host: str, port: int):
+        self._runner = web.AppRunner(self.create_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    # ---- Входящие обновления ----
+
+    def push_update(self, payload: dict) -> int:
+        update_id = self._next_update_id
+        self._next_update_id += 1
+        self._updates.append({"update_id": update_id, **payload})
+        self._updates_changed.set()
+        return update_id
+
+    def push_message(self, user_id: int, text: str = None, **extra) -> int:
+        self._message_ids[user_id] += 1
+        message = {
+            "message_id": self._message_ids[user_id],
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+        }
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                command = text.split()[0]
+                message["entities"] = [
+                    {"type": "bot_command", "offset": 0, "length": len(command)}
+                ]
+        message.update(extra)
+        return self.push_update({"message": message})
+
+    def push_photo(self, user_id: int, file_id: str, media_group_id: str = None) -> int:
+        extra = {
+            "photo": [
+                {"file_id": file_id, "file_unique_id": file_id, "width": 800, "height": 600}
+            ]
+        }
+        if media_group_id:
+            extra["media_group_id"] = media_group_id
+        return self.push_message(user_id, **extra)
+
+    def push_callback(self, user_id: int, message: dict, data: str) -> str:
+        """Нажатие inline-кнопки под сообщением message; возвращает id нажатия."""
+        callback_id = f"cb{self._next_update_id}"
+        self._answers[callback_id] = asyncio.get_running_loop().create_future()
+        self.push_update(
+            {
+                "callback_query": {
+                    "id": callback_id,
+                    "from": {"id": user_id, "is_bot": False, "first_name": f"Tech{user_id}"},
+                    "message": message,
+                    "chat_instance": str(user_id),
+                    "data": data,
+                }
+            }
+        )
+        return callback_id
+
+    @property
+    def pending_updates(self) -> int:
+        """Сколько обновлений бот ещё не забрал через getUpdates."""
+        return len(self._updates)
+
+    # ---- Исходящие сообщения ----
+
+    def inbox(self, chat_id: int) -> asyncio.Queue:
+        return self._inboxes[chat_id]
+
+    async def callback_answer(self, callback_id: str, timeout: float) -> str:
+        future = self._answers[callback_id]
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        finally:
+            if future.done():
+                del self._answers[callback_id]
+
+    def _deliver(self, chat_id: int, method: str, data: dict, **fields) -> dict:
+        self._message_ids[chat_id] += 1
+        message = {
+            "message_id": self._message_ids[chat_id],
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            **fields,
+        }
+        markup = data.get("reply_markup")
+        if markup:
+            markup = json.loads(markup)
+            if "inline_keyboard" in markup:
+                message["reply_markup"] = markup
+        self._inboxes[chat_id].put_nowait(
+            {"method": method, "received": time.monotonic(), "message": message}
+        )
+        return message
+
+    # ---- HTTP ----
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = dict(await request.post())
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method in FLOOD_METHODS and self.flood_every:
+            self._flood_counter += 1
+            if self._flood_counter % self.flood_every == 0:
+                self.flood_responses += 1
+                return web.json_response(
+                    {
+                        "ok": False,
+                        "error_code": 429,
+                        "description": f"Too Many Requests: retry after {self.retry_after}",
+                        "parameters": {"retry_after": self.retry_after},
+                    },
+                    status=429,
+                )
+
+        handler = getattr(self, f"api_{method}", None)
+        result = await handler(data) if handler else True
+        return web.json_response({"ok": True, "result": result})
+
+    async def api_getMe(self, data: dict):
+        return {"id": 1, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+
+    async def api_getUpdates(self, data: dict):
+        offset = int(data.get("offset") or 0)
+        limit = int(data.get("limit") or 100)
+        timeout = float(data.get("timeout") or 0)
+        if offset:
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout > 0:
+            self._updates_changed.clear()
+            try:
+                await asyncio.wait_for(self._updates_changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+
+    async def api_sendMessage(self, data: dict):
+        return self._deliver(int(data["chat_id"]), "sendMessage", data, text=data.get("text", ""))
+
+    async def api_sendPhoto(self, data: dict):
+        photo = {"file_id": data.get("photo", ""), "file_unique_id": "p", "width": 1, "height": 1}
+        return self._deliver(
+            int(data["chat_id"]),
+            "sendPhoto",
+            data,
+            photo=[photo],
+            caption=data.get("caption", ""),
+        )
+
+    async def api_sendMediaGroup(self, data: dict):
+        chat_id = int(data["chat_id"])
+        return [
+            self._deliver(chat_id, "sendMediaGroup", {}, photo=[{
+                "file_id": item.get("media", ""), "file_unique_id": "p", "width": 1, "height": 1,
+            }])
+            for item in json.loads(data.get("media") or "[]")
+        ]
+
+    async def _edited(self, data: dict):
+        if "inline_message_id" in data:
+            return True
+        chat_id = int(data["chat_id"])
+        return {
+            "message_id": int(data["message_id"]),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "text": data.get("text", ""),
+        }
+
+    api_editMessageText = _edited
+    api_editMessageCaption = _edited
+    api_editMessageReplyMarkup = _edited
+
+    async def api_answerCallbackQuery(self, data: dict):
+        future = self._answers.get(data.get("callback_query_id"))
+        if future is not None and not future.done():
+            future.set_result(data.get("text", ""))
+        return True
+
+
+# ============ УЧАСТНИКИ ============
+
+
+class StepTimeout(Exception):
+    pass
+
+
+class LoadTest:
+    def __init__(self, api: FakeBotAPI, args, stores: List[str], no_photo_text: str):
+        self.api = api
+        self.args = args
+        self.tech_ids = [TECH_ID_BASE + i for i in range(args.techs)]
+        self.stores = stores or ["1"]
+        self.no_photo_text = no_photo_text
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.failures: Counter = Counter()
+        self.created: Dict[int, float] = {}
+        self.closed: Dict[int, float] = {}
+        self.take_answers: Counter = Counter()
+        self.all_closed = asyncio.Event()
+        self.sellers_done = 0
+
+    async def expect(self, chat_id: int, marker: str) -> dict:
+        """Ждёт сообщение в чате, содержащее marker; остальные пропускает."""
+        inbox = self.api.inbox(chat_id)
+        deadline = time.monotonic() + self.args.step_timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise StepTimeout(marker)
+            try:
+                item = await asyncio.wait_for(inbox.get(), remaining)
+            except asyncio.TimeoutError:
+                raise StepTimeout(marker)
+            message = item["message"]
+            if marker in (message.get("text") or message.get("caption") or ""):
+                return item
+
+    async def step(self, name: str, chat_id: int, marker: str, send) -> dict:
+        started = time.monotonic()
+        send()
+        item = await self.expect(chat_id, marker)
+        self.latencies[name].append(item["received"] - started)
+        if self.args.think:
+            await asyncio.sleep(random.uniform(0, self.args.think))
+        return item
+
+    async def seller(self, index: int):
+        api = self.api
+        uid = SELLER_ID_BASE + index
+        store = random.choice(self.stores)
+        try:
+            await self.step("start", uid, "напишите ваше имя", lambda: api.push_message(uid, "/start"))
+            await self.step("name", uid, "номер вашего магазина", lambda: api.push_message(uid, f"Продавец {index}"))
+            await self.step("store", uid, "Готово,", lambda: api.push_message(uid, store))
+            for number in range(self.args.tickets_per_seller):
+                await self.step("new_ticket", uid, "Что сломалось?", lambda: api.push_message(uid, "📝 Новая заявка"))
+                await self.step("equipment", uid, "Опишите проблему", lambda: api.push_message(uid, random.choice(EQUIPMENT)))
+                await self.step("description", uid, "срочность", lambda: api.push_message(uid, f"Не работает, магазин {store}, заявка {number}"))
+                await self.step("priority", uid, "Пришлите фото", lambda: api.push_message(uid, random.choice(["обычная", "высокая"])))
+                item = await self.step("photo", uid, "создана", lambda: self.send_photos(uid, number))
+                self.on_ticket_created(item)
+        except StepTimeout as e:
+            self.failures[f"seller_timeout:{e}"] += 1
+        finally:
+            self.sellers_done += 1
+            self.check_finished()
+
+    def send_photos(self, uid: int, number: int):
+        roll = random.random()
+        if roll < self.args.album_share:
+            group = f"mg{uid}_{number}"
+            for i in range(random.randint(2, 4)):
+                self.api.push_photo(uid, f"ph_{uid}_{number}_{i}", media_group_id=group)
+        elif roll < self.args.album_share + self.args.photo_share:
+            self.api.push_photo(uid, f"ph_{uid}_{number}")
+        else:
+            self.api.push_message(uid, self.no_photo_text)
+
+    def on_ticket_created(self, item: dict):
+        """Запоминает номер из ответа «Заявка #N создана.»."""
+        text = item["message"].get("text", "")
+        try:
+            ticket_id = int(text.split("#", 1)[1].split()[0])
+        except (IndexError, ValueError):
+            return
+        self.created[ticket_id] = item["received"]
+
+    async def tech(self, tech_id: int):
+        inbox = self.api.inbox(tech_id)
+        handled = set()
+        while True:
+            item = await inbox.get()
+            message = item["message"]
+            callbacks = [
+                button.get("callback_data", "")
+                for row in message.get("reply_markup", {}).get("inline_keyboard", [])
+                for button in row
+            ]
+            take = next((c for c in callbacks if c.startswith("take_")), None)
+            if take is None or take in handled:
+                continue
+            handled.add(take)
+            asyncio.create_task(self.work_ticket(tech_id, message, int(take[5:])))
+
+    async def callback(self, name: str, tech_id: int, message: dict, data: str) -> str:
+        started = time.monotonic()
+        callback_id = self.api.push_callback(tech_id, message, data)
+        try:
+            text = await self.api.callback_answer(callback_id, self.args.step_timeout)
+        except asyncio.TimeoutError:
+            self.failures[f"callback_timeout:{name}"] += 1
+            return ""
+        self.latencies[name].append(time.monotonic() - started)
+        return text
+
+    async def work_ticket(self, tech_id: int, message: dict, ticket_id: int):
+        # Техники реагируют не мгновенно и иногда нажимают кнопку дважды
+        await asyncio.sleep(random.uniform(0, self.args.tech_delay))
+        taps = [self.callback("take", tech_id, message, f"take_{ticket_id}")]
+        if random.random() < self.args.double_tap:
+            taps.append(self.callback("take", tech_id, message, f"take_{ticket_id}"))
+        answers = await asyncio.gather(*taps)
+        for answer in answers:
+            self.take_answers[answer.split(":")[0]] += 1
+        if "Заявка взята в работу." not in answers:
+            return
+        await asyncio.sleep(random.uniform(0, self.args.tech_delay))
+        answer = await self.callback("done", tech_id, message, f"done_{ticket_id}")
+        if answer == "Заявка отмечена как выполненная.":
+            self.closed[ticket_id] = time.monotonic()
+            self.check_finished()
+
+    def check_finished(self):
+        if self.sellers_done == self.args.sellers and set(self.created) <= set(self.closed):
+            self.all_closed.set()
+
+
+# ============ ПРОГОН ============
+
+
+def setup_environment(workdir: str, port: int, tech_ids: List[int]):
+    """Переменные окружения для bot.py — до его импорта."""
+    techs_path = os.path.join(workdir, "techs.txt")
+    with open(techs_path, "w", encoding="utf-8") as f:
+        for i, tech_id in enumerate(tech_ids):
+            f.write(f"{tech_id} | Техник {i}\n")
+    os.environ.update(
+        {
+            "BOT_TOKEN": FAKE_TOKEN,
+            "TELEGRAM_API_URL": f"http://127.0.0.1:{port}",
+            "DB_PATH": os.path.join(workdir, "tickets.db"),
+            "TECHS_FILE_PATH": techs_path,
+            "STORES_FILE_PATH": os.path.join(os.path.dirname(os.path.abspath(__file__)), "stores.txt"),
+            "ADMIN_CHAT_ID": str(ADMIN_CHAT),
+            "ADMIN_USER_IDS": str(ADMIN_ID),
+        }
+    )
+
+
+def update_kind(update) -> str:
+    return "callback_query" if update.callback_query else "message"
+
+
+def instrument(bot_module, classify=update_kind) -> dict:
+    """Считает чтения из БД и время хэндлеров по классам обновлений."""
+    counters = {"db_reads": 0, "handler": defaultdict(list)}
+    run_db_read = bot_module.run_db_read
+
+    async def counted_read(func, *args, **kwargs):
+        counters["db_reads"] += 1
+        return await run_db_read(func, *args, **kwargs)
+
+    bot_module.run_db_read = counted_read
+
+    notify = bot_module.dp.updates_handler.notify
+
+    async def timed_notify(update):
+        started = time.perf_counter()
+        try:
+            return await notify(update)
+        finally:
+            counters["handler"][classify(update)].append(time.perf_counter() - started)
+
+    bot_module.dp.updates_handler.notify = timed_notify
+    return counters
+
+
+async def run(args) -> dict:
+    import bot
+    from outbound import OutboundScheduler
+
+    if args.no_limits:
+        bot.OUTBOUND = OutboundScheduler(global_rate=1e6, chat_rate=1e6, group_rate=1e6)
+
+    bot.init_db()
+    bot.warm_profile_caches()
+    bot.load_config()
+    counters = instrument(bot)
+
+    api = FakeBotAPI(flood_every=args.flood_every, retry_after=args.retry_after, latency=args.api_latency)
+    await api.start("127.0.0.1", args.port)
+    test = LoadTest(api, args, sorted(bot.CONFIG.stores), bot.NO_PHOTO_TEXT)
+
+    bot.Bot.set_current(bot.bot)
+    bot.Dispatcher.set_current(bot.dp)
+    await bot.on_startup(bot.dp)
+    stop = asyncio.Event()
+    polling = asyncio.create_task(bot.run_polling(stop))
+    techs = [asyncio.create_task(test.tech(tech_id)) for tech_id in test.tech_ids]
+
+    started = time.monotonic()
+    sellers = []
+    for index in range(args.sellers):
+        sellers.append(asyncio.create_task(test.seller(index)))
+        if args.ramp:
+            await asyncio.sleep(args.ramp / args.sellers)
+    await asyncio.gather(*sellers)
+    sellers_finished = time.monotonic()
+    try:
+        await asyncio.wait_for(test.all_closed.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        test.failures["tickets_not_closed"] += len(set(test.created) - set(test.closed))
+    finished = time.monotonic()
+
+    for task in techs:
+        task.cancel()
+    stop.set()
+    await polling
+    lanes = bot.dp.stats()
+    outbound = bot.OUTBOUND.stats()
+    await bot.on_shutdown(bot.dp)
+    await api.stop()
+    writes = bot.DB_WRITER.stats()
+
+    tickets = len(test.created) or 1
+    elapsed = finished - started
+    api_calls = {m: n for m, n in sorted(api.calls.items()) if m != "getUpdates"}
+    lifetimes = [test.closed[t] - test.created[t] for t in test.closed if t in test.created]
+    return {
+        "config": {
+            "sellers": args.sellers,
+            "techs": args.techs,
+            "tickets_per_seller": args.tickets_per_seller,
+            "album_share": args.album_share,
+            "photo_share": args.photo_share,
+            "flood_every": args.flood_every,
+            "no_limits": args.no_limits,
+        },
+        "elapsed_s": elapsed,
+        "tickets": {
+            "created": len(test.created),
+            "closed": len(test.closed),
+            "per_second": len(test.created) / (sellers_finished - started),
+            "lifetime": summarize(lifetimes),
+        },
+        "updates": {
+            "processed": lanes["processed"],
+            "errors": lanes["errors"],
+            "per_second": lanes["processed"] / elapsed,
+            "lane_wait_p95_ms": lanes["wait_p95_ms"],
+            "backpressure_waits": lanes["backpressure_waits"],
+        },
+        "steps": {name: summarize(values) for name, values in test.latencies.items()},
+        "handlers": {kind: summarize(values) for kind, values in counters["handler"].items()},
+        "db": {
+            "reads": counters["db_reads"],
+            "write_ops": writes["ops"],
+            "commits": writes["batches"],
+            "reads_per_ticket": counters["db_reads"] / tickets,
+            "write_ops_per_ticket": writes["ops"] / tickets,
+            "commits_per_ticket": writes["batches"] / tickets,
+        },
+        "api": {
+            "calls": api_calls,
+            "calls_per_ticket": sum(api_calls.values()) / tickets,
+            "flood_responses": api.flood_responses,
+            "outbound_flood_waits": outbound["flood_waits"],
+            "outbound_failed": outbound["failed"],
+        },
+        "take_answers": dict(test.take_answers),
+        "failures": dict(test.failures),
+    }
+
+
+def print_report(result: dict):
+    cfg = result["config"]
+    tickets = result["tickets"]
+    print(
+        f"Продавцов: {cfg['sellers']}, техников: {cfg['techs']}, "
+        f"заявок на продавца: {cfg['tickets_per_seller']}, "
+        f"лимиты Telegram: {'выключены' if cfg['no_limits'] else 'включены'}"
+    )
+    print(f"Время прогона: {result['elapsed_s']:.2f} с")
+    print(
+        f"Заявки: создано {tickets['created']}, закрыто {tickets['closed']}, "
+        f"{tickets['per_second']:.1f} заявок/с"
+    )
+    updates = result["updates"]
+    print(
+        f"Обновления: {updates['processed']} ({updates['per_second']:.1f}/с), "
+        f"ошибок {updates['errors']}, ожидание в линии p95 {updates['lane_wait_p95_ms']:.1f} мс"
+    )
+
+    print("\nЗадержки, мс              кол-во     p50     p95     p99     max")
+    rows = [(f"шаг {name}", s) for name, s in result["steps"].items()]
+    rows += [(f"хэндлер {kind}", s) for kind, s in result["handlers"].items()]
+    rows.append(("заявка до закрытия", tickets["lifetime"]))
+    for label, s in rows:
+        print(
+            f"  {label:<24}{s['count']:>6}{s['p50_ms']:>8.1f}{s['p95_ms']:>8.1f}"
+            f"{s['p99_ms']:>8.1f}{s['max_ms']:>8.1f}"
+        )
+
+    db = result["db"]
+    print(
+        f"\nБД на заявку: чтений {db['reads_per_ticket']:.1f}, "
+        f"записей {db['write_ops_per_ticket']:.1f}, коммитов {db['commits_per_ticket']:.1f}"
+    )
+    api = result["api"]
+    print(f"Bot API на заявку: {api['calls_per_ticket']:.1f} вызовов")
+    for method, count in api["calls"].items():
+        print(f"  {method:<24}{count:>7}")
+    print(
+        f"Ответов 429: {api['flood_responses']}, "
+        f"повторов после 429 в очереди отправки: {api['outbound_flood_waits']}, "
+        f"не доставлено: {api['outbound_failed']}"
+    )
+    if result["take_answers"]:
+        print("Ответы на «Принять»: " + ", ".join(
+            f"{text} — {count}" for text, count in result["take_answers"].items()
+        ))
+    if result["failures"]:
+        print("Сбои: " + ", ".join(f"{k} — {v}" for k, v in result["failures"].items()))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sellers", type=int, default=60, help="число продавцов")
+    parser.add_argument("--techs", type=int, default=5, help="число техников")
+    parser.add_argument("--tickets-per-seller", type=int, default=1)
+    parser.add_argument("--album-share", type=float, default=0.2, help="доля заявок с альбомом")
+    parser.add_argument("--photo-share", type=float, default=0.5, help="доля заявок с одним фото")
+    parser.add_argument("--ramp", type=float, default=1.0, help="за сколько секунд подключаются продавцы")
+    parser.add_argument("--think", type=float, default=0.0, help="пауза продавца между шагами, до N с")
+    parser.add_argument("--tech-delay", type=float, default=0.5, help="реакция техника, до N с")
+    parser.add_argument("--double-tap", type=float, default=0.3, help="вероятность двойного нажатия")
+    parser.add_argument("--flood-every", type=int, default=0, help="каждый N-й send/edit получает 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа API, с")
+    parser.add_argument("--no-limits", action="store_true", help="снять лимиты отправки Telegram")
+    parser.add_argument("--step-timeout", type=float, default=30.0)
+    parser.add_argument("--timeout", type=float, default=300.0, help="ожидание закрытия всех заявок")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--json", metavar="PATH", help="сохранить результат в JSON")
+    parser.add_argument("--verbose", action="store_true", help="не глушить логи бота")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    random.seed(args.seed)
+    args.port = args.port or free_port()
+    with tempfile.TemporaryDirectory(prefix="loadtest-") as workdir:
+        setup_environment(
+            workdir, args.port, [TECH_ID_BASE + i for i in range(args.techs)]
+        )
+        # bot читает настройки из окружения при импорте — только после setup_environment()
+        importlib.import_module("bot")
+
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+        result = asyncio.run(run(args))
+
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    return result
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
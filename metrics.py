@@ -0,0 +1,260 @@
+"""Метрики бота в формате Prometheus и фазы обработки обновления.
+
+Счётчики, датчики и гистограммы с метками, реестр METRICS, который отдаёт
+их текстом для /metrics, и учёт времени текущего обновления по фазам
+("db", "render", "api") для профилировщика медленных обновлений.
+"""
+import bisect
+import contextvars
+import functools
+import threading
+import time
+from typing import Optional
+
+# Границы корзин гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    """Метрика с метками; значения меняются из любого потока."""
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        """Сбрасывает все наборы меток (для значений, снимаемых при опросе)."""
+        with self._lock:
+            self._values.clear()
+
+    def _lines(self) -> list:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            for labels, value in items
+        ]
+
+    def render(self) -> str:
+        header = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        return "\n".join(header + self._lines())
+
+
+class CounterMetric(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def set_total(self, value: float, *labels):
+        """Для счётчиков, которые ведёт сам объект (stats()): берутся при опросе."""
+        with self._lock:
+            self._values[labels] = value
+
+
+class GaugeMetric(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class HistogramMetric(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # счётчики по корзинам (последняя — +Inf), сумма, количество
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _lines(self) -> list:
+        with self._lock:
+            items = sorted((labels, (list(s[0]), s[1], s[2])) for labels, s in self._values.items())
+        lines = []
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+                )
+            suffix = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{suffix} {_format_value(total)}")
+            lines.append(f"{self.name}_count{suffix} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def _register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> CounterMetric:
+        return self._register(CounterMetric(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> GaugeMetric:
+        return self._register(GaugeMetric(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = ()) -> HistogramMetric:
+        return self._register(HistogramMetric(name, documentation, labelnames))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+METRICS = MetricsRegistry()
+
+# Замеряются на месте
+HANDLER_CALLS = METRICS.counter(
+    "bot_handler_calls_total", "Вызовы хэндлеров по исходу (ok/error)", ("handler", "outcome")
+)
+HANDLER_SECONDS = METRICS.histogram(
+    "bot_handler_seconds", "Время работы хэндлера", ("handler",)
+)
+DB_CALLS = METRICS.counter(
+    "bot_db_calls_total", "Вызовы хелперов БД по исходу (ok/error)", ("helper", "kind", "outcome")
+)
+DB_SECONDS = METRICS.histogram(
+    "bot_db_seconds", "Время вызова хелпера БД вместе с ожиданием очереди", ("helper", "kind")
+)
+API_CALLS = METRICS.counter(
+    "bot_api_calls_total", "Вызовы Bot API по исходу (ok/flood/error)", ("method", "outcome")
+)
+API_SECONDS = METRICS.histogram(
+    "bot_api_seconds", "Время ответа Bot API", ("method",)
+)
+LOOP_LAG = METRICS.histogram(
+    "bot_event_loop_lag_seconds", "Насколько позже положенного просыпается цикл событий"
+)
+LOOP_STALLS = METRICS.counter(
+    "bot_event_loop_stalls_total", "Зависания цикла событий дольше порога", ("handler",)
+)
+
+# Снимаются при опросе из stats() объектов — см. collect_runtime_metrics()
+FSM_STATES = METRICS.gauge(
+    "bot_fsm_states", "Незавершённые сценарии (состояния FSM) по шагам", ("state",)
+)
+CACHE_ENTRIES = METRICS.gauge("bot_cache_entries", "Записей в кэше", ("cache",))
+CACHE_HITS = METRICS.counter("bot_cache_hits_total", "Попадания в кэш", ("cache",))
+CACHE_MISSES = METRICS.counter("bot_cache_misses_total", "Промахи кэша", ("cache",))
+OUTBOUND_QUEUE = METRICS.gauge(
+    "bot_outbound_queue_depth", "Исходящие вызовы в очереди, отложенные и в полёте"
+)
+OUTBOUND_SENT = METRICS.counter("bot_outbound_sent_total", "Отправлено через очередь исходящих")
+OUTBOUND_FAILED = METRICS.counter("bot_outbound_failed_total", "Не отправлено после повторов")
+OUTBOUND_FLOOD_WAITS = METRICS.counter(
+    "bot_outbound_flood_waits_total", "Ответы 429, после которых очередь ждала"
+)
+LANES_PENDING = METRICS.gauge("bot_update_pending", "Обновления, ждущие обработки в линиях")
+LANES_RUNNING = METRICS.gauge("bot_update_lanes_running", "Линии, обрабатываемые сейчас")
+UPDATES_PROCESSED = METRICS.counter("bot_updates_processed_total", "Обработанные обновления")
+UPDATE_ERRORS = METRICS.counter("bot_update_errors_total", "Обновления, завершившиеся ошибкой")
+DB_WRITE_QUEUE = METRICS.gauge("bot_db_write_queue_depth", "Записи, ждущие групповой транзакции")
+DB_COMMITS = METRICS.counter("bot_db_commits_total", "Транзакции групповой записи")
+MEDIA_GROUPS_BUFFERED = METRICS.gauge(
+    "bot_media_groups_buffered", "Альбомы в буфере: собираются или ждут поздних частей"
+)
+BACKGROUND_TASKS = METRICS.gauge("bot_background_tasks", "Фоновые задачи (правка копий и т. п.)")
+
+
+# ---- Фазы обработки обновления ----
+
+# Время текущего обновления по фазам ("db", "render", "api") и число вызовов;
+# словарь заводит UpdateProfilerMiddleware, вне обработки обновления — None
+UPDATE_PHASES: contextvars.ContextVar = contextvars.ContextVar("update_phases", default=None)
+
+
+def add_update_phase(phase: str, seconds: float):
+    phases = UPDATE_PHASES.get()
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0.0) + seconds
+        phases[f"{phase}_calls"] = phases.get(f"{phase}_calls", 0) + 1
+
+
+def detached_context() -> contextvars.Context:
+    """
+    Контекст для фоновой задачи, запущенной из хэндлера: она переживает
+    обновление, и её время не должно попадать в его фазы.
+    """
+    context = contextvars.copy_context()
+    context.run(UPDATE_PHASES.set, None)
+    return context
+
+
+def timed_phase(phase: str):
+    """Время синхронной функции засчитывается в фазу phase текущего обновления."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if UPDATE_PHASES.get() is None:
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                add_update_phase(phase, time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+def observe_db_call(func, kind: str, outcome: str, seconds: float):
+    helper = getattr(func, "__name__", "unknown")
+    DB_CALLS.inc(helper, kind, outcome)
+    DB_SECONDS.observe(seconds, helper, kind)
+    add_update_phase("db", seconds)
+
+
+def observe_api_call(method: str, error: Optional[str], seconds: float):
+    if error is None:
+        outcome = "ok"
+    elif error == "RetryAfter":
+        outcome = "flood"
+    else:
+        outcome = "error"
+    API_CALLS.inc(method, outcome)
+    API_SECONDS.observe(seconds, method)
+    add_update_phase("api", seconds)
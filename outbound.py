@@ -0,0 +1,285 @@
+"""Очередь исходящих вызовов Bot API с учётом лимитов Telegram.
+
+OutboundScheduler раздаёт вызовы воркерам по приоритету и корзинам
+токенов (общей на бота и отдельной на каждый чат), откладывает задачи
+чатов, упёршихся в лимит, и повторяет запрос после ответа 429.
+"""
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from collections import deque
+from typing import Optional
+
+from aiogram.utils import exceptions
+
+from metrics import add_update_phase
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота, ~1 в секунду в один
+# чат и ~20 в минуту в группу. Берём с небольшим запасом.
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "25"))
+OUTBOUND_CHAT_RATE = 1.0
+# Короткую серию в личный чат Telegram пропускает: ответ на нажатие и
+# правка сообщения не должны ждать друг друга по секунде
+OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_GROUP_RATE = 20 / 60
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", "8"))
+# Сколько раз повторять запрос после ответа 429 (flood wait)
+OUTBOUND_MAX_RETRIES = 3
+
+# Очереди по важности: срочные заявки, обычные сообщения, рассылки
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+# Выставляется в задачах воркеров: вызов API оттуда уже прошёл очередь
+_IN_WORKER = contextvars.ContextVar("outbound_worker", default=False)
+
+
+def in_outbound_worker() -> bool:
+    """Текущий вызов выполняет воркер очереди исходящих."""
+    return _IN_WORKER.get()
+
+
+class TokenBucket:
+    """Корзина токенов: delay() — сколько ждать до токена, take() — забрать."""
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        now = time.monotonic()
+        self._refill(now)
+        wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def take(self):
+        self._refill(time.monotonic())
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        """Telegram попросил подождать (retry_after)."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+
+class _OutboundJob:
+    __slots__ = (
+        "priority", "seq", "chat_id", "method", "kwargs", "future",
+        "enqueued", "attempt",
+    )
+
+    def __init__(self, priority, seq, chat_id, method, kwargs, future):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.method = method
+        self.kwargs = kwargs
+        self.future = future
+        self.enqueued = time.monotonic()
+        self.attempt = 0
+
+    def __lt__(self, other: "_OutboundJob") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class OutboundScheduler:
+    """
+    Все исходящие вызовы Bot API (send_*/edit_*) идут через эту очередь.
+
+    Несколько воркеров отправляют параллельно, но с учётом корзин токенов:
+    общей на бота и отдельной на каждый чат (для групп — своя, медленнее).
+    Если упёрлись в лимит чата, задача откладывается и не занимает воркер;
+    общий лимит воркер просто выжидает (он касается всех задач одинаково).
+    Ответ 429 (RetryAfter) блокирует чат на указанное время, задача
+    повторяется. Срочные заявки обгоняют обычные сообщения и рассылки.
+    """
+
+    def __init__(
+        self,
+        workers: int = OUTBOUND_WORKERS,
+        global_rate: float = OUTBOUND_GLOBAL_RATE,
+        chat_rate: float = OUTBOUND_CHAT_RATE,
+        group_rate: float = OUTBOUND_GROUP_RATE,
+        chat_burst: float = OUTBOUND_CHAT_BURST,
+    ):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self._global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self._chat_buckets: dict = {}
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._tasks: list = []
+        self._seq = 0
+        self._delayed = 0
+        self._in_flight = 0
+
+        self.sent = 0
+        self.failed = 0
+        self.flood_waits = 0
+        self._latencies: deque = deque(maxlen=1000)
+
+    def start(self):
+        if self._tasks:
+            return
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    async def stop(self, timeout: float = 10):
+        """Даёт дослать очередь (не дольше timeout) и останавливает воркеров."""
+        if self._queue is not None:
+            deadline = time.monotonic() + timeout
+            while self.queue_depth() and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def send(self, method, *, priority: int = PRIORITY_NORMAL, **kwargs):
+        """
+        Ставит вызов method(**kwargs) в очередь и ждёт его результата.
+        kwargs обязательно содержит chat_id — по нему считаются лимиты.
+        """
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        job = _OutboundJob(priority, self._seq, kwargs["chat_id"], method, kwargs, future)
+        self._queue.put_nowait(job)
+        # Сам вызов API выполнит воркер (вне обновления), поэтому ожидание
+        # в очереди и отправку засчитываем в фазу API здесь
+        started = time.perf_counter()
+        try:
+            return await future
+        finally:
+            add_update_phase("api", time.perf_counter() - started)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                self._chat_buckets = {
+                    cid: b for cid, b in self._chat_buckets.items() if not b.idle()
+                }
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate)
+            else:
+                bucket = TokenBucket(self.chat_rate, capacity=self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _requeue(self, job: _OutboundJob):
+        self._delayed -= 1
+        self._queue.put_nowait(job)
+
+    def _defer(self, job: _OutboundJob, delay: float):
+        self._delayed += 1
+        asyncio.get_running_loop().call_later(delay, self._requeue, job)
+
+    async def _worker(self):
+        _IN_WORKER.set(True)
+        while True:
+            job = await self._queue.get()
+            if job.future.done():
+                continue
+            try:
+                await self._process(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Воркер не должен умереть из-за одной задачи: иначе все
+                # следующие отправки зависнут в очереди
+                logging.exception(f"Ошибка очереди исходящих для чата {job.chat_id}: {e}")
+                if not job.future.done():
+                    job.future.set_exception(e)
+
+    async def _process(self, job: _OutboundJob):
+        """Дожидается лимитов, выполняет вызов и завершает future задачи."""
+        chat_bucket = self._chat_bucket(job.chat_id)
+        wait = chat_bucket.delay()
+        while wait <= 0:
+            global_wait = self._global_bucket.delay()
+            if global_wait <= 0:
+                break
+            await asyncio.sleep(global_wait)
+            # Пока ждали, в этот же чат мог отправить другой воркер
+            wait = chat_bucket.delay()
+        if wait > 0:
+            self._defer(job, wait)
+            return
+        chat_bucket.take()
+        self._global_bucket.take()
+
+        self._in_flight += 1
+        try:
+            result = await job.method(**job.kwargs)
+        except exceptions.RetryAfter as e:
+            self.flood_waits += 1
+            self._chat_bucket(job.chat_id).block(e.timeout)
+            if job.attempt < OUTBOUND_MAX_RETRIES:
+                job.attempt += 1
+                logging.warning(
+                    f"Flood wait {e.timeout} с для чата {job.chat_id}, повторим отправку."
+                )
+                self._defer(job, 0)
+            else:
+                self.failed += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+        except Exception as e:
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.sent += 1
+            self._latencies.append(time.monotonic() - job.enqueued)
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._in_flight -= 1
+
+    def queue_depth(self) -> int:
+        queued = self._queue.qsize() if self._queue is not None else 0
+        return queued + self._delayed + self._in_flight
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+
+        def percentile(p: float) -> float:
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+        return {
+            "queue_depth": self.queue_depth(),
+            "delayed": self._delayed,
+            "in_flight": self._in_flight,
+            "sent": self.sent,
+            "failed": self.failed,
+            "flood_waits": self.flood_waits,
+            "latency_p50_ms": percentile(0.5) * 1000,
+            "latency_p95_ms": percentile(0.95) * 1000,
+        }
+
+
+OUTBOUND = OutboundScheduler()
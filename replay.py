@@ -0,0 +1,457 @@
+"""Повтор записанного трафика бота на заглушке Bot API.
+
+Журнал пишет сам бот, если задан TRAFFIC_RECORD_PATH (см. TrafficRecorder
+в bot.py). Обновления из журнала подаются боту через getUpdates заглушки
+из loadtest.py в исходном темпе, быстрее в N раз или без пауз; бот работает
+на временной базе. Результат — задержки хэндлеров по видам обновлений,
+обращения к БД и вызовы Bot API; его можно сравнить с прошлым прогоном
+(или с результатом loadtest.py --json). Запуск:
+
+    python replay.py traffic.jsonl --speed 1
+    python replay.py traffic.jsonl --speed max --json new.json --compare old.json
+
+С --compare код выхода 1, если p95 какого-то вида обновлений вырос больше
+допуска или вызовов API/БД стало больше.
+"""
+import argparse
+import asyncio
+import copy
+import importlib
+import json
+import logging
+import re
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from loadtest import FakeBotAPI, free_port, instrument, setup_environment, summarize
+
+# Номер заявки в данных кнопок: take_12, done_12, user_cancel_12
+TICKET_CALLBACK_RE = re.compile(r"^(.*_)(\d+)$")
+# Ответ продавцу «Заявка #12 создана.»
+CREATED_TICKET_RE = re.compile(r"^Заявка #(\d+) создана")
+
+TECH_CALLBACKS = ("take_", "done_")
+
+
+class TrafficLog:
+    """Обновления и вызовы API из журнала TrafficRecorder."""
+
+    def __init__(self):
+        self.updates: List[Tuple[float, dict]] = []
+        self.calls: Counter = Counter()
+        self.call_ms: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+        self.sessions = 0
+        self.duration = 0.0
+
+    @classmethod
+    def read(cls, path: str) -> "TrafficLog":
+        log = cls()
+        # Каждая сессия записи начинает отсчёт t с нуля — склеиваем их подряд
+        base = last = 0.0
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                kind = record["k"]
+                if kind == "session":
+                    log.sessions += 1
+                    base = last
+                    continue
+                last = base + record["t"]
+                if kind == "in":
+                    log.updates.append((last, record["u"]))
+                elif kind == "out":
+                    log.calls[record["m"]] += 1
+                    log.call_ms[record["m"]].append(record["ms"] / 1000)
+                    if "e" in record:
+                        log.errors[f"{record['m']}:{record['e']}"] += 1
+        log.duration = last
+        return log
+
+    def tech_ids(self) -> List[int]:
+        """Кто нажимал кнопки техника — их и назначаем техниками при повторе."""
+        ids = set()
+        for _, payload in self.updates:
+            call = payload.get("callback_query")
+            if call and call.get("data", "").startswith(TECH_CALLBACKS):
+                ids.add(call["from"]["id"])
+        return sorted(ids)
+
+
+class ReplayBotAPI(FakeBotAPI):
+    """Заглушка, которая запоминает номера заявок, созданных при повторе."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.created_tickets: List[int] = []
+
+    async def api_sendMessage(self, data: dict):
+        match = CREATED_TICKET_RE.match(data.get("text", ""))
+        if match:
+            self.created_tickets.append(int(match.group(1)))
+        return await super().api_sendMessage(data)
+
+
+class TicketMap:
+    """
+    Номера заявок в кнопках — из боевой базы, а повтор идёт на пустой.
+    Записанный номер, упомянутый k-м по счёту, заменяется на k-ю заявку,
+    созданную при повторе: в исходном темпе порядок обычно совпадает.
+    При быстром повторе нажатие ждёт, пока бот создаст k-ю заявку
+    (wait_ticket). Если её так и нет (заявка старше записи), номер
+    остаётся прежним, бот ответит «Заявка не найдена», а сравнение
+    прогонов сочтёт такие нажатия регрессией.
+    """
+
+    def __init__(self, api: ReplayBotAPI):
+        self.api = api
+        self._order: Dict[str, int] = {}
+        self.mapped = 0
+        self.unmapped = 0
+
+    def _ticket_index(self, payload: dict) -> Optional[int]:
+        call = payload.get("callback_query")
+        match = TICKET_CALLBACK_RE.match((call or {}).get("data") or "")
+        if not match:
+            return None
+        return self._order.setdefault(match.group(2), len(self._order))
+
+    async def wait_ticket(self, payload: dict, timeout: float):
+        """Ждёт (не дольше timeout), пока создана заявка для этого нажатия."""
+        index = self._ticket_index(payload)
+        if index is None:
+            return
+        deadline = time.monotonic() + timeout
+        while index >= len(self.api.created_tickets) and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+
+    def remap(self, payload: dict) -> dict:
+        call = payload.get("callback_query")
+        match = TICKET_CALLBACK_RE.match((call or {}).get("data") or "")
+        if not match:
+            return payload
+        prefix = match.group(1)
+        index = self._ticket_index(payload)
+        if index >= len(self.api.created_tickets):
+            self.unmapped += 1
+            return payload
+        self.mapped += 1
+        payload["callback_query"]["data"] = f"{prefix}{self.api.created_tickets[index]}"
+        return payload
+
+
+def with_fresh_dates(payload: dict) -> dict:
+    """Даты сообщений — на момент повтора, иначе бот сочтёт их устаревшими."""
+    payload = copy.deepcopy(payload)
+    now = int(time.time())
+    message = payload.get("message") or (payload.get("callback_query") or {}).get("message")
+    if message:
+        message["date"] = now
+    return payload
+
+
+def classify_update(update, recordable_texts) -> str:
+    """Вид обновления, по которому сравниваются задержки."""
+    call = update.callback_query
+    if call:
+        match = TICKET_CALLBACK_RE.match(call.data or "")
+        return f"callback:{match.group(1) if match else call.data}"
+    message = update.message
+    if message is None:
+        return "other"
+    if message.photo:
+        return "album" if message.media_group_id else "photo"
+    text = message.text or ""
+    if text.startswith("/"):
+        return text.split()[0]
+    if text in recordable_texts:
+        return f"button:{text}"
+    if text.isdigit():
+        return "digits"
+    return "text" if text else message.content_type
+
+
+async def feed(
+    api: ReplayBotAPI,
+    tickets: TicketMap,
+    updates: List[Tuple[float, dict]],
+    speed: Optional[float],
+    ticket_wait: float,
+):
+    started = time.monotonic()
+    for t, payload in updates:
+        if speed:
+            delay = t / speed - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        # Нажатие на ещё не созданную заявку ушло бы в «Заявка не найдена»
+        await tickets.wait_ticket(payload, ticket_wait)
+        api.push_update(tickets.remap(with_fresh_dates(payload)))
+
+
+async def wait_quiet(bot_module, api: FakeBotAPI, settle: float, timeout: float) -> bool:
+    """Ждёт, пока бот всё обработает и отправит, и ещё settle секунд тишины."""
+    deadline = time.monotonic() + timeout
+    quiet_since = None
+    while time.monotonic() < deadline:
+        busy = (
+            api.pending_updates
+            or bot_module.dp.stats()["pending"]
+            or bot_module.OUTBOUND.queue_depth()
+        )
+        if busy:
+            quiet_since = None
+        elif quiet_since is None:
+            quiet_since = time.monotonic()
+        elif time.monotonic() - quiet_since >= settle:
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+async def run(args, log: TrafficLog) -> dict:
+    import bot
+    from outbound import OutboundScheduler
+
+    if args.no_limits:
+        bot.OUTBOUND = OutboundScheduler(global_rate=1e6, chat_rate=1e6, group_rate=1e6)
+
+    bot.init_db()
+    bot.warm_profile_caches()
+    bot.load_config()
+    counters = instrument(
+        bot, lambda update: classify_update(update, bot.RECORDABLE_TEXTS)
+    )
+
+    api = ReplayBotAPI(flood_every=args.flood_every, retry_after=args.retry_after, latency=args.api_latency)
+    await api.start("127.0.0.1", args.port)
+
+    bot.Bot.set_current(bot.bot)
+    bot.Dispatcher.set_current(bot.dp)
+    await bot.on_startup(bot.dp)
+    stop = asyncio.Event()
+    polling = asyncio.create_task(bot.run_polling(stop))
+
+    started = time.monotonic()
+    tickets = TicketMap(api)
+    await feed(api, tickets, log.updates, args.speed, args.ticket_wait)
+    settled = await wait_quiet(bot, api, args.settle, args.timeout)
+    elapsed = time.monotonic() - started - (args.settle if settled else 0)
+
+    stop.set()
+    await polling
+    lanes = bot.dp.stats()
+    outbound = bot.OUTBOUND.stats()
+    await bot.on_shutdown(bot.dp)
+    await api.stop()
+    writes = bot.DB_WRITER.stats()
+
+    updates = len(log.updates) or 1
+    api_calls = {m: n for m, n in sorted(api.calls.items()) if m not in ("getUpdates", "deleteWebhook")}
+    return {
+        "config": {
+            "log": args.log,
+            "speed": args.speed or "max",
+            "sessions": log.sessions,
+            "recorded_s": log.duration,
+            "no_limits": args.no_limits,
+        },
+        "elapsed_s": elapsed,
+        "settled": settled,
+        "updates": {
+            "replayed": len(log.updates),
+            "processed": lanes["processed"],
+            "errors": lanes["errors"],
+            "per_second": lanes["processed"] / elapsed if elapsed else 0.0,
+            "lane_wait_p95_ms": lanes["wait_p95_ms"],
+        },
+        "tickets": {
+            "created": len(api.created_tickets),
+            "callbacks_mapped": tickets.mapped,
+            "callbacks_unmapped": tickets.unmapped,
+        },
+        "handlers": {kind: summarize(values) for kind, values in sorted(counters["handler"].items())},
+        "db": {
+            "reads": counters["db_reads"],
+            "write_ops": writes["ops"],
+            "commits": writes["batches"],
+            "reads_per_update": counters["db_reads"] / updates,
+            "write_ops_per_update": writes["ops"] / updates,
+            "commits_per_update": writes["batches"] / updates,
+        },
+        "api": {
+            "calls": api_calls,
+            "calls_per_update": sum(api_calls.values()) / updates,
+            "flood_responses": api.flood_responses,
+            "outbound_flood_waits": outbound["flood_waits"],
+            "outbound_failed": outbound["failed"],
+        },
+        "recorded_api": {
+            "calls": dict(sorted(log.calls.items())),
+            "latency": {m: summarize(v) for m, v in sorted(log.call_ms.items())},
+            "errors": dict(log.errors),
+        },
+    }
+
+
+def print_report(result: dict):
+    cfg = result["config"]
+    updates = result["updates"]
+    print(
+        f"Журнал: {cfg['log']} (сессий {cfg['sessions']}, записано {cfg['recorded_s']:.1f} с), "
+        f"скорость: {cfg['speed']}"
+    )
+    print(
+        f"Повтор: {result['elapsed_s']:.2f} с, обновлений {updates['processed']} из "
+        f"{updates['replayed']} ({updates['per_second']:.1f}/с), ошибок {updates['errors']}"
+    )
+    tickets = result["tickets"]
+    print(
+        f"Заявок создано: {tickets['created']}, нажатий с номером заявки из повтора: "
+        f"{tickets['callbacks_mapped']}, без соответствия: {tickets['callbacks_unmapped']}"
+    )
+    if not result["settled"]:
+        print("Внимание: бот не успел обработать всё до --timeout")
+
+    print("\nХэндлеры, мс                    кол-во     p50     p95     p99     max")
+    for kind, s in result["handlers"].items():
+        print(
+            f"  {kind:<30}{s['count']:>6}{s['p50_ms']:>8.1f}{s['p95_ms']:>8.1f}"
+            f"{s['p99_ms']:>8.1f}{s['max_ms']:>8.1f}"
+        )
+
+    db = result["db"]
+    print(
+        f"\nБД на обновление: чтений {db['reads_per_update']:.2f}, "
+        f"записей {db['write_ops_per_update']:.2f}, коммитов {db['commits_per_update']:.2f}"
+    )
+    recorded = result["recorded_api"]["calls"]
+    print("Bot API                     повтор  в записи")
+    for method in sorted(set(result["api"]["calls"]) | set(recorded)):
+        print(
+            f"  {method:<24}{result['api']['calls'].get(method, 0):>7}"
+            f"{recorded.get(method, 0):>10}"
+        )
+
+
+# ============ СРАВНЕНИЕ ПРОГОНОВ ============
+
+
+def compare(current: dict, baseline: dict, tolerance: float, min_delta_ms: float) -> List[str]:
+    """Печатает разницу с прошлым прогоном и возвращает список регрессий."""
+    regressions = []
+
+    print("\nСравнение p95, мс               было   стало")
+    for section in ("steps", "handlers"):
+        old_rows, new_rows = baseline.get(section, {}), current.get(section, {})
+        for kind in sorted(set(old_rows) & set(new_rows)):
+            old, new = old_rows[kind]["p95_ms"], new_rows[kind]["p95_ms"]
+            mark = ""
+            if new > old * (1 + tolerance) and new - old > min_delta_ms:
+                mark = "  ← регрессия"
+                regressions.append(f"{kind}: p95 {old:.1f} → {new:.1f} мс")
+            print(f"  {kind:<28}{old:>8.1f}{new:>8.1f}{mark}")
+
+    print("\nСравнение вызовов Bot API       было   стало")
+    old_calls = baseline.get("api", {}).get("calls", {})
+    new_calls = current.get("api", {}).get("calls", {})
+    for method in sorted(set(old_calls) | set(new_calls)):
+        old, new = old_calls.get(method, 0), new_calls.get(method, 0)
+        mark = ""
+        if new > old:
+            mark = "  ← больше вызовов"
+            regressions.append(f"{method}: {old} → {new} вызовов")
+        print(f"  {method:<28}{old:>8}{new:>8}{mark}")
+
+    print("\nСравнение БД                    было   стало")
+    old_db, new_db = baseline.get("db", {}), current.get("db", {})
+    for key in ("reads", "write_ops", "commits"):
+        if key not in old_db or key not in new_db:
+            continue
+        old, new = old_db[key], new_db[key]
+        mark = ""
+        if new > old * (1 + tolerance):
+            mark = "  ← регрессия"
+            regressions.append(f"БД {key}: {old} → {new}")
+        print(f"  {key:<28}{old:>8}{new:>8}{mark}")
+
+    old_unmapped = baseline.get("tickets", {}).get("callbacks_unmapped", 0)
+    new_unmapped = current.get("tickets", {}).get("callbacks_unmapped", 0)
+    if new_unmapped > old_unmapped:
+        # Такие нажатия бот отбил как «Заявка не найдена» — их задержки
+        # и вызовы API сравнивать с прошлым прогоном нельзя
+        regressions.append(f"нажатий без заявки из повтора: {old_unmapped} → {new_unmapped}")
+
+    if regressions:
+        print("\nРегрессии:\n  " + "\n  ".join(regressions))
+    else:
+        print("\nРегрессий нет.")
+    return regressions
+
+
+def parse_speed(value: str) -> Optional[float]:
+    if value == "max":
+        return None
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("скорость должна быть больше нуля или max")
+    return speed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("log", help="журнал TRAFFIC_RECORD_PATH")
+    parser.add_argument("--speed", type=parse_speed, default=1.0, help="1, N (во сколько раз быстрее) или max")
+    parser.add_argument("--flood-every", type=int, default=0, help="каждый N-й send/edit получает 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа API, с")
+    parser.add_argument("--no-limits", action="store_true", help="снять лимиты отправки Telegram")
+    parser.add_argument("--settle", type=float, default=2.0, help="сколько секунд тишины считать окончанием")
+    parser.add_argument("--ticket-wait", type=float, default=10.0, help="сколько ждать создания заявки перед нажатием на неё, с")
+    parser.add_argument("--timeout", type=float, default=300.0, help="ожидание обработки после подачи журнала")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--json", metavar="PATH", help="сохранить результат в JSON")
+    parser.add_argument("--compare", metavar="PATH", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимый рост p95 и обращений к БД")
+    parser.add_argument("--min-delta-ms", type=float, default=5.0, help="меньший рост p95 не считается")
+    parser.add_argument("--verbose", action="store_true", help="не глушить логи бота")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    args.port = args.port or free_port()
+    log = TrafficLog.read(args.log)
+    if not log.updates:
+        print(f"В журнале {args.log} нет обновлений.")
+        return 1
+
+    with tempfile.TemporaryDirectory(prefix="replay-") as workdir:
+        setup_environment(workdir, args.port, log.tech_ids())
+        # bot читает настройки из окружения при импорте — только после setup_environment()
+        importlib.import_module("bot")
+
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+        result = asyncio.run(run(args, log))
+
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(result, baseline, args.tolerance, args.min_delta_ms):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
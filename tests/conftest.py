@@ -0,0 +1,26 @@
+import os
+import tempfile
+
+import pytest
+
+# bot.py и db.py читают настройки из окружения при импорте: база и файлы
+# конфигурации тестов не должны попасть в рабочий каталог
+_TMP = tempfile.mkdtemp(prefix="bot-tests-")
+os.environ["DB_PATH"] = os.path.join(_TMP, "tickets.db")
+os.environ["STORES_FILE_PATH"] = os.path.join(_TMP, "stores.txt")
+os.environ["TECHS_FILE_PATH"] = os.path.join(_TMP, "techs.txt")
+
+
+@pytest.fixture
+def bot_module():
+    """bot.py на чистой временной базе; кэши сброшены."""
+    import bot
+
+    bot.init_db()
+    with bot.DB_POOL.connection() as conn:
+        bot.wipe_all_tables(conn.cursor())
+    bot.TICKET_CACHE.clear()
+    bot.SENDER_CACHE.clear()
+    bot.TECH_NAME_CACHE.clear()
+    bot.FSM_STORAGE.clear_cache()
+    return bot
@@ -0,0 +1,277 @@
+import asyncio
+import time
+
+import pytest
+from aiogram import Bot, types
+
+from lanes import LaneDispatcher
+
+
+def message_update(update_id: int, age: float = 0, user_id: int = 1) -> types.Update:
+    return types.Update.to_object({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time() - age),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Тест"},
+            "text": str(update_id),
+        },
+    })
+
+
+class FakeTelegram:
+    """getUpdates по накопленной очереди; страницы могут повторять обновления."""
+
+    def __init__(self, pages):
+        self.pages = list(pages)
+        self.offsets = []
+
+    async def delete_webhook(self, drop_pending_updates=False):
+        pass
+
+    async def get_updates(self, offset=None, limit=100, timeout=0, allowed_updates=None):
+        self.offsets.append(offset)
+        while self.pages:
+            page = [u for u in self.pages.pop(0) if offset is None or u.update_id >= offset]
+            if page:
+                return page[:limit]
+        return []
+
+
+class PollingTelegram:
+    """
+    Очередь обновлений как у Telegram: getUpdates(offset) удаляет всё до
+    offset (подтверждено) и отдаёт остальное, пока его не подтвердят.
+    """
+
+    def __init__(self, updates):
+        self.pending = list(updates)
+
+    async def delete_webhook(self, drop_pending_updates=False):
+        pass
+
+    async def get_updates(self, offset=None, limit=100, timeout=0, allowed_updates=None):
+        if offset:
+            self.pending = [u for u in self.pending if u.update_id >= offset]
+        if not self.pending and timeout:
+            await asyncio.sleep(0.01)
+        return self.pending[:limit]
+
+    def pending_ids(self):
+        return [u.update_id for u in self.pending]
+
+
+def make_dispatcher(handler) -> LaneDispatcher:
+    dp = LaneDispatcher(Bot(token="123456:" + "A" * 35))
+    dp.register_message_handler(handler)
+    return dp
+
+
+@pytest.fixture
+def backlog(bot_module, monkeypatch):
+    handled = []
+
+    async def handler(message: types.Message):
+        handled.append(int(message.text))
+
+    monkeypatch.setattr(bot_module, "dp", make_dispatcher(handler))
+    monkeypatch.setattr(bot_module, "_saved_update_mark", 0)
+    # /wipe_db отметку не трогает — каждый тест начинает без неё
+    with bot_module.DB_POOL.connection() as conn:
+        conn.execute("DELETE FROM bot_state;")
+
+    def drain(pages):
+        telegram = FakeTelegram(pages)
+        monkeypatch.setattr(bot_module, "bot", telegram)
+        offset = asyncio.run(bot_module.drain_backlog())
+        return offset, telegram
+
+    return bot_module, drain, handled
+
+
+def saved_mark(bot):
+    mark = bot.get_bot_state(bot.LAST_UPDATE_KEY)
+    return mark[0] if mark else None
+
+
+def test_first_start_skips_stale_messages_and_saves_mark(backlog):
+    bot, drain, handled = backlog
+    old = bot.BACKLOG_MAX_AGE_SECONDS + 60
+
+    offset, telegram = drain([[message_update(1), message_update(2, age=old), message_update(3)]])
+
+    assert handled == [1, 3]
+    assert offset == 4
+    assert telegram.offsets[0] is None
+    # устаревшее тоже считается принятым: повторно его не запросим
+    assert saved_mark(bot) == 3
+
+
+def test_duplicates_across_pages_are_handled_once(backlog):
+    bot, drain, handled = backlog
+
+    offset, _ = drain([
+        [message_update(1), message_update(2)],
+        [message_update(2), message_update(3)],  # 2 пришло повторно
+    ])
+
+    assert handled == [1, 2, 3]
+    assert offset == 4
+
+
+def test_restart_skips_updates_before_saved_mark(backlog):
+    bot, drain, handled = backlog
+    asyncio.run(bot.run_db_write(bot.set_bot_state, bot.LAST_UPDATE_KEY, 2))
+
+    offset, telegram = drain([[message_update(i) for i in range(1, 6)]])
+
+    assert telegram.offsets[0] == 3
+    assert handled == [3, 4, 5]
+    assert saved_mark(bot) == 5
+
+
+def test_outdated_mark_is_ignored(backlog, monkeypatch):
+    bot, drain, handled = backlog
+    asyncio.run(bot.run_db_write(bot.set_bot_state, bot.LAST_UPDATE_KEY, 100))
+    monkeypatch.setattr(bot, "LAST_UPDATE_MAX_AGE_SECONDS", -1)
+
+    _, telegram = drain([[message_update(1), message_update(2)]])
+
+    # Telegram начал нумерацию заново — старая отметка отбросила бы всё
+    assert telegram.offsets[0] is None
+    assert handled == [1, 2]
+
+
+def test_mark_stops_before_unfinished_update(backlog):
+    bot, _, handled = backlog
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def slow(message: types.Message):
+            if message.text == "2":
+                await release.wait()
+            handled.append(int(message.text))
+
+        bot.dp.message_handlers.handlers.clear()
+        bot.dp.register_message_handler(slow)
+        await bot.dp.process_updates([message_update(i) for i in range(1, 4)])
+        await asyncio.sleep(0.01)
+        await bot.remember_completed_updates()
+        while_blocked = saved_mark(bot)
+        release.set()
+        await bot.dp.wait_idle(timeout=5)
+        await bot.remember_completed_updates()
+        return while_blocked
+
+    assert asyncio.run(scenario()) == 1
+    assert saved_mark(bot) == 3
+
+
+async def wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "не дождались"
+        await asyncio.sleep(0.01)
+
+
+def test_updates_queued_at_crash_are_delivered_after_restart(backlog, monkeypatch):
+    bot, _, _ = backlog
+    telegram = PollingTelegram([])
+    monkeypatch.setattr(bot, "bot", telegram)
+    before_crash, after_restart = [], []
+
+    async def stuck_on_two(message: types.Message):
+        if message.text == "2":
+            await asyncio.Event().wait()  # процесс упадёт посреди обработки
+        before_crash.append(int(message.text))
+
+    async def handler(message: types.Message):
+        after_restart.append(int(message.text))
+
+    async def scenario():
+        bot.dp = make_dispatcher(stuck_on_two)
+        polling = asyncio.create_task(bot.run_polling(asyncio.Event()))
+        await asyncio.sleep(0.02)  # очередь простоя пуста — дальше long polling
+        telegram.pending += [message_update(i, user_id=i) for i in range(1, 5)]
+        await wait_for(lambda: len(before_crash) == 3)
+        await asyncio.sleep(0.05)  # ещё несколько getUpdates с тем же offset
+        polling.cancel()  # аварийная остановка: без дообработки и подтверждения
+        await asyncio.gather(polling, return_exceptions=True)
+        unconfirmed = telegram.pending_ids()
+
+        # Перезапуск: состояние процесса с нуля, отметка — из базы
+        bot.dp = make_dispatcher(handler)
+        bot._saved_update_mark = 0
+        stop = asyncio.Event()
+        polling = asyncio.create_task(bot.run_polling(stop))
+        await wait_for(lambda: 2 in after_restart)
+        stop.set()
+        await polling
+        return unconfirmed
+
+    unconfirmed = asyncio.run(scenario())
+
+    assert sorted(before_crash) == [1, 3, 4]
+    # Telegram подтверждено только то, что до незавершённого обновления
+    assert unconfirmed == [2, 3, 4]
+    # после перезапуска оно обработано; следующие за ним — повторно (at least once)
+    assert after_restart == [2, 3, 4]
+    assert saved_mark(bot) == 4
+    assert telegram.pending_ids() == []
+
+
+def test_shutdown_confirms_only_processed_updates(backlog, monkeypatch):
+    bot, _, _ = backlog
+    telegram = PollingTelegram([])
+    monkeypatch.setattr(bot, "bot", telegram)
+    monkeypatch.setattr(bot, "UPDATE_DRAIN_TIMEOUT", 0.05)
+    handled = []
+
+    async def stuck_on_two(message: types.Message):
+        if message.text == "2":
+            await asyncio.Event().wait()
+        handled.append(int(message.text))
+
+    async def scenario():
+        bot.dp = make_dispatcher(stuck_on_two)
+        stop = asyncio.Event()
+        polling = asyncio.create_task(bot.run_polling(stop))
+        await asyncio.sleep(0.02)
+        telegram.pending += [message_update(i, user_id=i) for i in range(1, 4)]
+        await wait_for(lambda: len(handled) == 2)
+        stop.set()
+        await polling  # дообработка не успевает за UPDATE_DRAIN_TIMEOUT
+
+    asyncio.run(scenario())
+
+    assert telegram.pending_ids() == [2, 3]
+    assert saved_mark(bot) == 1
+
+
+def test_polling_does_not_requeue_updates_in_progress(backlog, monkeypatch):
+    bot, _, _ = backlog
+    telegram = PollingTelegram([])
+    monkeypatch.setattr(bot, "bot", telegram)
+    calls = []
+
+    async def handler(message: types.Message):
+        calls.append(int(message.text))
+        if message.text == "1":
+            await asyncio.sleep(0.1)  # пока ждём, getUpdates отдаёт 1 снова
+
+    async def scenario():
+        bot.dp = make_dispatcher(handler)
+        stop = asyncio.Event()
+        polling = asyncio.create_task(bot.run_polling(stop))
+        await asyncio.sleep(0.02)
+        telegram.pending += [message_update(1), message_update(2, user_id=2)]
+        await wait_for(lambda: bot.dp.completed_update_id() == 2)
+        stop.set()
+        await polling
+
+    asyncio.run(scenario())
+
+    assert sorted(calls) == [1, 2]
+    assert telegram.pending_ids() == []
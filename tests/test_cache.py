@@ -0,0 +1,124 @@
+import asyncio
+
+from aiogram import types
+
+from bot import LRUCache
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.put(1, "a")
+    cache.put(2, "b")
+    assert cache.get(1) == "a"  # 1 стал свежее 2
+
+    cache.put(3, "c")
+
+    assert cache.get(2) is None
+    assert cache.get(1) == "a"
+    assert cache.get(3) == "c"
+    assert cache.evictions == 1
+    assert len(cache) == 2
+
+
+def test_load_started_before_write_is_not_cached():
+    cache = LRUCache(10)
+    token = cache.begin_load()
+    # пока читали из БД, запись сбросила ключ
+    cache.invalidate(1)
+
+    cache.put_loaded(1, "старое", token)
+
+    assert cache.get(1) is None
+    cache.put_loaded(1, "новое", cache.begin_load())
+    assert cache.get(1) == "новое"
+
+
+def test_slow_ticket_read_does_not_overwrite_transition(bot_module, monkeypatch):
+    bot = bot_module
+    ticket = asyncio.run(bot.create_ticket_async(
+        store="1",
+        sender_id=500,
+        sender_name="Продавец",
+        equipment="Весы",
+        description="Не включаются",
+        priority="обычная",
+        photo_ids=[],
+        tech_ids=[],
+    ))
+    ticket_id = ticket["ticket_id"]
+    bot.TICKET_CACHE.clear()
+    read = bot.run_db_read
+
+    async def scenario():
+        loaded = asyncio.Event()
+        release = asyncio.Event()
+
+        async def slow_read(func, *args):
+            result = await read(func, *args)
+            if func is bot.get_ticket_data:
+                loaded.set()
+                await release.wait()
+            return result
+
+        monkeypatch.setattr(bot, "run_db_read", slow_read)
+        lookup = asyncio.create_task(bot.get_ticket_data_async(ticket_id))
+        await loaded.wait()
+        # чтение уже вернуло «Создана», а заявку тем временем взяли
+        await bot.take_ticket_async(ticket_id, 7, "Техник")
+        release.set()
+        stale = await lookup
+        monkeypatch.setattr(bot, "run_db_read", read)
+        return stale, await bot.get_ticket_data_async(ticket_id)
+
+    stale, fresh = asyncio.run(scenario())
+
+    assert stale["status"] == bot.STATUS_CREATED
+    assert fresh["status"] == bot.STATUS_IN_PROGRESS
+
+
+def tech_user(user_id=7):
+    return types.User(id=user_id, is_bot=False, first_name="Telegram-имя")
+
+
+def test_technician_name_is_fresh_after_set_name(bot_module):
+    bot = bot_module
+    user = tech_user()
+
+    async def scenario():
+        before = await bot.get_technician_name_async(user)  # в кэше «имени нет»
+        await bot.set_technician_name_async(user.id, "Илья (камеры)")
+        return before, await bot.get_technician_name_async(user)
+
+    before, after = asyncio.run(scenario())
+
+    assert before == "Telegram-имя"
+    assert after == "Илья (камеры)"
+
+
+def test_slow_name_read_does_not_hide_new_name(bot_module, monkeypatch):
+    bot = bot_module
+    user = tech_user()
+    read = bot.run_db_read
+
+    async def scenario():
+        loaded = asyncio.Event()
+        release = asyncio.Event()
+
+        async def slow_read(func, *args):
+            result = await read(func, *args)
+            if func is bot.get_technician_display_name:
+                loaded.set()
+                await release.wait()
+            return result
+
+        monkeypatch.setattr(bot, "run_db_read", slow_read)
+        lookup = asyncio.create_task(bot.get_technician_name_async(user))
+        await loaded.wait()
+        # /settechname прошёл, пока чтение ещё не вернулось
+        await bot.set_technician_name_async(user.id, "Илья (камеры)")
+        release.set()
+        await lookup
+        monkeypatch.setattr(bot, "run_db_read", read)
+        return await bot.get_technician_name_async(user)
+
+    assert asyncio.run(scenario()) == "Илья (камеры)"
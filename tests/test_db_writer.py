@@ -0,0 +1,80 @@
+import asyncio
+import threading
+
+import pytest
+
+import db
+
+
+@pytest.fixture
+def writer(tmp_path):
+    pool = db.SQLiteConnectionManager(str(tmp_path / "test.db"))
+    with pool.connection() as conn:
+        conn.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT NOT NULL);")
+    writer = db.GroupCommitWriter(pool, max_delay_ms=50, max_ops=100)
+    yield writer
+    writer.stop()
+    pool.close_all()
+
+
+def insert(cur, item_id, name):
+    cur.execute("INSERT INTO items (id, name) VALUES (?, ?);", (item_id, name))
+    return cur.lastrowid
+
+
+def count(pool):
+    with pool.connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM items;").fetchone()[0]
+
+
+def test_ops_submitted_together_share_one_commit(writer):
+    futures = [writer.submit(insert, i, f"item {i}") for i in range(10)]
+
+    assert [f.result(timeout=5) for f in futures] == list(range(10))
+    assert count(writer.pool) == 10
+    stats = writer.stats()
+    assert stats["ops"] == 10
+    assert stats["batches"] < 10
+
+
+def test_failed_op_rolls_back_only_itself(writer):
+    def insert_two(cur):
+        # обе строки в одном SAVEPOINT: вторая падает — откатывается и первая
+        insert(cur, 100, "first")
+        insert(cur, 1, "duplicate")
+
+    ok_before = writer.submit(insert, 1, "one")
+    failed = writer.submit(insert_two)
+    ok_after = writer.submit(insert, 2, "two")
+
+    assert ok_before.result(timeout=5) == 1
+    with pytest.raises(Exception):
+        failed.result(timeout=5)
+    assert ok_after.result(timeout=5) == 2
+    assert count(writer.pool) == 2
+    assert writer.stats()["failed_ops"] == 1
+
+
+def test_stop_flushes_queued_ops(writer):
+    release = threading.Event()
+
+    def blocker(cur):
+        release.wait(5)
+
+    writer.submit(blocker)
+    futures = [writer.submit(insert, i, "queued") for i in range(5)]
+    release.set()
+    writer.stop()
+
+    assert all(f.done() and f.exception() is None for f in futures)
+    assert count(writer.pool) == 5
+
+
+def test_run_db_write_waits_for_commit(writer, monkeypatch):
+    monkeypatch.setattr(db, "DB_WRITER", writer)
+
+    async def main():
+        await db.run_db_write(insert, 7, "seven")
+        return await db.run_db_read(count, writer.pool)
+
+    assert asyncio.run(main()) == 1
@@ -0,0 +1,179 @@
+import asyncio
+import contextvars
+
+import pytest
+from aiogram import Bot, types
+
+from lanes import LaneDispatcher, update_lane_key
+
+SEEN: contextvars.ContextVar = contextvars.ContextVar("seen", default=None)
+
+
+def message_update(update_id: int, user_id: int, text: str = "") -> types.Update:
+    return types.Update.to_object({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Тест"},
+            "text": text or str(update_id),
+        },
+    })
+
+
+def make_dispatcher(handler, **kwargs) -> LaneDispatcher:
+    bot = Bot(token="123456:" + "A" * 35)
+    dp = LaneDispatcher(bot, **kwargs)
+    dp.register_message_handler(handler)
+    return dp
+
+
+def test_updates_of_one_lane_run_in_order_and_lanes_run_in_parallel():
+    log = []
+
+    async def handler(message: types.Message):
+        user_id = message.from_user.id
+        log.append(("start", user_id, message.text))
+        # первое обновление линии — самое медленное: следующие не должны обогнать
+        await asyncio.sleep(0.05 if message.text.endswith("1") else 0)
+        log.append(("end", user_id, message.text))
+
+    async def main():
+        dp = make_dispatcher(handler)
+        await dp.process_updates([
+            message_update(1, 1, "a1"), message_update(2, 1, "a2"),
+            message_update(3, 2, "b1"), message_update(4, 1, "a3"),
+        ])
+        assert await dp.wait_idle(timeout=5)
+        return dp.stats()
+
+    stats = asyncio.run(main())
+
+    lane_a = [text for event, user, text in log if user == 1]
+    assert lane_a == ["a1", "a1", "a2", "a2", "a3", "a3"]
+    # линия 2 началась, пока первое обновление линии 1 ещё обрабатывалось
+    assert log.index(("start", 2, "b1")) < log.index(("end", 1, "a1"))
+    assert stats["processed"] == 4
+    assert stats["pending"] == 0
+
+
+def test_each_update_gets_its_own_context():
+    seen = []
+
+    async def handler(message: types.Message):
+        seen.append(SEEN.get())
+        SEEN.set(message.text)
+
+    async def main():
+        dp = make_dispatcher(handler)
+        await dp.process_updates([message_update(i, 1) for i in range(1, 4)])
+        await dp.wait_idle(timeout=5)
+
+    asyncio.run(main())
+    assert seen == [None, None, None]
+
+
+def test_error_does_not_stop_the_lane():
+    handled = []
+
+    async def handler(message: types.Message):
+        if message.text == "boom":
+            raise RuntimeError("boom")
+        handled.append(message.text)
+
+    async def main():
+        dp = make_dispatcher(handler)
+        await dp.process_updates([message_update(1, 1, "boom"), message_update(2, 1, "ok")])
+        await dp.wait_idle(timeout=5)
+        return dp.stats()
+
+    stats = asyncio.run(main())
+    assert handled == ["ok"]
+    assert stats["errors"] == 1
+    assert stats["processed"] == 2
+
+
+def test_completed_update_id_waits_for_earliest_unfinished():
+    async def main():
+        release = asyncio.Event()
+
+        async def handler(message: types.Message):
+            if message.text == "slow":
+                await release.wait()
+
+        dp = make_dispatcher(handler)
+        await dp.process_updates([
+            message_update(10, 1),
+            message_update(11, 2, "slow"),
+            message_update(12, 3),
+        ])
+        await asyncio.sleep(0.01)
+        marks = [dp.completed_update_id()]  # 10 и 12 готовы, 11 ещё нет
+        release.set()
+        await dp.wait_idle(timeout=5)
+        marks.append(dp.completed_update_id())
+        dp.mark_received(15)  # пропущено без обработки (например, дубль)
+        marks.append(dp.completed_update_id())
+        return marks
+
+    assert asyncio.run(main()) == [10, 12, 15]
+
+
+def test_enqueue_waits_when_too_many_pending():
+    async def main():
+        release = asyncio.Event()
+        enqueued = []
+
+        async def handler(message: types.Message):
+            await release.wait()
+
+        dp = make_dispatcher(
+            handler, max_pending=2, on_enqueue=lambda update: enqueued.append(update.update_id)
+        )
+        feeding = asyncio.create_task(
+            dp.process_updates([message_update(i, 1) for i in range(1, 5)])
+        )
+        await asyncio.sleep(0.01)
+        blocked = list(enqueued)
+        release.set()
+        await asyncio.wait_for(feeding, timeout=5)
+        await dp.wait_idle(timeout=5)
+        return blocked, enqueued, dp.stats()
+
+    blocked, enqueued, stats = asyncio.run(main())
+    assert blocked == [1, 2]
+    assert enqueued == [1, 2, 3, 4]
+    assert stats["backpressure_waits"] >= 1
+
+
+@pytest.mark.parametrize("kind", ["message", "callback_query"])
+def test_lane_key_for_callbacks_uses_message_chat(kind):
+    user = {"id": 5, "is_bot": False, "first_name": "Тест"}
+    message = {"message_id": 1, "date": 0, "chat": {"id": -100, "type": "group"}, "from": user}
+    if kind == "message":
+        update = types.Update.to_object({"update_id": 1, "message": message})
+    else:
+        update = types.Update.to_object({
+            "update_id": 1,
+            "callback_query": {"id": "1", "from": user, "chat_instance": "x", "message": message},
+        })
+    assert update_lane_key(update) == (-100, 5)
+
+
+def test_wait_completed_returns_once_mark_passes():
+    async def main():
+        release = asyncio.Event()
+
+        async def handler(message: types.Message):
+            await release.wait()
+
+        dp = make_dispatcher(handler)
+        await dp.process_updates([message_update(5, 1)])
+        received = (dp.was_received(5), dp.was_received(6))
+        timed_out = await dp.wait_completed(4, timeout=0.01)
+        waiter = asyncio.create_task(dp.wait_completed(4, timeout=5))
+        release.set()
+        return received, timed_out, await waiter
+
+    assert asyncio.run(main()) == ((True, False), False, True)
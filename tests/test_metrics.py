@@ -0,0 +1,60 @@
+import asyncio
+
+import metrics
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = metrics.HistogramMetric("t_seconds", "Тест", ("handler",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, "a")
+    histogram.observe(0.5, "a")
+    histogram.observe(5.0, "a")
+
+    lines = histogram.render().splitlines()
+
+    assert 't_seconds_bucket{handler="a",le="0.1"} 1' in lines
+    assert 't_seconds_bucket{handler="a",le="1"} 2' in lines
+    assert 't_seconds_bucket{handler="a",le="+Inf"} 3' in lines
+    assert 't_seconds_count{handler="a"} 3' in lines
+
+
+def test_labels_are_escaped():
+    counter = metrics.CounterMetric("t_total", "Тест", ("name",))
+    counter.inc('a"b\\c')
+
+    assert 't_total{name="a\\"b\\\\c"} 1' in counter.render().splitlines()
+
+
+def test_timed_phase_counts_only_inside_update():
+    @metrics.timed_phase("render")
+    def render():
+        return "text"
+
+    assert render() == "text"  # вне обновления фазы не ведутся
+
+    phases = {}
+    token = metrics.UPDATE_PHASES.set(phases)
+    try:
+        render()
+        render()
+    finally:
+        metrics.UPDATE_PHASES.reset(token)
+
+    assert phases["render_calls"] == 2
+    assert phases["render"] >= 0
+
+
+def test_detached_context_hides_update_phases():
+    async def background():
+        metrics.add_update_phase("api", 1.0)
+
+    async def handler():
+        phases = {}
+        metrics.UPDATE_PHASES.set(phases)
+        loop = asyncio.get_running_loop()
+        await loop.create_task(background(), context=metrics.detached_context())
+        metrics.add_update_phase("db", 0.5)
+        return phases
+
+    phases = asyncio.run(handler())
+
+    assert phases == {"db": 0.5, "db_calls": 1}
@@ -0,0 +1,222 @@
+import asyncio
+import types
+
+import pytest
+from aiogram.utils import exceptions
+
+import outbound
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(outbound, "time", types.SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+def test_bucket_allows_burst_up_to_capacity(clock):
+    bucket = outbound.TokenBucket(rate=2.0, capacity=2.0)
+
+    assert bucket.delay() == 0
+    bucket.take()
+    assert bucket.delay() == 0
+    bucket.take()
+    assert bucket.delay() == pytest.approx(0.5)
+
+
+def test_bucket_refills_at_rate_without_exceeding_capacity(clock):
+    bucket = outbound.TokenBucket(rate=1.0)
+    bucket.take()
+    assert bucket.delay() == pytest.approx(1.0)
+
+    clock.now += 0.25
+    assert bucket.delay() == pytest.approx(0.75)
+
+    clock.now += 100
+    assert bucket.idle()
+    bucket.take()
+    assert bucket.delay() == pytest.approx(1.0)
+
+
+def test_bucket_block_overrides_available_tokens(clock):
+    bucket = outbound.TokenBucket(rate=1.0)
+    bucket.block(30)
+
+    assert bucket.delay() == pytest.approx(30)
+    assert not bucket.idle()
+    clock.now += 30
+    assert bucket.delay() == 0
+
+
+def run_scheduler(coro_factory, **kwargs):
+    async def main():
+        scheduler = outbound.OutboundScheduler(**kwargs)
+        try:
+            return await coro_factory(scheduler)
+        finally:
+            await scheduler.stop(timeout=0)
+
+    return asyncio.run(main())
+
+
+def test_higher_priority_jobs_go_first():
+    sent = []
+
+    async def method(chat_id, text):
+        sent.append(text)
+
+    async def scenario(scheduler):
+        sends = [
+            scheduler.send(method, chat_id=chat_id, text=text, priority=priority)
+            for chat_id, text, priority in [
+                (1, "bulk", outbound.PRIORITY_BULK),
+                (2, "normal", outbound.PRIORITY_NORMAL),
+                (3, "high", outbound.PRIORITY_HIGH),
+            ]
+        ]
+        tasks = [asyncio.create_task(send) for send in sends]
+        await asyncio.sleep(0)  # все три в очереди до старта воркера
+        scheduler.start()
+        await asyncio.gather(*tasks)
+
+    run_scheduler(scenario, workers=1, global_rate=1e6, chat_rate=1e6)
+    assert sent == ["high", "normal", "bulk"]
+
+
+def test_same_chat_is_rate_limited_but_others_are_not():
+    sent = []
+
+    async def method(chat_id):
+        sent.append((chat_id, asyncio.get_running_loop().time()))
+
+    async def scenario(scheduler):
+        scheduler.start()
+        started = asyncio.get_running_loop().time()
+        await asyncio.gather(
+            scheduler.send(method, chat_id=1),
+            scheduler.send(method, chat_id=1),
+            scheduler.send(method, chat_id=2),
+        )
+        return started
+
+    started = run_scheduler(scenario, workers=4, global_rate=1e6, chat_rate=10, chat_burst=1)
+    times = {}
+    for chat_id, at in sent:
+        times.setdefault(chat_id, []).append(at - started)
+    assert times[2][0] < 0.05
+    assert times[1][1] - times[1][0] >= 0.09  # второе в чат 1 — через 1/10 с
+
+
+def test_retry_after_blocks_chat_and_retries():
+    calls = []
+
+    async def method(chat_id):
+        calls.append(asyncio.get_running_loop().time())
+        if len(calls) == 1:
+            raise exceptions.RetryAfter(0.1)
+        return "ok"
+
+    async def scenario(scheduler):
+        scheduler.start()
+        return await scheduler.send(method, chat_id=1), scheduler.stats()
+
+    result, stats = run_scheduler(scenario, workers=1, global_rate=1e6, chat_rate=1e6)
+    assert result == "ok"
+    assert calls[1] - calls[0] >= 0.09
+    assert stats["flood_waits"] == 1
+    assert stats["sent"] == 1
+    assert stats["failed"] == 0
+
+
+def test_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(outbound, "OUTBOUND_MAX_RETRIES", 1)
+    calls = []
+
+    async def method(chat_id):
+        calls.append(chat_id)
+        raise exceptions.RetryAfter(0)
+
+    async def scenario(scheduler):
+        scheduler.start()
+        with pytest.raises(exceptions.RetryAfter):
+            await scheduler.send(method, chat_id=1)
+        return scheduler.stats()
+
+    stats = run_scheduler(scenario, workers=1, global_rate=1e6, chat_rate=1e6)
+    assert len(calls) == 2
+    assert stats["failed"] == 1
+
+
+def test_worker_survives_caller_cancelled_during_retries(monkeypatch):
+    monkeypatch.setattr(outbound, "OUTBOUND_MAX_RETRIES", 1)
+
+    async def scenario(scheduler):
+        last_attempt = asyncio.Event()
+        release = asyncio.Event()
+        attempts = []
+
+        async def flooded(chat_id):
+            attempts.append(chat_id)
+            if len(attempts) > outbound.OUTBOUND_MAX_RETRIES:
+                last_attempt.set()
+                await release.wait()
+            raise exceptions.RetryAfter(0)
+
+        async def ok(chat_id):
+            return "ok"
+
+        scheduler.start()
+        caller = asyncio.create_task(scheduler.send(flooded, chat_id=1))
+        await last_attempt.wait()
+        caller.cancel()  # вызывающий ушёл, пока в полёте последняя попытка
+        release.set()
+        # повторы исчерпаны уже без вызывающего — единственный воркер жив
+        return await asyncio.wait_for(scheduler.send(ok, chat_id=2), timeout=2)
+
+    assert run_scheduler(scenario, workers=1, global_rate=1e6, chat_rate=1e6) == "ok"
+
+
+def test_handler_replies_go_through_queue_at_high_priority(bot_module, monkeypatch):
+    from aiogram.bot.base import BaseBot
+
+    bot = bot_module
+    api_calls = []
+
+    async def fake_request(self, method, data=None, files=None, **kwargs):
+        api_calls.append((method, outbound.in_outbound_worker()))
+        return True
+
+    monkeypatch.setattr(BaseBot, "request", fake_request)
+    scheduler = outbound.OutboundScheduler(workers=1, global_rate=1e6, chat_rate=1e6)
+    monkeypatch.setattr(bot, "OUTBOUND", scheduler)
+    priorities = []
+    send = scheduler.send
+
+    async def recording_send(method, *, priority=outbound.PRIORITY_NORMAL, **kwargs):
+        priorities.append(priority)
+        return await send(method, priority=priority, **kwargs)
+
+    monkeypatch.setattr(scheduler, "send", recording_send)
+
+    async def scenario():
+        scheduler.start()
+        try:
+            # как message.answer и call.answer из хэндлера
+            await bot.bot.request("sendMessage", {"chat_id": 5, "text": "Готово"})
+            await bot.bot.request("answerCallbackQuery", {"callback_query_id": "1"})
+        finally:
+            await scheduler.stop(timeout=0)
+
+    asyncio.run(scenario())
+
+    assert api_calls == [("sendMessage", True), ("answerCallbackQuery", False)]
+    assert priorities == [outbound.PRIORITY_HIGH]
+    assert scheduler.sent == 1
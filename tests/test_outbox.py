@@ -0,0 +1,218 @@
+import asyncio
+import itertools
+import time
+import types
+
+import pytest
+from aiogram.utils import exceptions
+
+ADMIN_CHAT = -100
+TECHS = [11, 12]
+
+
+class FakeBot:
+    """Вместо Bot API: запоминает отправки, может падать или ждать по чату."""
+
+    def __init__(self):
+        self.sent = []
+        # (метод, chat_id) -> список исключений на ближайшие вызовы
+        self.errors = {}
+        self.gates = {}  # chat_id -> asyncio.Event, до которого отправка ждёт
+        self._ids = itertools.count(1)
+
+    async def _send(self, method, chat_id, **kwargs):
+        gate = self.gates.get(chat_id)
+        if gate is not None:
+            await gate.wait()
+        errors = self.errors.get((method, chat_id))
+        if errors:
+            raise errors.pop(0)
+        self.sent.append((method, chat_id))
+        return types.SimpleNamespace(message_id=next(self._ids))
+
+    async def send_message(self, chat_id, **kwargs):
+        return await self._send("send_message", chat_id, **kwargs)
+
+    async def send_photo(self, chat_id, **kwargs):
+        return await self._send("send_photo", chat_id, **kwargs)
+
+    async def send_media_group(self, chat_id, **kwargs):
+        return [await self._send("send_media_group", chat_id, **kwargs)]
+
+
+class DirectOutbound:
+    async def send(self, method, *, priority=None, **kwargs):
+        return await method(**kwargs)
+
+
+@pytest.fixture
+def outbox_bot(bot_module, monkeypatch):
+    fake = FakeBot()
+    monkeypatch.setattr(bot_module, "bot", fake)
+    monkeypatch.setattr(bot_module, "OUTBOUND", DirectOutbound())
+    monkeypatch.setattr(bot_module, "ADMIN_CHAT_ID", ADMIN_CHAT)
+    return bot_module, fake
+
+
+async def add_ticket(bot, photo_ids=()):
+    return await bot.create_ticket_async(
+        store="1",
+        sender_id=500,
+        sender_name="Продавец",
+        equipment="Весы",
+        description="Не включаются",
+        priority="обычная",
+        photo_ids=list(photo_ids),
+        tech_ids=TECHS,
+    )
+
+
+def create_ticket(bot, photo_ids=()):
+    return asyncio.run(add_ticket(bot, photo_ids))
+
+
+def outbox_rows(bot):
+    with bot.DB_POOL.connection() as conn:
+        return conn.execute(
+            "SELECT chat_id, attempts, status, next_attempt_ts FROM outbox ORDER BY id;"
+        ).fetchall()
+
+
+def process_due(bot):
+    async def run():
+        for item in bot.fetch_due_outbox(100):
+            await bot.process_outbox_item(item)
+
+    asyncio.run(run())
+
+
+def test_delivery_records_messages_and_clears_outbox(outbox_bot):
+    bot, fake = outbox_bot
+    ticket_id = create_ticket(bot, photo_ids=["photo"])["ticket_id"]
+
+    process_due(bot)
+
+    assert sorted(fake.sent) == sorted(
+        [("send_photo", ADMIN_CHAT)] + [("send_photo", tech) for tech in TECHS]
+    )
+    assert outbox_rows(bot) == []
+    assert bot.get_ticket_data(ticket_id)["admin_msg_id"]
+    assert sorted(c["chat_id"] for c in bot.get_ticket_messages(ticket_id)) == TECHS
+
+
+def test_repeated_delivery_does_not_send_twice(outbox_bot):
+    bot, fake = outbox_bot
+    create_ticket(bot)
+    items = bot.fetch_due_outbox(100)
+
+    async def run():
+        for item in items:
+            await bot.deliver_outbox_item(item)
+        # та же пачка ещё раз — как если бы строку взяли повторно
+        for item in items:
+            await bot.deliver_outbox_item(item)
+
+    asyncio.run(run())
+
+    assert len(fake.sent) == 1 + len(TECHS)
+    assert outbox_rows(bot) == []
+
+
+def test_album_is_not_resent_when_card_fails(outbox_bot):
+    bot, fake = outbox_bot
+    fake.errors[("send_message", ADMIN_CHAT)] = [exceptions.NetworkError("timeout")]
+    ticket_id = create_ticket(bot, photo_ids=["photo 1", "photo 2"])["ticket_id"]
+
+    process_due(bot)
+    with bot.DB_POOL.connection() as conn:
+        conn.execute("UPDATE outbox SET next_attempt_ts = 0;")
+    process_due(bot)
+
+    for chat_id in [ADMIN_CHAT] + TECHS:
+        assert fake.sent.count(("send_media_group", chat_id)) == 1
+        assert fake.sent.count(("send_message", chat_id)) == 1
+    assert outbox_rows(bot) == []
+    assert bot.get_ticket_data(ticket_id)["admin_msg_id"]
+
+
+def test_tech_copy_of_closed_ticket_is_dropped(outbox_bot):
+    bot, fake = outbox_bot
+    ticket_id = create_ticket(bot)["ticket_id"]
+    asyncio.run(bot.cancel_ticket_by_sender_async(ticket_id, 500))
+
+    process_due(bot)
+
+    assert fake.sent == [("send_message", ADMIN_CHAT)]
+    assert outbox_rows(bot) == []
+
+
+def test_failed_send_is_retried_later(outbox_bot):
+    bot, fake = outbox_bot
+    fake.errors[("send_message", TECHS[0])] = [exceptions.NetworkError("timeout")]
+    create_ticket(bot)
+
+    process_due(bot)
+
+    ((chat_id, attempts, status, next_attempt_ts),) = outbox_rows(bot)
+    assert (chat_id, attempts, status) == (TECHS[0], 1, "pending")
+    assert next_attempt_ts > time.time()
+    assert bot.fetch_due_outbox(100) == []  # до срока повтора не берётся
+
+    with bot.DB_POOL.connection() as conn:
+        conn.execute("UPDATE outbox SET next_attempt_ts = 0;")
+    process_due(bot)
+
+    assert outbox_rows(bot) == []
+    assert fake.sent.count(("send_message", TECHS[0])) == 1
+
+
+def test_permanent_error_is_not_retried(outbox_bot):
+    bot, fake = outbox_bot
+    fake.errors[("send_message", TECHS[0])] = [exceptions.ChatNotFound("Chat not found")]
+    create_ticket(bot)
+
+    process_due(bot)
+
+    assert [row[:3] for row in outbox_rows(bot)] == [(TECHS[0], 1, "failed")]
+
+
+def test_gives_up_after_max_attempts(outbox_bot, monkeypatch):
+    bot, fake = outbox_bot
+    monkeypatch.setattr(bot, "OUTBOX_MAX_ATTEMPTS", 2)
+    fake.errors[("send_message", TECHS[0])] = [exceptions.NetworkError("timeout")] * 2
+    create_ticket(bot)
+
+    process_due(bot)
+    with bot.DB_POOL.connection() as conn:
+        conn.execute("UPDATE outbox SET next_attempt_ts = 0;")
+    process_due(bot)
+
+    assert [row[:3] for row in outbox_rows(bot)] == [(TECHS[0], 2, "failed")]
+
+
+def test_slow_admin_chat_does_not_hold_tech_notifications(outbox_bot):
+    bot, fake = outbox_bot
+
+    async def run():
+        fake.gates[ADMIN_CHAT] = asyncio.Event()
+        await add_ticket(bot)
+        await add_ticket(bot)
+        bot.start_outbox_dispatcher()
+        try:
+            deadline = time.monotonic() + 5
+            # копии техникам обеих заявок уходят, пока чат руководства ждёт
+            while len(fake.sent) < 2 * len(TECHS) and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+            delivered_while_blocked = list(fake.sent)
+            fake.gates[ADMIN_CHAT].set()
+            while len(fake.sent) < 2 * (1 + len(TECHS)) and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+        finally:
+            await bot.stop_outbox_dispatcher()
+        return delivered_while_blocked
+
+    delivered_while_blocked = asyncio.run(run())
+
+    assert sorted(chat for _, chat in delivered_while_blocked) == sorted(TECHS * 2)
+    assert [chat for _, chat in fake.sent].count(ADMIN_CHAT) == 2
+    assert outbox_rows(bot) == []
@@ -0,0 +1,184 @@
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+
+
+def new_ticket(bot, sender_id=500):
+    async def create():
+        return await bot.create_ticket_async(
+            store="1",
+            sender_id=sender_id,
+            sender_name="Продавец",
+            equipment="Весы",
+            description="Не включаются",
+            priority="обычная",
+            photo_ids=[],
+            tech_ids=[],
+        )
+
+    return asyncio.run(create())
+
+
+def test_only_one_of_concurrent_takes_wins(bot_module):
+    bot = bot_module
+    ticket_id = new_ticket(bot)["ticket_id"]
+
+    async def race():
+        return await asyncio.gather(*[
+            bot.take_ticket_async(ticket_id, tech_id, f"Техник {tech_id}")
+            for tech_id in range(1, 11)
+        ])
+
+    results = asyncio.run(race())
+
+    winners = [ticket["executor_id"] for won, ticket in results if won]
+    assert len(winners) == 1
+    # проигравшие получают заявку в состоянии после победившего перехода
+    for won, ticket in results:
+        assert ticket["status"] == bot.STATUS_IN_PROGRESS
+        assert ticket["executor_id"] == winners[0]
+    assert bot.get_ticket_data(ticket_id)["executor_id"] == winners[0]
+
+
+def test_take_race_across_connections(bot_module):
+    """Условный UPDATE защищает и от писателей из других соединений."""
+    bot = bot_module
+    ticket_id = new_ticket(bot)["ticket_id"]
+    start = threading.Barrier(8)
+    results = []
+
+    def take(tech_id):
+        conn = sqlite3.connect(bot.DB_POOL.path, timeout=10)
+        try:
+            start.wait()
+            conn.execute("BEGIN IMMEDIATE;")
+            won, _ = bot.take_ticket(conn.cursor(), ticket_id, tech_id, "Техник")
+            conn.commit()
+            results.append((tech_id, won))
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=take, args=(tech_id,)) for tech_id in range(1, 9)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    winners = [tech_id for tech_id, won in results if won]
+    assert len(results) == 8
+    assert len(winners) == 1
+    assert bot.get_ticket_data(ticket_id)["executor_id"] == winners[0]
+
+
+def test_done_only_by_executor_and_only_once(bot_module):
+    bot = bot_module
+    ticket_id = new_ticket(bot)["ticket_id"]
+
+    async def scenario():
+        await bot.take_ticket_async(ticket_id, 1, "Исполнитель")
+        stranger = await bot.complete_ticket_async(ticket_id, 2, "Чужой")
+        both = await asyncio.gather(
+            bot.complete_ticket_async(ticket_id, 1, "Исполнитель"),
+            bot.complete_ticket_async(ticket_id, 1, "Исполнитель"),
+        )
+        return stranger, both
+
+    (stranger_won, stranger_ticket), both = asyncio.run(scenario())
+
+    assert not stranger_won
+    assert stranger_ticket["status"] == bot.STATUS_IN_PROGRESS
+    assert sorted(won for won, _ in both) == [False, True]
+    assert all(ticket["status"] == bot.STATUS_DONE for _, ticket in both)
+
+
+@pytest.mark.parametrize("first", ["take", "cancel"])
+def test_take_and_cancel_race(bot_module, first):
+    bot = bot_module
+    ticket_id = new_ticket(bot, sender_id=500)["ticket_id"]
+    take = bot.take_ticket_async(ticket_id, 1, "Техник")
+    cancel = bot.cancel_ticket_by_sender_async(ticket_id, 500)
+
+    async def race():
+        # DB_WRITER выполняет записи в порядке постановки
+        pair = (take, cancel) if first == "take" else (cancel, take)
+        return await asyncio.gather(*pair)
+
+    (_, first_ticket), (second_won, final) = asyncio.run(race())
+
+    if first == "take":
+        # взятую заявку отправитель ещё может отменить
+        assert second_won
+        assert final["status"] == bot.STATUS_CANCELLED
+    else:
+        assert not second_won
+        assert final["status"] == bot.STATUS_CANCELLED
+        assert final["executor_id"] is None
+
+
+def test_transition_updates_cache_with_row_from_update(bot_module):
+    bot = bot_module
+    ticket_id = new_ticket(bot)["ticket_id"]
+
+    asyncio.run(bot.take_ticket_async(ticket_id, 7, "Техник"))
+
+    cached = asyncio.run(bot.get_ticket_data_async(ticket_id))
+    assert cached["status"] == bot.STATUS_IN_PROGRESS
+    assert cached["executor_id"] == 7
+
+
+class EditingBot:
+    """Запоминает правки копий; первая правка ждёт, пока её не отпустят."""
+
+    def __init__(self):
+        self.edits = []  # (chat_id, текст)
+        self.release_first = asyncio.Event()
+        self._calls = 0
+
+    async def edit_message_text(self, chat_id, text, **kwargs):
+        self._calls += 1
+        if self._calls == 1:
+            await self.release_first.wait()
+        self.edits.append((chat_id, text))
+
+
+class DirectOutbound:
+    async def send(self, method, *, priority=None, **kwargs):
+        return await method(**kwargs)
+
+
+def test_back_to_back_transitions_leave_copies_with_final_status(bot_module, monkeypatch):
+    bot = bot_module
+    fake = EditingBot()
+    monkeypatch.setattr(bot, "bot", fake)
+    monkeypatch.setattr(bot, "OUTBOUND", DirectOutbound())
+    monkeypatch.setattr(bot, "TECH_COPY_SYNCER", bot.TechCopySyncer())
+    ticket_id = new_ticket(bot)["ticket_id"]
+    techs = [11, 12]
+
+    async def scenario():
+        for message_id, tech_id in enumerate(techs, start=1):
+            await bot.run_db_write(
+                bot.add_ticket_message, ticket_id, tech_id, message_id, bot.MESSAGE_KIND_TEXT
+            )
+        # взяли и сразу выполнили: первая синхронизация ещё висит на правке
+        await bot.take_ticket_async(ticket_id, 11, "Техник")
+        bot.TECH_COPY_SYNCER.schedule(ticket_id)
+        await asyncio.sleep(0.05)
+        await bot.complete_ticket_async(ticket_id, 11, "Техник")
+        bot.TECH_COPY_SYNCER.schedule(ticket_id)
+        await asyncio.sleep(0.05)
+        fake.release_first.set()
+        await bot.drain_background_tasks()
+
+    asyncio.run(scenario())
+
+    final = bot.render_ticket(bot.get_ticket_data(ticket_id))
+    last_edit = {}
+    for chat_id, text in fake.edits:
+        last_edit[chat_id] = text
+    assert last_edit == {tech_id: final for tech_id in techs}
+    # второй проход дождался первого, а не пошёл параллельно
+    assert bot.TECH_COPY_SYNCER.stats()["synced"] == 2
+    assert bot.TECH_COPY_SYNCER.stats()["running"] == 0
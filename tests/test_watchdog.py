@@ -0,0 +1,72 @@
+import asyncio
+import time
+
+from aiogram import Bot, Dispatcher, types
+
+from watchdog import LoopWatchdog
+
+
+def blocking_step():
+    time.sleep(0.3)
+
+
+async def slow_handler(message: types.Message):
+    blocking_step()
+
+
+def test_stall_is_attributed_to_handler():
+    async def main():
+        dp = Dispatcher(Bot(token="123456:" + "A" * 35))
+        dp.register_message_handler(slow_handler)
+        watchdog = LoopWatchdog(interval=0.02, threshold=0.1)
+        watchdog.start(dp)
+        try:
+            await asyncio.sleep(0.05)
+            await slow_handler(None)
+            await asyncio.sleep(0.05)
+        finally:
+            await watchdog.stop()
+        return watchdog.stats()
+
+    stats = asyncio.run(main())
+
+    assert stats["stalls"] == 1
+    assert stats["uncaptured"] == 0
+    stall = stats["recent"][0]
+    assert stall["handler"] == "slow_handler"
+    assert stall["lag_ms"] >= 250
+    assert stall["where"] == "test_watchdog.py:10 blocking_step"
+
+
+def test_stall_outside_handlers_names_outermost_own_function():
+    async def background_job():
+        blocking_step()
+
+    async def main():
+        dp = Dispatcher(Bot(token="123456:" + "A" * 35))
+        dp.register_message_handler(slow_handler)  # файл хэндлеров — «свой» код
+        watchdog = LoopWatchdog(interval=0.02, threshold=0.1)
+        watchdog.start(dp)
+        try:
+            await asyncio.sleep(0.05)
+            await asyncio.create_task(background_job())
+            await asyncio.sleep(0.05)
+        finally:
+            await watchdog.stop()
+        return watchdog.stats()
+
+    stats = asyncio.run(main())
+    assert stats["recent"][0]["handler"] == "background_job"
+
+
+def test_no_stalls_on_idle_loop():
+    async def main():
+        watchdog = LoopWatchdog(interval=0.01, threshold=0.2)
+        watchdog.start(Dispatcher(Bot(token="123456:" + "A" * 35)))
+        await asyncio.sleep(0.1)
+        await watchdog.stop()
+        return watchdog.stats()
+
+    stats = asyncio.run(main())
+    assert stats["stalls"] == 0
+    assert not stats["running"]
@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+SECRET = "s3cret"
+
+
+class RecordingDispatcher:
+    def __init__(self):
+        self.updates = []
+
+    async def process_updates(self, updates):
+        self.updates.extend(updates)
+
+
+@pytest.fixture
+def webhook(bot_module, monkeypatch):
+    dispatcher = RecordingDispatcher()
+    monkeypatch.setattr(bot_module, "dp", dispatcher)
+    return bot_module, dispatcher
+
+
+def post(bot, data=None, headers=None, **kwargs):
+    async def request():
+        client = TestClient(TestServer(bot.create_webhook_app(SECRET)))
+        await client.start_server()
+        try:
+            response = await client.post(
+                bot.WEBHOOK_PATH, data=data, headers=headers or {}, **kwargs
+            )
+            return response.status
+        finally:
+            await client.close()
+
+    return asyncio.run(request())
+
+
+def secret_header(bot, value=SECRET):
+    return {bot.WEBHOOK_SECRET_HEADER: value}
+
+
+UPDATE = {
+    "update_id": 42,
+    "message": {
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": 7, "type": "private"},
+        "from": {"id": 7, "is_bot": False, "first_name": "Продавец"},
+        "text": "/start",
+    },
+}
+
+
+@pytest.mark.parametrize("headers", [None, {"X-Telegram-Bot-Api-Secret-Token": "wrong"}])
+def test_request_without_valid_secret_is_rejected(webhook, headers):
+    bot, dispatcher = webhook
+
+    assert post(bot, json=UPDATE, headers=headers) == 403
+    assert dispatcher.updates == []
+
+
+def test_bad_json_is_rejected(webhook):
+    bot, dispatcher = webhook
+
+    status = post(
+        bot,
+        data="{not json",
+        headers={**secret_header(bot), "Content-Type": "application/json"},
+    )
+
+    assert status == 400
+    assert dispatcher.updates == []
+
+
+def test_valid_update_is_dispatched_once(webhook):
+    bot, dispatcher = webhook
+
+    assert post(bot, json=UPDATE, headers=secret_header(bot)) == 200
+    assert [update.update_id for update in dispatcher.updates] == [42]
+    assert dispatcher.updates[0].message.text == "/start"
@@ -0,0 +1,208 @@
+"""Поиск блокировок цикла событий.
+
+LoopWatchdog замеряет задержку цикла сердцебиением и, когда цикл завис,
+снимает из отдельного потока стек его потока, чтобы показать хэндлер
+и место, где застрял цикл.
+"""
+import asyncio
+import inspect
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+from typing import Optional
+
+from aiogram import Dispatcher
+
+from metrics import LOOP_LAG, LOOP_STALLS
+
+# Как часто сердцебиение замеряет задержку цикла событий
+LOOP_HEARTBEAT_SECONDS = float(os.getenv("LOOP_HEARTBEAT_SECONDS", "0.1"))
+# Задержка, начиная с которой зависание пишется в лог со стеком
+LOOP_STALL_SECONDS = float(os.getenv("LOOP_STALL_SECONDS", "0.25"))
+# Кадров стека в логе и последних зависаний в /loopstats
+LOOP_STALL_STACK_LIMIT = 30
+LOOP_STALLS_KEPT = 20
+
+_ASYNCIO_DIR = os.path.dirname(asyncio.__file__)
+
+
+def handler_code_names(dispatcher: Dispatcher) -> dict:
+    """Объект кода -> имя для всех зарегистрированных хэндлеров."""
+    codes = {}
+    for handlers in (
+        dispatcher.message_handlers,
+        dispatcher.edited_message_handlers,
+        dispatcher.callback_query_handlers,
+        dispatcher.errors_handlers,
+    ):
+        for handler_obj in handlers.handlers:
+            # Под обёрткой замера из observe_handlers — исходная функция
+            func = inspect.unwrap(handler_obj.handler)
+            code = getattr(func, "__code__", None)
+            if code is not None:
+                codes[code] = func.__name__
+    return codes
+
+
+class LoopWatchdog:
+    """
+    Сердцебиение раз в interval секунд засыпает в цикле событий и замеряет,
+    насколько позже положенного проснулось: это задержка цикла (LOOP_LAG).
+
+    Отдельный поток следит за временем последнего удара. Если цикл молчит
+    заметно дольше interval, поток снимает стек потока цикла через
+    sys._current_frames(): на его вершине в этот момент блокирующий вызов.
+    Когда цикл отвиснет и задержка окажется не меньше threshold, сердцебиение
+    пишет в лог стек и хэндлер, в котором застрял цикл.
+    """
+
+    def __init__(
+        self, interval: float = LOOP_HEARTBEAT_SECONDS, threshold: float = LOOP_STALL_SECONDS
+    ):
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls = 0
+        self.uncaptured = 0
+        self.max_lag = 0.0
+        self.recent: deque = deque(maxlen=LOOP_STALLS_KEPT)
+        self._lags: deque = deque(maxlen=1000)
+        self._handler_codes: dict = {}
+        # Файлы с хэндлерами — код бота, а не библиотек
+        self._own_files: frozenset = frozenset()
+        self._loop_thread_id: Optional[int] = None
+        self._last_beat = 0.0
+        # (удар, после которого снят стек, хэндлер, место вызова, стек);
+        # пишет только поток наблюдателя, забирает и обнуляет сердцебиение
+        self._captured = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, dispatcher: Dispatcher):
+        if self._task is not None:
+            return
+        self._handler_codes = handler_code_names(dispatcher)
+        self._own_files = frozenset(code.co_filename for code in self._handler_codes)
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stop.set()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await asyncio.to_thread(self._thread.join)
+        self._thread = None
+
+    async def _heartbeat(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - started - self.interval, 0.0)
+            beat, self._last_beat = self._last_beat, time.monotonic()
+            captured, self._captured = self._captured, None
+            self._lags.append(lag)
+            LOOP_LAG.observe(lag)
+            if lag >= self.threshold:
+                # Стек, снятый до прошлого удара, относится к другому зависанию
+                self._report(lag, captured if captured and captured[0] == beat else None)
+
+    def _watch(self):
+        # Стек снимаем с запасом до порога: зависание длиной ровно threshold
+        # иначе могло бы закончиться раньше, чем поток успеет проснуться
+        capture_after = self.interval + self.threshold / 2
+        while not self._stop.wait(self.threshold / 4):
+            beat = self._last_beat
+            if time.monotonic() - beat < capture_after:
+                continue
+            if self._captured is not None and self._captured[0] == beat:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is not None:
+                self._captured = (beat,) + self._describe(frame)
+
+    def _describe(self, frame) -> tuple:
+        """(хэндлер, место вызова, стек) для кадра, на котором стоит цикл."""
+        code = frame.f_code
+        where = f"{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}"
+        # Кадры задачи — до первого кадра самого asyncio (шаг задачи, цикл)
+        frames = []
+        current = frame
+        while current is not None and not current.f_code.co_filename.startswith(_ASYNCIO_DIR):
+            frames.append((current, current.f_lineno))
+            current = current.f_back
+        if not frames:
+            frames = list(traceback.walk_stack(frame))
+        handler = None
+        for current, _ in frames:
+            handler = self._handler_codes.get(current.f_code)
+            if handler is not None:
+                break
+        else:
+            # Не из хэндлера: фоновая задача бота или чужой код
+            own = [f.f_code.co_name for f, _ in frames if f.f_code.co_filename in self._own_files]
+            handler = own[-1] if own else "вне бота"
+        frames.reverse()
+        stack = traceback.StackSummary.extract(frames, limit=LOOP_STALL_STACK_LIMIT)
+        return handler, where, "".join(stack.format())
+
+    def _report(self, lag: float, captured):
+        self.stalls += 1
+        self.max_lag = max(self.max_lag, lag)
+        if captured is None:
+            self.uncaptured += 1
+            handler, where, stack = "не определён", "", ""
+        else:
+            _, handler, where, stack = captured
+        LOOP_STALLS.inc(handler)
+        self.recent.append(
+            {"at": datetime.now(), "lag_ms": lag * 1000, "handler": handler, "where": where}
+        )
+        if stack:
+            logging.warning(
+                f"Цикл событий завис на {lag * 1000:.0f} мс: {handler}, {where}. "
+                f"Стек задачи:\n{stack.rstrip()}"
+            )
+        else:
+            logging.warning(
+                f"Цикл событий завис на {lag * 1000:.0f} мс, стек снять не успели "
+                "(несколько коротких блокировок подряд)."
+            )
+
+    def stats(self) -> dict:
+        lags = sorted(self._lags)
+
+        def percentile(p: float) -> float:
+            if not lags:
+                return 0.0
+            return lags[min(len(lags) - 1, int(len(lags) * p))]
+
+        return {
+            "running": self._task is not None,
+            "interval_ms": self.interval * 1000,
+            "threshold_ms": self.threshold * 1000,
+            "stalls": self.stalls,
+            "uncaptured": self.uncaptured,
+            "lag_p50_ms": percentile(0.5) * 1000,
+            "lag_p99_ms": percentile(0.99) * 1000,
+            "max_lag_ms": self.max_lag * 1000,
+            "recent": list(self.recent),
+        }
+
+
+LOOP_WATCHDOG = LoopWatchdog()